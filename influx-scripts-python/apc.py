@@ -1,20 +1,29 @@
+import asyncio
 import decimal
-from random import randint
-from time import time, sleep
-
-from pysnmp.error import PySnmpError
-from pysnmp.hlapi import ObjectType, ObjectIdentity, getCmd, SnmpEngine, UsmUserData, UdpTransportTarget, ContextData
-
-from influx_writer import send_data_to_influx
+from time import monotonic, perf_counter, time_ns
+
+import snmp_engine
+from collector_stats import increment_stat, record_error, set_duration_stat
+from deadband_filter import filter_unchanged_fields, hold_values_until_written
+from device_health import (CircuitOpenError, get_device_timeout, record_device_failure, record_device_success,
+                           save_device_health, should_poll_device)
+from device_inventory import get_assigned_devices
+from influx_writer import close_influx_writer, get_precision_timestamp, send_data_to_influx
+from latest_value_cache import record_latest_values
+from line_protocol import build_series_prefix, encode_point
 from my_credentials import APC_SNMPV3_USER
+from phase_scheduler import get_device_phase_delay_seconds, wait_for_collector_phase
+from response_recorder import record_response, save_recorded_responses
+from snmp_engine import (build_object_type_list, forget_transport_target, get_snmp_engine, get_transport_target,
+                         run_snmp_coroutine)
 
 # Gets APC UPS information using its NMC2 network management card and SNMPv3
 # https://www.apc.com/us/en/product/SFPMIB441/powernet-mib-v4-4-1/
 # https://www.apc.com/us/en/faqs/FA156048/
 
-# These Tuples define the IP address from which to fetch data and the tag "ups" stored in InfluxDB for each.
-# This way, if the IP address changes, an update can be made to keep the data going to the same tag in Influx
-ip_addresses_to_influx_ups = [("apc.brad", "apc")]
+# These Tuples define the IP address from which to fetch data and the tag "ups" stored in InfluxDB for each, taken from
+# the "apc" devices in the inventory that this process polls
+ip_addresses_to_influx_ups = get_assigned_devices("apc")
 # This Dict defines the SNMP OIDs under which the values are retrieved, alongside the names of each field in InfluxDB
 oid_to_influx_field_dict = {"1.3.6.1.4.1.318.1.1.1.3.3.1.0": "utilVoltage",
                             "1.3.6.1.4.1.318.1.1.1.2.3.2.0": "upsTemp",
@@ -22,115 +31,173 @@ oid_to_influx_field_dict = {"1.3.6.1.4.1.318.1.1.1.3.3.1.0": "utilVoltage",
                             "1.3.6.1.4.1.318.1.1.1.4.3.4.0": "loadCurrent"}
 # Define the "measurement" category under which the data fields will be stored
 influx_measurement_name = "ups_data"
+# This Dict defines the optional deadband of Influx fields, as described in deadband_filter.py
+influx_field_deadbands = {"utilVoltage": (1, None),
+                          "upsTemp": (0.5, None)}
 # Define the port where SNMP is running on the target devices
 snmp_port_number = 161
 
-
-# Given a list of OIDs, create the object structure needed by the SNMP library
-def create_object_type_list_from_oid_list(oid_list):
-    object_type_list = []
-    for oid in oid_list:
-        object_type_list.append(ObjectType(ObjectIdentity(oid)))
-    return object_type_list
-
-
-# Given an IP address and a list of OIDs, fetch the OID values using the SNMP library's GET command
-def fetch_data(ip_address, oid_list):
-    object_type_list = create_object_type_list_from_oid_list(oid_list)
-    # For SNMPV2, replace UsmUserData("someSNMPuser") with CommunityData("public")
-    result_tuple = getCmd(SnmpEngine(), UsmUserData(APC_SNMPV3_USER),
-                          UdpTransportTarget((ip_address, snmp_port_number)), ContextData(), *object_type_list)
-    return result_tuple
-
-
-# Convert the dict to a string in Line Protocol, which is `field=value,field2=value2,field3=value3` for the data section
-def parse_influx_dict_into_line_protocol(influx_dict):
-    line_protocol_list = []
-    for key in influx_dict:
-        line_protocol_list.append("{}={}".format(key, influx_dict[key]))
-    return ",".join(line_protocol_list)
+# The SNMP credentials, context, and list of OIDs to request are built on first use, and reused for every poll
+snmp_request_tuple = None
+
+
+# Get the Tuple of SNMP credentials, context, and OIDs to request, building it the first time. pysnmp is imported
+# here rather than at the top, so it isn't loaded until a UPS is actually polled
+def get_snmp_request_tuple():
+    global snmp_request_tuple
+    if snmp_request_tuple is None:
+        from pysnmp.hlapi.asyncio import ContextData, UsmUserData
+        # For SNMPV2, replace UsmUserData("someSNMPuser") with CommunityData("public")
+        snmp_request_tuple = (UsmUserData(APC_SNMPV3_USER), ContextData(),
+                              build_object_type_list(oid_to_influx_field_dict.keys()))
+    return snmp_request_tuple
+
+
+# Given an IP address, fetch the OID values using the SNMP library's asyncio GET command on the shared engine,
+# optionally with a timeout for each try other than the default
+async def fetch_data(ip_address, timeout_seconds=None):
+    from pysnmp.hlapi.asyncio import getCmd
+    usm_user_data, context_data, object_type_list = get_snmp_request_tuple()
+    transport_target = get_transport_target(ip_address, snmp_port_number, timeout_seconds)
+    return await getCmd(get_snmp_engine(), usm_user_data, transport_target, context_data, *object_type_list)
+
+
+# Given an IP address and the monotonic time the cycle started, wait for the device's phase slot and fetch from it
+# unless its circuit breaker is open, with a timeout based on how quickly it usually responds. Returns a Tuple of the
+# seconds the fetch took, the time since Epoch in nanoseconds that it finished, and the result Tuple
+async def fetch_data_with_device_health(ip_address, cycle_start_time):
+    if not should_poll_device("apc", ip_address):
+        raise CircuitOpenError("Circuit breaker for {} is open, skipping until its next probe".format(ip_address))
+    await asyncio.sleep(get_device_phase_delay_seconds("apc", ip_address, cycle_start_time))
+    start_time = perf_counter()
+    data = await fetch_data(ip_address, get_device_timeout("apc", ip_address, snmp_engine.snmp_timeout_seconds))
+    return perf_counter() - start_time, time_ns(), data
+
+
+# Given a list of IP addresses, fetch from all of them at once so polling many UPSes costs about one round trip, each
+# starting in its own phase slot. Returns a list in the same order, where each entry is either a Tuple of the seconds
+# taken, the time it finished, and the result Tuple, or the Exception that was raised
+async def fetch_data_from_all(ip_address_list):
+    cycle_start_time = monotonic()
+    return await asyncio.gather(*[fetch_data_with_device_health(ip_address, cycle_start_time)
+                                  for ip_address in ip_address_list], return_exceptions=True)
+
+
+# Given a list of (OID, value) Tuples of strings as returned by the UPS, convert each value and store it in a dict under
+# its Influx field name
+def parse_var_binds_into_influx_dict(oid_value_tuples):
+    influx_dict = {}
+    for data_oid, data_value in oid_value_tuples:
+        print("Retrieved OID {} with value {}".format(data_oid, data_value))
+        # APC returns integers and requires division by 10 to get the true value
+        try:
+            data_value_adjusted = decimal.Decimal(data_value) / 10
+        except decimal.InvalidOperation:
+            # Don't exit on an Exception when getting data, just skip the current IP
+            print("Could not convert OID {} value [{}] to a decimal, skipping this value".format(data_oid, data_value))
+            continue
+        # Look up the OID to Influx field name mapping
+        influx_field_name = oid_to_influx_field_dict.get(data_oid)
+        if influx_field_name:
+            # Add the Influx field name and data value combo to the dict
+            influx_dict[influx_field_name] = data_value_adjusted
+    return influx_dict
 
 
-# Top-level APC data-gathering function to orchestrate all the other calls in this file
-def collect_and_write_apc_readings():
+# Top-level APC data-gathering function to orchestrate all the other calls in this file, returning the Line Protocol
+# for every UPS without writing it
+def collect_apc_readings():
     # Instantiate a list to store lines of Line Protocol to write to Influx
     line_protocol_string_list = []
-    # Iterate through each tuple of IP and Influx ups name
-    for ip_to_ups_tuple in ip_addresses_to_influx_ups:
+    # Build the request parts and engine up front, so that first-time work doesn't hold up the shared SNMP event loop
+    get_snmp_request_tuple()
+    get_snmp_engine()
+    # Get the data from every IP at once, using the prebuilt list of OIDs from the dict
+    fetched_data_list = run_snmp_coroutine(fetch_data_from_all([current_ip for current_ip, _ in
+                                                                ip_addresses_to_influx_ups]))
+    # Iterate through each tuple of IP and Influx ups name alongside the data fetched from it
+    for ip_to_ups_tuple, data in zip(ip_addresses_to_influx_ups, fetched_data_list):
         current_ip = ip_to_ups_tuple[0]
         influx_ups_name = ip_to_ups_tuple[1]
         print("\nChecking IP {} with Influx Host Name {}".format(current_ip, influx_ups_name))
-        try:
-            # Get the data from the current IP, using the dict to source the OIDs needed
-            data = fetch_data(current_ip, oid_to_influx_field_dict.keys())
-        except PySnmpError:
-            # Don't exit on an Exception when getting data, rather skipping the current IP
-            print("Could not connect/fetch from IP {}, skipping".format(current_ip))
+        if isinstance(data, Exception):
+            record_error("apc", current_ip, data)
+        if isinstance(data, CircuitOpenError):
+            print("Skipping IP {}: {}".format(current_ip, data))
+            continue
+        elif isinstance(data, Exception):
+            # Don't exit on any Exception when getting data, such as the host name not resolving, rather skipping the
+            # current IP so the others are still written. Forget its transport so the host name is resolved again next
+            # time in case that is what failed
+            print("Could not connect/fetch from IP {}, skipping. Error was {}".format(current_ip, data))
+            forget_transport_target(current_ip, snmp_port_number)
+            record_device_failure("apc", current_ip)
             continue
 
         # Parse the returned data Tuple
-        error_indication = data[0]
-        error_status = data[1]
-        error_index = data[2]
-        var_binds = data[3]
-        # Skip this IP and proceed to others if an error is found
+        fetch_seconds, fetch_time, (error_indication, error_status, error_index, var_binds) = data
+        # Skip this IP and proceed to others if an error is found. An error indication means the UPS never answered,
+        # while an error status is still a response from it
         if error_indication:
             print("SNMP returned an error for IP {}, skipping: {}".format(current_ip, error_indication))
+            record_device_failure("apc", current_ip)
+            record_error("apc", current_ip, error_indication)
             continue
-        elif error_status:
+        record_device_success("apc", current_ip, fetch_seconds)
+        set_duration_stat("apc", current_ip, "fetchMilliseconds", fetch_seconds)
+        if error_status:
             print("SNMP returned an error for IP {}, skipping: {} at {}".format(current_ip,
                                                                                 error_status.prettyPrint(),
                                                                                 error_index and
                                                                                 var_binds[int(error_index) - 1][
                                                                                     0] or "?"))
             continue
-        # Otherwise begin parsing the returned data
-        influx_dict = {}
-        # Each var_bind is a tuple itself, with the first element being an identifier and the second a value
-        for var_bind in var_binds:
-            data_oid = var_bind[0].getOid().prettyPrint()
-            data_value = var_bind[1].prettyPrint()
-            print("Retrieved OID {} with value {}".format(data_oid, data_value))
-            # APC returns integers and requires division by 10 to get the true value
-            try:
-                data_value_adjusted = decimal.Decimal(data_value) / 10
-            except decimal.InvalidOperation:
-                # Don't exit on an Exception when getting data, just skip the current IP
-                print("Could not convert OID {} value [{}] to a decimal, skipping this value".format(data_oid,
-                                                                                                     data_value))
-                continue
-            # Look up the OID to Influx field name mapping
-            influx_field_name = oid_to_influx_field_dict.get(data_oid)
-            if influx_field_name:
-                # Add the Influx field name and data value combo to the dict
-                influx_dict[influx_field_name] = data_value_adjusted
-
+        # Otherwise begin parsing the returned data. Each var_bind is a tuple itself, with the first element being an
+        # identifier and the second a value, which are read as strings
+        parse_start_time = perf_counter()
+        oid_value_tuples = [(var_bind[0].getOid().prettyPrint(), var_bind[1].prettyPrint()) for var_bind in var_binds]
+        record_response("apc", current_ip, oid_value_tuples, fetch_time)
+        influx_dict = parse_var_binds_into_influx_dict(oid_value_tuples)
+        set_duration_stat("apc", current_ip, "parseMilliseconds", perf_counter() - parse_start_time)
         # Skip adding line protocol for output if there were no values
         if len(influx_dict) < 1:
             print("No valid data was found for IP {}, skipping submission of this IP".format(current_ip))
             continue
+        record_latest_values(influx_measurement_name, influx_ups_name, influx_dict, fetch_time)
+        # Drop the fields that haven't changed beyond their deadband, skipping this IP if that leaves none
+        influx_dict = filter_unchanged_fields("apc", influx_ups_name, influx_dict, influx_field_deadbands)
+        if len(influx_dict) < 1:
+            print("No field from IP {} changed beyond its deadband, skipping submission".format(current_ip))
+            continue
 
-        # Convert the Influx field name dict into a Line Protocol string, but just the data at this point
-        line_protocol_data_string = parse_influx_dict_into_line_protocol(influx_dict)
-        # Get the current time since Epoch in seconds, which is used when writing lines to Influx
-        epoch_time_seconds = int(time())
-        # Format the rest of the Line Protocol, forming together the measurement, tags, field set, and time
-        line_protocol_full_string = "{},ups={} {} {}".format(influx_measurement_name, influx_ups_name,
-                                                             line_protocol_data_string, epoch_time_seconds)
+        # Encode the Line Protocol, forming together the measurement, tags, field set, and time
+        line_protocol_full_string = encode_point(build_series_prefix(influx_measurement_name,
+                                                                     (("ups", influx_ups_name),)),
+                                                 influx_dict, get_precision_timestamp(fetch_time))
+        # Count the filtered values as written only once InfluxDB has this line
+        hold_values_until_written("apc", influx_ups_name, line_protocol_full_string)
         # Add the completed Line Protocol to the list of Line Protocol to write to Influx
         line_protocol_string_list.append(line_protocol_full_string)
+        increment_stat("apc", current_ip, "points")
+    save_device_health("apc")
+    save_recorded_responses("apc")
+    return line_protocol_string_list
 
+
+# Collect the APC data and write it to Influx on its own
+def collect_and_write_apc_readings():
+    line_protocol_string_list = collect_apc_readings()
     # Skip calling InfluxDB if the Line Protocol list ended up being empty
     if len(line_protocol_string_list) < 1:
-        print("No APC UPS data found, exiting")
-        exit(0)
+        print("No APC UPS data found, skipping write")
+        return
     print("\nWriting data from {} APC UPS unit(s) into InfluxDB".format(len(line_protocol_string_list)))
     send_data_to_influx(line_protocol_string_list)
     print("Completed writing APC data to Influx!")
 
 
 if __name__ == '__main__':
-    wait_seconds = randint(0, 10)
-    print("Adding {} second(s) of jitter before executing".format(wait_seconds))
-    sleep(wait_seconds)
+    wait_for_collector_phase("apc")
     collect_and_write_apc_readings()
+    # Write anything still batched before the process exits
+    close_influx_writer()
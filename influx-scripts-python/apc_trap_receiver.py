@@ -0,0 +1,181 @@
+import asyncio
+import socket
+from time import perf_counter, sleep, time_ns
+
+import apc
+from collector_stats import increment_stat, record_error, set_duration_stat
+from device_inventory import load_device_inventory
+from influx_writer import close_influx_writer, get_precision_timestamp, send_data_to_influx
+from latest_value_cache import record_latest_values
+from line_protocol import build_series_prefix, encode_point
+from my_credentials import APC_SNMPV3_USER
+from snmp_engine import get_snmp_engine, run_snmp_coroutine
+
+# Event-driven APC ingestion, so power events reach InfluxDB within a second rather than at the next poll. An SNMPv3
+# trap and inform receiver runs on the shared SNMP event loop with the same user apc.py polls with. Each PowerNet
+# notification from a known UPS is written straight away as a `ups_data` point holding the notification's code and any
+# of the polled OIDs it carried, and triggers a GET of that UPS so its full reading follows right behind.
+# Informs are answered by this engine, so they work as-is. Traps come from each UPS's own engine ID, so they are
+# accepted for the user from any engine ID, which needs the user to be without authentication as it is for polling.
+# Run on its own with `pipenv run python3 apc_trap_receiver.py`, or alongside the polls in collector_daemon.py
+
+# Define the address and port to receive notifications on. Port 162 is the standard one but needs root to bind
+trap_listen_host = "0.0.0.0"
+trap_listen_port = 162
+
+# Define the OID whose value is the OID of the notification itself, and the prefix of every PowerNet notification,
+# after which comes the notification's code, such as 5 for "UPS on battery"
+snmp_trap_oid = "1.3.6.1.6.3.1.1.4.1.0"
+powernet_trap_oid_prefix = "1.3.6.1.4.1.318.0."
+# Define the Influx field holding a notification's code
+trap_code_influx_field = "trapCode"
+# Define the pysnmp engine ID matching any sender, under which the user is added so traps from every UPS are accepted
+wildcard_security_engine_id_hex = "0000000000"
+
+# Map each IP address notifications may come from to its (inventory address, Influx ups name), built when starting
+source_ip_to_ups_dict = {}
+# The IP addresses with a GET already under way, so a burst of notifications only triggers one
+pending_get_ip_set = set()
+
+
+# Build the map of source IP to UPS from every APC in the inventory, not only those this process polls, since only one
+# process can receive on the port. Addresses are resolved once here, so notifications are matched without a lookup
+def build_source_ip_to_ups_dict():
+    source_ip_to_ups_dict.clear()
+    for address, influx_ups_name in load_device_inventory().get("apc", []):
+        try:
+            resolved_ip = socket.gethostbyname(address)
+        except OSError as resolve_error:
+            print("Could not resolve APC address {}, notifications from it will be ignored: {}".format(
+                address, resolve_error))
+            continue
+        source_ip_to_ups_dict[resolved_ip] = (address, influx_ups_name)
+
+
+# Encode one `ups_data` point for a UPS and write it
+def write_ups_point(influx_ups_name, influx_dict, fetch_time):
+    line_protocol_full_string = encode_point(build_series_prefix(apc.influx_measurement_name,
+                                                                 (("ups", influx_ups_name),)),
+                                             influx_dict, get_precision_timestamp(fetch_time))
+    if line_protocol_full_string is None:
+        return
+    print("Converted notification data into Line Protocol: {}".format(line_protocol_full_string))
+    send_data_to_influx([line_protocol_full_string])
+
+
+# GET the polled OIDs from a UPS right after a notification and write the reading, the same as a poll would. The write
+# runs in a worker thread, so a slow InfluxDB doesn't hold up the SNMP event loop
+async def fetch_and_write_after_notification(address, influx_ups_name):
+    try:
+        start_time = perf_counter()
+        error_indication, error_status, _, var_binds = await apc.fetch_data(address)
+        set_duration_stat("apc", address, "fetchMilliseconds", perf_counter() - start_time)
+        if error_indication or error_status:
+            print("SNMP returned an error for IP {} after a notification: {}".format(address, error_indication or
+                                                                                      error_status.prettyPrint()))
+            return
+        influx_dict = apc.parse_var_binds_into_influx_dict([(var_bind[0].getOid().prettyPrint(),
+                                                             var_bind[1].prettyPrint()) for var_bind in var_binds])
+        fetch_time = time_ns()
+        record_latest_values(apc.influx_measurement_name, influx_ups_name, influx_dict, fetch_time)
+        await asyncio.get_running_loop().run_in_executor(None, write_ups_point, influx_ups_name, influx_dict,
+                                                         fetch_time)
+    except Exception as fetch_error:
+        # Nothing awaits this task, so any error, such as the address not resolving, is reported here or not at all
+        print("Could not fetch and write from IP {} after a notification: {}".format(address, fetch_error))
+        record_error("apc", address, fetch_error)
+    finally:
+        pending_get_ip_set.discard(address)
+
+
+# Report the error, if any, of writing a notification's point in a worker thread, since nothing awaits the write
+def report_notification_write_error(address, write_future):
+    if write_future.cancelled() or write_future.exception() is None:
+        return
+    print("Could not write notification data from IP {}: {}".format(address, write_future.exception()))
+    record_error("apc", address, write_future.exception())
+
+
+# Handle one notification, which pysnmp calls on the SNMP event loop. Notifications from unknown senders are ignored
+def handle_notification(snmp_engine, state_reference, context_engine_id, context_name, var_binds, callback_context):
+    try:
+        source_ip = snmp_engine.observer.getExecutionContext("rfc3412.receiveMessage:request")["transportAddress"][0]
+        ups_tuple = source_ip_to_ups_dict.get(source_ip)
+        if ups_tuple is None:
+            print("Ignoring notification from unknown address {}".format(source_ip))
+            return
+        address, influx_ups_name = ups_tuple
+        oid_value_tuples = [(oid.prettyPrint(), value.prettyPrint()) for oid, value in var_binds]
+        print("Received notification from {}: {}".format(influx_ups_name, oid_value_tuples))
+        increment_stat("apc", address, "notifications")
+        influx_dict = {}
+        for data_oid, data_value in oid_value_tuples:
+            if data_oid == snmp_trap_oid and data_value.startswith(powernet_trap_oid_prefix):
+                # Stored as a float like every other ups_data field
+                influx_dict[trap_code_influx_field] = float(data_value[len(powernet_trap_oid_prefix):])
+        # Notifications carrying any of the polled OIDs give their values straight away
+        influx_dict.update(apc.parse_var_binds_into_influx_dict(
+            [(data_oid, data_value) for data_oid, data_value in oid_value_tuples
+             if data_oid in apc.oid_to_influx_field_dict]))
+        if len(influx_dict) > 0:
+            fetch_time = time_ns()
+            record_latest_values(apc.influx_measurement_name, influx_ups_name, influx_dict, fetch_time)
+            write_future = asyncio.get_running_loop().run_in_executor(None, write_ups_point, influx_ups_name,
+                                                                      influx_dict, fetch_time)
+            write_future.add_done_callback(lambda done_future: report_notification_write_error(address, done_future))
+        if address not in pending_get_ip_set:
+            pending_get_ip_set.add(address)
+            asyncio.ensure_future(fetch_and_write_after_notification(address, influx_ups_name))
+    except Exception as notification_error:
+        # Don't let one bad notification stop the receiver
+        print("Could not handle notification: {}".format(notification_error))
+        record_error("apc", None, notification_error)
+
+
+# Create the receiving engine and open its port, which must run on the SNMP event loop that the port is bound to.
+# Raises an OSError if the port can't be bound
+async def open_trap_receiver():
+    from pysnmp.carrier.asyncio.dgram import udp
+    from pysnmp.entity import config, engine
+    from pysnmp.entity.rfc3413 import ntfrcv
+    from pysnmp.proto.api import v2c
+    # The receiver has its own engine, since it answers informs as its own authority rather than as the poller
+    trap_engine = engine.SnmpEngine()
+    # Bind the socket here rather than leaving it to pysnmp, which binds it later on the event loop, so a port that is
+    # in use or needs root fails right away
+    trap_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        trap_socket.bind((trap_listen_host, trap_listen_port))
+    except OSError:
+        trap_socket.close()
+        raise
+    config.addTransport(trap_engine, udp.domainName, udp.UdpTransport().openServerMode(sock=trap_socket))
+    config.addV3User(trap_engine, APC_SNMPV3_USER)
+    config.addV3User(trap_engine, APC_SNMPV3_USER,
+                     securityEngineId=v2c.OctetString(hexValue=wildcard_security_engine_id_hex))
+    ntfrcv.NotificationReceiver(trap_engine, handle_notification)
+    return trap_engine
+
+
+# Start receiving notifications in the background on the SNMP event loop, returning the receiving engine
+def start_trap_receiver():
+    build_source_ip_to_ups_dict()
+    # Build the GET's request parts and engine up front, so that first-time work doesn't hold up the event loop
+    apc.get_snmp_request_tuple()
+    get_snmp_engine()
+    trap_engine = run_snmp_coroutine(open_trap_receiver())
+    print("Receiving APC notifications on {}:{} from {} UPS(es)".format(trap_listen_host, trap_listen_port,
+                                                                         len(source_ip_to_ups_dict)))
+    return trap_engine
+
+
+if __name__ == '__main__':
+    start_trap_receiver()
+    try:
+        # Notifications are handled on the SNMP event loop's thread, so the main thread only waits to be stopped
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    # Write anything still batched before the process exits
+    close_influx_writer()
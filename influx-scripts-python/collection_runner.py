@@ -0,0 +1,91 @@
+import sys
+from time import perf_counter
+from traceback import print_exc
+
+from apc import collect_apc_readings
+from collector_stats import increment_stat, record_error, set_duration_stat
+from esp import collect_esp_sensor_readings, sample_esp_sensor_readings
+from fetch_engine import fetch_all_concurrently
+from influx_writer import close_influx_writer, send_data_to_influx
+from phase_scheduler import wait_for_collector_phase
+from tasmota import collect_tasmota_readings, sample_tasmota_readings
+from ubiquiti import collect_s16_readings
+from unraid import collect_unraid_readings
+
+# Every collector follows the same interface: a function taking no arguments that fetches from its devices and returns
+# a list of Line Protocol strings without writing them. This runner calls every collector and merges their output into
+# a single write per cycle, which is also the one place for behavior that applies to every collector's records.
+
+# These Tuples define the name of each collector and the function that returns its Line Protocol
+collector_name_function_tuples = [("esp", collect_esp_sensor_readings),
+                                  ("tasmota", collect_tasmota_readings),
+                                  ("apc", collect_apc_readings),
+                                  ("s16", collect_s16_readings),
+                                  ("unraid", collect_unraid_readings)]
+# These Tuples define the name of each collector that can also be sampled between its writes, and the function taking
+# no arguments that samples its devices into the window_aggregator without returning anything
+collector_name_sample_function_tuples = [("esp", sample_esp_sensor_readings),
+                                         ("tasmota", sample_tasmota_readings)]
+
+
+# Run one collector and return its Line Protocol, or an empty list if it fails so the other collectors still get written
+def run_collector(collector_name_function_tuple):
+    collector_name, collect_function = collector_name_function_tuple
+    collect_start_time = perf_counter()
+    try:
+        line_protocol_string_list = collect_function()
+    except Exception as collector_error:
+        # Don't exit on an Exception from one collector, rather printing it and skipping that collector's data
+        print("Collector {} failed, skipping its data".format(collector_name))
+        print_exc()
+        record_error(collector_name, None, collector_error)
+        return []
+    set_duration_stat(collector_name, None, "collectMilliseconds", perf_counter() - collect_start_time)
+    increment_stat(collector_name, None, "points", len(line_protocol_string_list))
+    print("Collector {} produced {} line(s) of Line Protocol".format(collector_name, len(line_protocol_string_list)))
+    return line_protocol_string_list
+
+
+# Write the Line Protocol gathered from one or more collectors to Influx
+def write_collected_records(line_protocol_string_list):
+    # Skip calling InfluxDB if the Line Protocol list ended up being empty
+    if len(line_protocol_string_list) < 1:
+        print("No data collected, skipping write")
+        return
+    send_data_to_influx(line_protocol_string_list)
+
+
+# Run one collector once its phase slot in the current interval arrives, returning its Line Protocol
+def run_collector_in_phase(collector_name_function_tuple):
+    wait_for_collector_phase(collector_name_function_tuple[0])
+    return run_collector(collector_name_function_tuple)
+
+
+# Run every collector at once, then write everything they collected together in one call. When started from cron, each
+# collector can first wait for its own phase slot so they don't all hit the network in the same instant
+def run_collection_cycle(name_function_tuples=None, wait_for_phase=False):
+    if name_function_tuples is None:
+        name_function_tuples = collector_name_function_tuples
+    if len(name_function_tuples) < 1:
+        print("No collectors selected, exiting")
+        return
+    # Collectors already bound their own device fetches, so let them run to completion rather than imposing a deadline
+    collected_list = fetch_all_concurrently(run_collector_in_phase if wait_for_phase else run_collector,
+                                            name_function_tuples, max_workers=len(name_function_tuples),
+                                            deadline_seconds=None)
+    line_protocol_string_list = []
+    for collected in collected_list:
+        line_protocol_string_list.extend(collected)
+    print("\nWriting {} line(s) from {} collector(s) into InfluxDB".format(len(line_protocol_string_list),
+                                                                          len(name_function_tuples)))
+    write_collected_records(line_protocol_string_list)
+
+
+if __name__ == '__main__':
+    # Optionally limit the cycle to the collectors named on the command line, such as `esp tasmota`
+    selected_name_list = sys.argv[1:]
+    run_collection_cycle([name_function_tuple for name_function_tuple in collector_name_function_tuples
+                          if len(selected_name_list) < 1 or name_function_tuple[0] in selected_name_list],
+                         wait_for_phase=True)
+    # Write anything still batched before the process exits
+    close_influx_writer()
@@ -0,0 +1,178 @@
+import multiprocessing
+import os
+import signal
+from threading import Event, Thread
+from time import monotonic, time
+from traceback import print_exc
+
+from collection_runner import (collector_name_function_tuples, collector_name_sample_function_tuples, run_collector,
+                               write_collected_records)
+import apc_trap_receiver
+import device_inventory
+import esp_ingest_server
+import latest_value_cache
+from influx_writer import close_influx_writer
+from phase_scheduler import get_next_collector_phase_time
+
+# Long-running replacement for launching each script from cron every minute. Every library is imported once when the
+# daemon starts, and each collector then runs on its own thread and interval so a slow device can't delay the others.
+# When device_inventory sets more than one worker process, the daemon instead starts that many copies of itself, each
+# polling its own share of this host's devices, so polling isn't limited to what one interpreter can keep up with
+
+# This Dict defines how many seconds to wait between the start of each run of every collector registered in
+# collection_runner. Intervals may be shorter than a minute, and collectors not listed use the default
+collector_name_to_interval_seconds = {"esp": 60,
+                                      "tasmota": 60,
+                                      "apc": 60,
+                                      "s16": 60,
+                                      "unraid": 60}
+default_interval_seconds = 60
+
+# Define whether collectors that support it are also sampled between runs, so the minimum, maximum, and mean of their
+# fast-changing fields over each interval are written alongside each run's values
+high_frequency_sampling_enabled = False
+# This Dict defines how many seconds to wait between the start of each sample of every collector that can be sampled
+collector_name_to_sample_interval_seconds = {"esp": 5,
+                                             "tasmota": 2}
+
+# Define whether the latest readings are kept in memory and served on a local HTTP endpoint, as set up in
+# latest_value_cache, so dashboards can read the current state without querying InfluxDB
+latest_value_server_enabled = True
+
+# Define whether APC notifications are received as well as polled, as set up in apc_trap_receiver, so power events are
+# written as they happen. Only the first worker process receives them, since only one process can bind the port
+apc_trap_receiver_enabled = False
+
+# Define whether ESP boards may also push their readings, as set up in esp_ingest_server, rather than only being polled.
+# Only the first worker process accepts them, since only one process can listen on the port
+esp_ingest_server_enabled = False
+
+# Define how long to wait for each collector to finish its current run when stopping, before giving up on it
+shutdown_timeout_seconds = 30
+
+# Set when the daemon is asked to stop, which wakes every collector thread out of its wait
+stop_event = Event()
+
+
+# Run a function forever on a fixed interval, measured from the start of each run so runs don't drift later. The first
+# run waits for the phase slot of the given name, so every run of it starts at the same point in its interval
+def run_on_interval(run_name, run_function, interval_seconds, phase_name):
+    next_run_time = monotonic() + get_next_collector_phase_time(phase_name, interval_seconds) - time()
+    stop_event.wait(next_run_time - monotonic())
+    while not stop_event.is_set():
+        try:
+            run_function()
+        except Exception:
+            # Don't exit on an Exception from one run, rather printing it and trying again next interval
+            print("{} failed, retrying next interval".format(run_name))
+            print_exc()
+        # Skip any runs that were missed because this one overran, rather than running them back to back
+        next_run_time += interval_seconds
+        current_time = monotonic()
+        if next_run_time < current_time:
+            print("{} overran its {} second interval".format(run_name, interval_seconds))
+            next_run_time = current_time
+        stop_event.wait(next_run_time - current_time)
+
+
+# Run one collector and write what it collected
+def run_and_write_collector(collector_name, collect_function):
+    print("\nRunning collector {}".format(collector_name))
+    write_collected_records(run_collector((collector_name, collect_function)))
+
+
+# Run one collector forever on its interval
+def run_collector_on_interval(collector_name, collect_function, interval_seconds):
+    run_on_interval("Collector {}".format(collector_name),
+                    lambda: run_and_write_collector(collector_name, collect_function), interval_seconds,
+                    collector_name)
+
+
+# Ask every collector thread to stop once it finishes its current run
+def handle_stop_signal(signal_number, _):
+    print("Received signal {}, stopping collectors".format(signal_number))
+    stop_event.set()
+
+
+# Start a thread per collector and wait until the daemon is told to stop
+def run_collector_threads():
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    signal.signal(signal.SIGINT, handle_stop_signal)
+    if latest_value_server_enabled:
+        try:
+            latest_value_cache.start_latest_value_server(device_inventory.get_worker_index() or 0)
+        except OSError as bind_error:
+            # The endpoint is only a convenience, so carry on collecting without it, such as when its port is taken
+            print("Could not start the latest value server, continuing without it: {}".format(bind_error))
+    if apc_trap_receiver_enabled and not device_inventory.get_worker_index():
+        apc_trap_receiver.start_trap_receiver()
+    if esp_ingest_server_enabled and not device_inventory.get_worker_index():
+        esp_ingest_server.start_ingest_server_thread()
+    thread_list = []
+    for collector_name, collect_function in collector_name_function_tuples:
+        interval_seconds = collector_name_to_interval_seconds.get(collector_name, default_interval_seconds)
+        thread = Thread(target=run_collector_on_interval, name=collector_name,
+                        args=(collector_name, collect_function, interval_seconds), daemon=True)
+        thread.start()
+        thread_list.append(thread)
+    # Sample in threads of their own, so a slow write never delays a sample or the other way around
+    if high_frequency_sampling_enabled:
+        for collector_name, sample_function in collector_name_sample_function_tuples:
+            interval_seconds = collector_name_to_sample_interval_seconds.get(collector_name)
+            if interval_seconds is None:
+                continue
+            thread = Thread(target=run_on_interval, name="{}-sampler".format(collector_name),
+                            args=("Sampler {}".format(collector_name), sample_function, interval_seconds,
+                                  "{}-sampler".format(collector_name)),
+                            daemon=True)
+            thread.start()
+            thread_list.append(thread)
+    # Wait in short steps rather than one long join, so the main thread stays responsive to signals
+    while not stop_event.wait(1):
+        pass
+    for thread in thread_list:
+        thread.join(timeout=shutdown_timeout_seconds)
+    print("All collectors stopped")
+    # Write anything still batched before the process exits
+    close_influx_writer()
+
+
+# Start one worker process per share of this host's devices and wait until the daemon is told to stop. Workers are
+# spawned rather than forked, so each imports the collectors afresh and picks up its own devices from the inventory
+def run_worker_processes(worker_count):
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    signal.signal(signal.SIGINT, handle_stop_signal)
+    spawn_context = multiprocessing.get_context("spawn")
+    process_list = []
+    for worker_index in range(worker_count):
+        # Spawned processes inherit the environment as it is when they start, which is how each learns its index
+        os.environ[device_inventory.worker_index_environment_variable] = str(worker_index)
+        process = spawn_context.Process(target=run_collector_threads, name="worker{}".format(worker_index))
+        process.start()
+        process_list.append(process)
+    os.environ.pop(device_inventory.worker_index_environment_variable)
+    print("Started {} worker process(es)".format(worker_count))
+    while not stop_event.wait(1):
+        # A worker that exits on its own isn't restarted, so the daemon stops and leaves restarting to its supervisor
+        if any(not process.is_alive() for process in process_list):
+            print("A worker process exited unexpectedly, stopping the others")
+            stop_event.set()
+    # Pass the stop on to each worker, which finishes its current runs and writes what it has batched before exiting
+    for process in process_list:
+        if process.is_alive():
+            process.terminate()
+    for process in process_list:
+        process.join(timeout=shutdown_timeout_seconds)
+    print("All worker processes stopped")
+
+
+# Run the collectors in this process, or across worker processes when the inventory is split between several
+def run_daemon():
+    if device_inventory.worker_process_count > 1:
+        run_worker_processes(device_inventory.worker_process_count)
+    else:
+        run_collector_threads()
+
+
+if __name__ == '__main__':
+    run_daemon()
@@ -0,0 +1,96 @@
+from threading import Lock
+
+from device_inventory import load_device_inventory
+from line_protocol import build_series_prefix, encode_point
+
+# Self-instrumentation of the collectors and the writer, written to InfluxDB as its own measurement alongside the data.
+# Collectors record per-device fetch and parse times, the points each device produced, and errors by type, and the
+# writer records the size and latency of each batch it sends. Stats build up in memory and are drained into the next
+# write, so each device's stats describe the cycle that write belongs to and the writer's stats are always one write
+# behind. Graphing them shows which device is slowing a collector down, and how a change moved the timings.
+# Collectors record stats against the address they fetch from, which is stored under the device's name from the
+# inventory, so the stats join to the device's readings and stay in one series if its address changes.
+
+# Define whether stats are recorded and written at all
+collector_stats_enabled = True
+# Define the "measurement" category under which the stats are stored
+collector_stats_measurement_name = "collector_stats"
+
+# Map each (collector name, device) to its dict of stat field to value, where the device is None for stats about the
+# collector or writer as a whole
+pending_stats_dict = {}
+collector_stats_lock = Lock()
+# Map each (collector name, address) in the inventory to the device's name, built on first use
+address_to_device_name_dict = None
+
+
+# Get the name stats for a device are stored under, which is its name in the inventory when given its address, and the
+# device as given otherwise, such as for devices not in the inventory. Must be called while holding the lock
+def get_stats_device_name(collector_name, device_key):
+    global address_to_device_name_dict
+    if address_to_device_name_dict is None:
+        address_to_device_name_dict = {(inventory_collector_name, address): name
+                                       for inventory_collector_name, device_list in load_device_inventory().items()
+                                       for address, name in device_list}
+    return address_to_device_name_dict.get((collector_name, device_key), device_key)
+
+
+# Get the dict of stats for a collector and device, creating it on first use. Must be called while holding the lock
+def get_pending_stats(collector_name, device_key):
+    if device_key is not None:
+        device_key = get_stats_device_name(collector_name, device_key)
+    stat_dict = pending_stats_dict.get((collector_name, device_key))
+    if stat_dict is None:
+        stat_dict = pending_stats_dict[(collector_name, device_key)] = {}
+    return stat_dict
+
+
+# Set a stat to a value, replacing whatever was recorded earlier in the cycle
+def set_stat(collector_name, device_key, stat_field, value):
+    if not collector_stats_enabled:
+        return
+    with collector_stats_lock:
+        get_pending_stats(collector_name, device_key)[stat_field] = value
+
+
+# Add an amount to a stat, such as the number of points produced or batches written since the last drain
+def increment_stat(collector_name, device_key, stat_field, amount=1):
+    if not collector_stats_enabled:
+        return
+    with collector_stats_lock:
+        stat_dict = get_pending_stats(collector_name, device_key)
+        stat_dict[stat_field] = stat_dict.get(stat_field, 0) + amount
+
+
+# Record an error against a device, counting it and keeping the name of its type, such as `ConnectTimeout`
+def record_error(collector_name, device_key, error):
+    if not collector_stats_enabled:
+        return
+    with collector_stats_lock:
+        stat_dict = get_pending_stats(collector_name, device_key)
+        stat_dict["errors"] = stat_dict.get("errors", 0) + 1
+        stat_dict["errorType"] = type(error).__name__
+
+
+# Set a duration stat in milliseconds, given the duration in seconds
+def set_duration_stat(collector_name, device_key, stat_field, duration_seconds):
+    set_stat(collector_name, device_key, stat_field, round(duration_seconds * 1000, 3))
+
+
+# Take every stat recorded since the last drain, returning it as Line Protocol stamped with the given timestamp and
+# starting over
+def drain_stats_lines(timestamp):
+    with collector_stats_lock:
+        if len(pending_stats_dict) < 1:
+            return []
+        pending_stats_tuple_list = list(pending_stats_dict.items())
+        pending_stats_dict.clear()
+    line_protocol_string_list = []
+    for (collector_name, device_key), stat_dict in pending_stats_tuple_list:
+        tag_tuples = (("collector", collector_name),) if device_key is None else \
+            (("collector", collector_name), ("device", device_key))
+        line_protocol_full_string = encode_point(build_series_prefix(collector_stats_measurement_name, tag_tuples),
+                                                 stat_dict, timestamp)
+        if line_protocol_full_string is not None:
+            line_protocol_string_list.append(line_protocol_full_string)
+    return line_protocol_string_list
@@ -0,0 +1,133 @@
+import json
+import os
+from threading import Lock
+from time import time
+
+from device_inventory import get_collector_file_name
+
+# Optional deadband filter applied to each device's fields before they are encoded, so values that have barely moved
+# since they were last written aren't written again. Each collector defines the deadband of each field beside its
+# field-mapping tables, as a Tuple of an absolute change and a percentage change of the last written value. A field is
+# written when its change reaches the larger of the two, and always written once the heartbeat interval has passed
+# since it was last written, so a flat series never looks like missing data. Fields without a deadband are always
+# written. A value only counts as written once InfluxDB has it, so after a failed or spooled write the next cycle's
+# value is written again rather than held back until the heartbeat. Collectors hand the line each filtered dict was
+# encoded into to hold_values_until_written(), and the writer resolves each batch's lines with resolve_written_lines().
+# The last written value of each field is kept on local disk in one file per collector, so it carries over between
+# runs of a collector started by cron.
+
+# Define whether fields are filtered at all. When off, every field is written every cycle as before
+deadband_filter_enabled = False
+# Define the longest time a field with a deadband can go without being written
+deadband_heartbeat_seconds = 15 * 60
+# Define where the last written values are stored, next to the scripts themselves
+deadband_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "deadband")
+
+# Map each collector name to its dict of device to field to [last written value, time it was written]
+collector_written_value_dict = {}
+# Map each (collector, device) to its dict of field to [value, time] that passed the filter, until its line is encoded
+pending_value_dict = {}
+# Map each encoded line to the list of (collector, device, dict of field to [value, time]) waiting for it to be written
+line_to_pending_values = {}
+deadband_lock = Lock()
+
+
+# Get the path of the last written value file for a collector
+def get_written_value_file_path(collector_name):
+    return os.path.join(deadband_directory, "{}.json".format(get_collector_file_name(collector_name)))
+
+
+# Get the dict of device to last written values for a collector, loading it from disk the first time. Must be called
+# while holding the lock. A missing or unreadable file means every field is written on its next cycle
+def get_collector_written_values(collector_name):
+    device_value_dict = collector_written_value_dict.get(collector_name)
+    if device_value_dict is None:
+        try:
+            with open(get_written_value_file_path(collector_name)) as written_value_file:
+                device_value_dict = json.load(written_value_file)
+        except (OSError, ValueError):
+            device_value_dict = {}
+        collector_written_value_dict[collector_name] = device_value_dict
+    return device_value_dict
+
+
+# Write a collector's last written values to disk, replacing the file atomically so a reader never sees it half-written
+def save_written_values(collector_name):
+    if not deadband_filter_enabled:
+        return
+    with deadband_lock:
+        written_value_json = json.dumps(get_collector_written_values(collector_name))
+    os.makedirs(deadband_directory, exist_ok=True)
+    written_value_file_path = get_written_value_file_path(collector_name)
+    temporary_file_path = "{}.{}.tmp".format(written_value_file_path, os.getpid())
+    with open(temporary_file_path, "w") as written_value_file:
+        written_value_file.write(written_value_json)
+    os.replace(temporary_file_path, written_value_file_path)
+
+
+# Return True if the change from the last written value reaches the deadband, a Tuple of the absolute change and the
+# percentage change of the last written value, where either can be None
+def exceeds_deadband(value, last_written_value, deadband_tuple):
+    absolute_change, percentage_change = deadband_tuple
+    change = abs(value - last_written_value)
+    threshold = max(absolute_change or 0, abs(last_written_value) * (percentage_change or 0) / 100)
+    return change > 0 and change >= threshold
+
+
+# Given one device's dict of Influx field to value and the collector's dict of Influx field to deadband, return a dict
+# of only the fields that should be written, holding each value that has a deadband until its line is encoded
+def filter_unchanged_fields(collector_name, device_key, field_dict, field_deadband_dict):
+    if not deadband_filter_enabled or len(field_deadband_dict) < 1:
+        return field_dict
+    current_time = time()
+    filtered_field_dict = {}
+    pending_field_dict = {}
+    with deadband_lock:
+        written_value_dict = get_collector_written_values(collector_name).get(device_key, {})
+        for influx_field, value in field_dict.items():
+            deadband_tuple = field_deadband_dict.get(influx_field)
+            if deadband_tuple is None:
+                filtered_field_dict[influx_field] = value
+                continue
+            float_value = float(value)
+            last_written = written_value_dict.get(influx_field)
+            if last_written is None or current_time - last_written[1] >= deadband_heartbeat_seconds \
+                    or exceeds_deadband(float_value, last_written[0], deadband_tuple):
+                filtered_field_dict[influx_field] = value
+                pending_field_dict[influx_field] = [float_value, current_time]
+        pending_value_dict[(collector_name, device_key)] = pending_field_dict
+    return filtered_field_dict
+
+
+# Given the line of Line Protocol a device's filtered fields were encoded into, or None if none was, hold the values
+# that passed the filter until that line is written
+def hold_values_until_written(collector_name, device_key, line_protocol_string):
+    with deadband_lock:
+        pending_field_dict = pending_value_dict.pop((collector_name, device_key), None)
+        if pending_field_dict and line_protocol_string is not None:
+            line_to_pending_values.setdefault(line_protocol_string, []).append((collector_name, device_key,
+                                                                                pending_field_dict))
+
+
+# Resolve the lines of a batch handed back by the writer, given as a newline-separated String or bytes, as either
+# written or failed. The values held for written lines become the last written values, and each collector they belong
+# to is saved, while those held for failed lines are forgotten
+def resolve_written_lines(batch_data, written):
+    if len(line_to_pending_values) < 1:
+        return
+    if isinstance(batch_data, bytes):
+        batch_data = batch_data.decode("utf-8")
+    written_collector_name_set = set()
+    with deadband_lock:
+        for line in batch_data.split("\n"):
+            pending_tuple_list = line_to_pending_values.get(line)
+            if pending_tuple_list is None:
+                continue
+            collector_name, device_key, pending_field_dict = pending_tuple_list.pop(0)
+            if len(pending_tuple_list) < 1:
+                line_to_pending_values.pop(line)
+            if written:
+                get_collector_written_values(collector_name).setdefault(device_key, {}).update(pending_field_dict)
+                written_collector_name_set.add(collector_name)
+    for collector_name in written_collector_name_set:
+        save_written_values(collector_name)
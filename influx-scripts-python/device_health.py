@@ -0,0 +1,179 @@
+import json
+import os
+from threading import Lock
+from time import monotonic, perf_counter, time, time_ns
+
+import fetch_engine
+from collector_stats import record_error, set_duration_stat
+from device_inventory import get_collector_file_name
+from phase_scheduler import get_device_phase_offset_seconds, wait_for_device_phase
+
+# Per-device health tracking, kept on local disk so it carries over between runs. Each device has a circuit breaker
+# that opens after several failures in a row, after which the device is only probed on an exponentially growing
+# schedule rather than costing its full timeout on every cycle. While a device is healthy, its timeout is set from the
+# latencies it has actually responded with, so a device that normally answers in milliseconds is given up on quickly.
+# State is kept in one file per collector, so collectors running as separate processes don't overwrite each other.
+
+# Define where the health files are stored, next to the scripts themselves
+device_health_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "device_health")
+# Define how many failures in a row open a device's circuit breaker
+breaker_failure_threshold = 3
+# Define how long an open breaker waits before the first probe, doubling after each failed probe up to the maximum
+breaker_base_probe_interval_seconds = 60
+breaker_max_probe_interval_seconds = 3600
+# Define how many of each device's most recent latencies are kept for setting its timeout
+latency_sample_count = 50
+# Define how many latencies must be seen before the timeout adapts, and which percentile of them it is set from
+minimum_latency_samples = 5
+timeout_latency_percentile = 0.95
+# Define how far above that percentile the timeout is set, and the least time a request is ever given
+timeout_latency_multiplier = 3
+minimum_timeout_seconds = 0.5
+
+# Map each collector name to its dict of device to health state, loaded from disk on first use
+collector_health_dict = {}
+device_health_lock = Lock()
+
+
+# Raised in place of a fetch for a device whose breaker is open and that isn't yet due to be probed
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+# Get the path of the health file for a collector
+def get_health_file_path(collector_name):
+    return os.path.join(device_health_directory, "{}.json".format(get_collector_file_name(collector_name)))
+
+
+# Get the dict of device to health state for a collector, loading it from disk the first time. Must be called while
+# holding the lock. A missing or unreadable file starts every device off healthy
+def get_collector_health(collector_name):
+    device_state_dict = collector_health_dict.get(collector_name)
+    if device_state_dict is None:
+        try:
+            with open(get_health_file_path(collector_name)) as health_file:
+                device_state_dict = json.load(health_file)
+        except (OSError, ValueError):
+            device_state_dict = {}
+        collector_health_dict[collector_name] = device_state_dict
+    return device_state_dict
+
+
+# Get the health state of one device, creating it as healthy on first sight. Must be called while holding the lock
+def get_device_state(collector_name, device_key):
+    device_state_dict = get_collector_health(collector_name)
+    device_state = device_state_dict.get(device_key)
+    if device_state is None:
+        device_state = device_state_dict[device_key] = {"failures": 0, "next_probe_time": 0, "latencies": []}
+    return device_state
+
+
+# Write a collector's health state to disk, replacing the file atomically so a reader never sees it half-written
+def save_device_health(collector_name):
+    with device_health_lock:
+        health_json = json.dumps(get_collector_health(collector_name))
+    os.makedirs(device_health_directory, exist_ok=True)
+    health_file_path = get_health_file_path(collector_name)
+    temporary_file_path = "{}.{}.tmp".format(health_file_path, os.getpid())
+    with open(temporary_file_path, "w") as health_file:
+        health_file.write(health_json)
+    os.replace(temporary_file_path, health_file_path)
+
+
+# Return True if the device should be fetched from, meaning its breaker is closed or it is due to be probed
+def should_poll_device(collector_name, device_key):
+    with device_health_lock:
+        device_state = get_device_state(collector_name, device_key)
+        return device_state["failures"] < breaker_failure_threshold or device_state["next_probe_time"] <= time()
+
+
+# Get the timeout to fetch from the device with. A device that has just failed, or hasn't been seen enough, gets the
+# full default so a slow response isn't mistaken for a dead device
+def get_device_timeout(collector_name, device_key, default_timeout_seconds):
+    with device_health_lock:
+        device_state = get_device_state(collector_name, device_key)
+        if device_state["failures"] > 0 or len(device_state["latencies"]) < minimum_latency_samples:
+            return default_timeout_seconds
+        sorted_latency_list = sorted(device_state["latencies"])
+    percentile_latency = sorted_latency_list[min(len(sorted_latency_list) - 1,
+                                                 int(len(sorted_latency_list) * timeout_latency_percentile))]
+    return min(default_timeout_seconds, max(minimum_timeout_seconds, percentile_latency * timeout_latency_multiplier))
+
+
+# Record a successful fetch and how long it took, closing the device's breaker
+def record_device_success(collector_name, device_key, latency_seconds):
+    with device_health_lock:
+        device_state = get_device_state(collector_name, device_key)
+        if device_state["failures"] >= breaker_failure_threshold:
+            print("Device {} is responding again, closing its circuit breaker".format(device_key))
+        device_state["failures"] = 0
+        device_state["next_probe_time"] = 0
+        device_state["latencies"] = (device_state["latencies"] + [round(latency_seconds, 4)])[-latency_sample_count:]
+
+
+# Record a failed fetch, opening the device's breaker once it has failed enough times in a row and pushing the next
+# probe further out after each failure beyond that
+def record_device_failure(collector_name, device_key):
+    with device_health_lock:
+        device_state = get_device_state(collector_name, device_key)
+        device_state["failures"] += 1
+        failures_past_threshold = device_state["failures"] - breaker_failure_threshold
+        if failures_past_threshold >= 0:
+            probe_interval_seconds = min(breaker_max_probe_interval_seconds,
+                                         breaker_base_probe_interval_seconds * 2 ** min(failures_past_threshold, 32))
+            device_state["next_probe_time"] = time() + probe_interval_seconds
+            print("Device {} has failed {} time(s) in a row, next probe in {} second(s)".format(
+                device_key, device_state["failures"], probe_interval_seconds))
+
+
+# Given a fetch function taking a device and a timeout, fetch from every device whose breaker allows it, each in its
+# phase slot and with its own adaptive timeout, then record every result and save the collector's health state.
+# Returns a list in the same order as the devices, where each entry is the fetched data or an Exception, with skipped
+# devices as CircuitOpenError, and a list of the time in nanoseconds since Epoch that each device's data was fetched,
+# or None where there was no data. The default timeout is the HTTP timeout setting. High-frequency samples pass
+# record_health=False, so they still skip devices with an open breaker and use the adaptive timeouts, but neither count
+# towards opening breakers nor rewrite the health file every few seconds
+def fetch_all_with_device_health(collector_name, fetch_function, device_key_list, default_timeout_seconds=None,
+                                 record_health=True):
+    if default_timeout_seconds is None:
+        default_timeout_seconds = fetch_engine.http_timeout_seconds
+    cycle_start_time = monotonic()
+
+    # Time each fetch inside its worker, so the latency doesn't include waiting for a free worker or for its slot
+    def fetch_with_timing(device_key):
+        if not should_poll_device(collector_name, device_key):
+            raise CircuitOpenError("Circuit breaker for {} is open, skipping until its next probe".format(device_key))
+        wait_for_device_phase(collector_name, device_key, cycle_start_time)
+        start_time = perf_counter()
+        data = fetch_function(device_key, get_device_timeout(collector_name, device_key, default_timeout_seconds))
+        return perf_counter() - start_time, time_ns(), data
+
+    # Hand devices to the workers in the order of their slots, so no worker sits waiting on a later slot while an
+    # earlier one is due
+    phase_ordered_key_list = sorted(device_key_list,
+                                    key=lambda device_key: get_device_phase_offset_seconds(collector_name, device_key))
+    key_to_fetched_dict = dict(zip(phase_ordered_key_list,
+                                   fetch_engine.fetch_all_concurrently(fetch_with_timing, phase_ordered_key_list)))
+    result_list = []
+    fetch_time_list = []
+    if not record_health:
+        for device_key in device_key_list:
+            result = key_to_fetched_dict[device_key]
+            result_list.append(result if isinstance(result, Exception) else result[2])
+            fetch_time_list.append(None if isinstance(result, Exception) else result[1])
+        return result_list, fetch_time_list
+    for device_key in device_key_list:
+        result = key_to_fetched_dict[device_key]
+        if isinstance(result, Exception):
+            record_error(collector_name, device_key, result)
+            if not isinstance(result, CircuitOpenError):
+                record_device_failure(collector_name, device_key)
+            result_list.append(result)
+            fetch_time_list.append(None)
+        else:
+            record_device_success(collector_name, device_key, result[0])
+            set_duration_stat(collector_name, device_key, "fetchMilliseconds", result[0])
+            result_list.append(result[2])
+            fetch_time_list.append(result[1])
+    save_device_health(collector_name)
+    return result_list, fetch_time_list
@@ -0,0 +1,147 @@
+import json
+import os
+from bisect import bisect_left
+
+from phase_scheduler import get_phase_fraction
+
+# The inventory of devices every collector polls, kept in one JSON file rather than in each collector's source. Each
+# collector has a list of devices, each with the address to fetch from and the name stored in InfluxDB, so if an
+# address changes the data keeps going to the same name. An optional note describes the device. The file is loaded and
+# validated once per process, and a mistake in it stops the collectors rather than silently dropping devices.
+#
+# Devices can be split across several collector hosts, and across several worker processes on each host, so polling
+# keeps up as the fleet grows past what one interpreter can poll in an interval. Each device is placed on a hash ring
+# by its collector and name, so every host agrees on who polls what without talking to each other, and adding a device
+# or a host only moves the devices that land on the new one.
+
+# Define where the inventory file is stored, next to the scripts themselves
+device_inventory_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "device_inventory.json")
+# Define how many hosts share the inventory, which every host must agree on, and which of them this is, counting from 0
+collector_host_count = 1
+collector_host_index = 0
+# Define how many worker processes the resident collector splits this host's devices across
+worker_process_count = 1
+# Define the environment variable telling a worker process which worker it is, counting from 0. A process started
+# without it, such as from cron, polls every device assigned to this host
+worker_index_environment_variable = "COLLECTOR_WORKER_INDEX"
+# Define how many points each host or worker gets on the hash ring. More points spread devices more evenly
+hash_ring_virtual_node_count = 100
+
+# Define the keys each device entry may have, and which of them are required
+required_device_keys = ("address", "name")
+optional_device_keys = ("note",)
+
+# Map each collector name to its list of (address, name) Tuples, loaded from the file on first use
+collector_device_dict = None
+# Map each (ring name, node count) to its sorted list of (position, node) Tuples, built on first use
+hash_ring_dict = {}
+
+
+# Check the loaded inventory is a dict of collector name to a list of devices, each with a unique address and name,
+# raising ValueError on the first problem found. Returns the dict of collector name to list of (address, name) Tuples
+def validate_device_inventory(inventory_dict):
+    if not isinstance(inventory_dict, dict):
+        raise ValueError("Inventory must be an object of collector name to list of devices")
+    validated_dict = {}
+    for collector_name, device_list in inventory_dict.items():
+        if not isinstance(device_list, list):
+            raise ValueError("Inventory for collector {} must be a list of devices".format(collector_name))
+        address_set = set()
+        name_set = set()
+        validated_dict[collector_name] = []
+        for position, device_entry in enumerate(device_list):
+            if not isinstance(device_entry, dict):
+                raise ValueError("Device {} of collector {} must be an object".format(position, collector_name))
+            unknown_key_list = [key for key in device_entry
+                                if key not in required_device_keys and key not in optional_device_keys]
+            if len(unknown_key_list) > 0:
+                raise ValueError("Device {} of collector {} has unknown key(s) {}".format(position, collector_name,
+                                                                                         unknown_key_list))
+            for key in required_device_keys:
+                value = device_entry.get(key)
+                if not isinstance(value, str) or len(value.strip()) < 1:
+                    raise ValueError("Device {} of collector {} needs a non-empty string {}".format(position,
+                                                                                                   collector_name, key))
+            address = device_entry["address"]
+            name = device_entry["name"]
+            if address in address_set:
+                raise ValueError("Address {} is listed twice for collector {}".format(address, collector_name))
+            if name in name_set:
+                raise ValueError("Name {} is listed twice for collector {}".format(name, collector_name))
+            address_set.add(address)
+            name_set.add(name)
+            validated_dict[collector_name].append((address, name))
+    return validated_dict
+
+
+# Get the dict of collector name to list of (address, name) Tuples, loading and validating the file the first time
+def load_device_inventory():
+    global collector_device_dict
+    if collector_device_dict is None:
+        with open(device_inventory_path) as inventory_file:
+            inventory_dict = json.load(inventory_file)
+        try:
+            collector_device_dict = validate_device_inventory(inventory_dict)
+        except ValueError as validation_error:
+            raise ValueError("Invalid inventory {}: {}".format(device_inventory_path, validation_error))
+    return collector_device_dict
+
+
+# Get this process's worker index from the environment, or None if it wasn't started as one of several workers
+def get_worker_index():
+    worker_index_string = os.environ.get(worker_index_environment_variable)
+    if worker_index_string is None or worker_process_count < 2:
+        return None
+    worker_index = int(worker_index_string)
+    if not 0 <= worker_index < worker_process_count:
+        raise ValueError("Worker index {} is outside the {} worker process(es)".format(worker_index,
+                                                                                      worker_process_count))
+    return worker_index
+
+
+# Get the hash ring for a number of nodes, with each node placed at many points around it. The ring name keeps the
+# host ring and the worker ring independent, so which worker polls a device doesn't depend on which host it is on
+def get_hash_ring(ring_name, node_count):
+    hash_ring = hash_ring_dict.get((ring_name, node_count))
+    if hash_ring is None:
+        hash_ring = sorted((get_phase_fraction("{}/{}/{}".format(ring_name, node, virtual_node)), node)
+                           for node in range(node_count) for virtual_node in range(hash_ring_virtual_node_count))
+        hash_ring_dict[(ring_name, node_count)] = hash_ring
+    return hash_ring
+
+
+# Get the node a key lands on, which is the first point on the ring at or after the key's own position
+def get_ring_node(ring_name, node_count, key):
+    if node_count < 2:
+        return 0
+    hash_ring = get_hash_ring(ring_name, node_count)
+    ring_position = bisect_left(hash_ring, (get_phase_fraction(key), -1))
+    return hash_ring[ring_position % len(hash_ring)][1]
+
+
+# Return True if this process polls the device, which is keyed on its name so it stays put when its address changes
+def is_device_assigned(collector_name, device_name):
+    device_key = "{}/{}".format(collector_name, device_name)
+    if not 0 <= collector_host_index < collector_host_count:
+        raise ValueError("Host index {} is outside the {} collector host(s)".format(collector_host_index,
+                                                                                   collector_host_count))
+    if get_ring_node("host", collector_host_count, device_key) != collector_host_index:
+        return False
+    worker_index = get_worker_index()
+    return worker_index is None or get_ring_node("worker", worker_process_count, device_key) == worker_index
+
+
+# Get the list of (address, name) Tuples of a collector's devices that this process polls, in inventory order. A
+# collector missing from the inventory has no devices
+def get_assigned_devices(collector_name):
+    return [(address, name) for address, name in load_device_inventory().get(collector_name, [])
+            if is_device_assigned(collector_name, name)]
+
+
+# Get the name that files kept per collector are stored under, such as device health, which has the worker index added
+# when running as one of several workers so workers don't overwrite each other's files
+def get_collector_file_name(collector_name):
+    worker_index = get_worker_index()
+    if worker_index is None:
+        return collector_name
+    return "{}-worker{}".format(collector_name, worker_index)
@@ -1,19 +1,21 @@
 from math import log
-from random import randint
-from time import time, sleep
+from time import perf_counter
 
-from requests import get, RequestException
+from collector_stats import increment_stat, record_error, set_duration_stat
+from deadband_filter import filter_unchanged_fields, hold_values_until_written
+from device_health import fetch_all_with_device_health
+from device_inventory import get_assigned_devices
+from fetch_engine import fetch_url_text
+from influx_writer import close_influx_writer, get_precision_timestamp, send_data_to_influx
+from latest_value_cache import record_latest_values
+from line_protocol import build_series_prefix, encode_point
+from phase_scheduler import wait_for_collector_phase
+from response_recorder import record_response, save_recorded_responses
+from window_aggregator import add_field_samples, drain_window_aggregates
 
-from influx_writer import send_data_to_influx
-
-# These Tuples define the IP address from which to fetch data and the host string stored in InfluxDB for each.
-# This way, if the IP address changes, an update can be made to keep the data going to the same tag in Influx
-ip_addresses_to_influx_hosts = [("10.1.1.31", "nodemcu3"),  # office esp32 Feather BME280 PMS7003 SGP30
-                                ("10.1.1.37", "nodemcu1"),  # bed amica2 DHT22 BME280
-                                ("10.1.1.36", "nodemcu2"),  # bathroom amica1 DHT22 BME280
-                                ("10.1.1.34", "nodemcu4"),  # couch geek1 SCD40 SGP30 (adafruit) BME280
-                                ("10.1.1.40", "nodemcu5"),  # bedbath esp32 feiyang1 SGP30 BME280
-                                ("10.1.1.35", "nodemcu6")]  # outside geek2 SGP30 BME280 VEML6075
+# These Tuples define the IP address from which to fetch data and the host string stored in InfluxDB for each, taken
+# from the "esp" devices in the inventory that this process polls
+ip_addresses_to_influx_hosts = get_assigned_devices("esp")
 
 # These Tuples define the names of the fields in InfluxDB, and the ESP-reported field names they are derived from.
 # In special cases such as dew point, multiple inputs are needed, and are defined with a nested Tuple in this case
@@ -44,155 +46,251 @@ influx_fields_to_http_fields = [("humidity", "dhtHumidityPercent"),
                                 ("tvoc", "sgpTVOC"),
                                 ("eco2", "sgpECO2"),
                                 ("co2", "scdCO2")]
+# This Dict defines the optional deadband of Influx fields, as described in deadband_filter.py
+influx_field_deadbands = {"humidity": (0.5, None),
+                          "temperaturec": (0.1, None),
+                          "temperaturef": (0.2, None),
+                          "dewpointf": (0.2, None),
+                          "pressurehg": (0.01, None)}
+# These Influx fields are also sampled between writes when the resident collector has high-frequency sampling on, and
+# are written with their minimum, maximum, and mean over each window as extra fields such as `pm250Max`
+influx_fields_to_aggregate = ["pm250", "co2"]
+
+
+# Given an IP address, fetch its HTTP response, optionally with a timeout other than the default
+def fetch_data(ip_address, timeout=None):
+    # Form the URL and fetch it over the shared keep-alive Session, which limits the HTTP GET before timing out
+    return fetch_url_text("http://" + ip_address, timeout)
+
+
+# Given a single ESP field value, determine whether it is one of the values sensors report when they have no reading
+def is_bad_value(esp_value):
+    known_bad_value_float = -16384
+    known_bad_value_string = "nan"
+    return (esp_value == known_bad_value_string) or (float(esp_value) == known_bad_value_float)
+
+
+# Conversions from the raw ESP value(s) to the float stored in Influx. Values are stored as floats, which is the type
+# every ESP field has always had in Influx, and converted values are rounded to two places, as they always have been.
+# Rounding a float to two places gives exactly the value of parsing it back from "{:.2f}"
+def convert_raw_value(esp_value):
+    return float(esp_value)
 
 
 # Convert temperature from degrees Celsius to degrees Fahrenheit
-def convert_celsius_to_fahrenheit(temp_c):
-    return "{:.2f}".format(float(temp_c) * 1.8 + 32)
+def convert_raw_temperature_to_fahrenheit(temp_c):
+    return round(float(temp_c) * 1.8 + 32, 2)
 
 
 # Convert barometric pressure in Pascals to inches of Mercury
 # https://www.metric-conversions.org/pressure/pascals-to-inches-of-mercury.htm
-def convert_pascals_to_inches_mercury(pressure_pa):
-    return "{:.2f}".format(float(pressure_pa) * 0.00029530)
+def convert_raw_pressure_to_inches_mercury(pressure_pa):
+    return round(float(pressure_pa) * 0.00029530, 2)
 
 
-# Given the temperature in Celsius and relative humidity in percent, determine the dewpoint
-# of the current moisture level in the air in Celsius
+# Given the temperature in Celsius and relative humidity in percent, determine the dewpoint of the current moisture
+# level in the air in Fahrenheit
 # https://forum.arduino.cc/t/dew-point-using-dht22-sensor/485107/7 (cites "Application of a Dew Point Method to
 # Obtain the Soil Water Characteristic," 2007, https://link.springer.com/chapter/10.1007/3-540-69873-6_7)
 # https://iridl.ldeo.columbia.edu/dochelp/QA/Basic/dewpoint.html
 # https://unidata.github.io/MetPy/latest/api/generated/metpy.calc.dewpoint.html
 # https://sites.google.com/site/alessandropensato/arduino/simple-dew-point-controller
-def convert_relative_humidity_temperature_to_dewpoint(temp_c, humidity_percent):
-    gamma = log(float(humidity_percent) / 100.0) + ((17.62 * float(temp_c)) / (243.5 + float(temp_c)))
-    dewpoint_c = 243.5 * gamma / (17.62 - gamma)
-    return "{:.2f}".format(dewpoint_c)
-
+def convert_raw_temperature_humidity_to_dewpoint_fahrenheit(temp_c, humidity_percent):
+    temp_c = float(temp_c)
+    gamma = log(float(humidity_percent) / 100.0) + ((17.62 * temp_c) / (243.5 + temp_c))
+    # The dewpoint is rounded in Celsius before converting, as it always has been
+    return round(round(243.5 * gamma / (17.62 - gamma), 2) * 1.8 + 32, 2)
 
-# Given an IP address, fetch its HTTP response
-def fetch_data(ip_address):
-    # Form the URL and limit the HTTP GET to 5 seconds before timing out
-    response = get("http://" + ip_address, timeout=5)
-    return response.text
 
+# This Dict defines the Influx fields that need a conversion. All others store the raw ESP value
+influx_field_to_converter = {"dewpointf": convert_raw_temperature_humidity_to_dewpoint_fahrenheit,
+                             "temperaturef": convert_raw_temperature_to_fahrenheit,
+                             "pressurehg": convert_raw_pressure_to_inches_mercury}
 
-# Given an ESP's response as a list of lines, validate that its schema line and data line are the only lines,
-# and that the number of fields is equal in both
-def validate_data(line_list):
-    line_list_count = len(line_list)
-    if line_list_count != 2:
-        raise Exception("Expected ESP response was 2 lines, actual was {}".format(line_list_count))
-    schema_field_count = len(line_list[0].split(","))
-    data_field_count = len(line_list[1].split(","))
-    if schema_field_count != data_field_count:
-        raise Exception("Expected ESP response schema field count to match data field count. Schema count was {} and "
-                        "field count was {}".format(schema_field_count, data_field_count))
+# Compiled field mapping plans, keyed by the schema line they were compiled from. Boards of the same build share a
+# schema line, so only a handful of plans ever exist. Cleared if it grows past the limit, in case of garbled schemas
+field_mapping_plan_cache = {}
+field_mapping_plan_cache_limit = 256
 
 
-# Given an ESP's response as a list of lines, add each field name/value pair to a dictionary
-# Super cool shorthand https://www.geeksforgeeks.org/python-convert-two-lists-into-a-dictionary/
-def parse_data_into_dict(line_list):
-    esp_dict = {line_list[0].split(",")[i]: line_list[1].split(",")[i] for i in range(len(line_list[0].split(",")))}
-    return esp_dict
+# Given an ESP's schema line, compile influx_fields_to_http_fields into a plan for reading its data line directly.
+# The plan is a Tuple of the schema's field count and, for each Influx field the board can provide, a Tuple of
+# (Influx field name, candidates), where the candidates are (column index Tuple, converter) in order of preference.
+# Since later-listed mappings are preferred, the candidates are the board's available mappings in reverse order
+def compile_field_mapping_plan(schema_line):
+    schema_field_list = schema_line.split(",")
+    # Where a schema repeats a name, the last column wins, the same as when building a dict from the response
+    schema_field_to_index = {schema_field: index for index, schema_field in enumerate(schema_field_list)}
+    influx_field_to_candidates = {}
+    for influx_field_name, http_field in influx_fields_to_http_fields:
+        http_field_tuple = http_field if isinstance(http_field, tuple) else (http_field,)
+        # Leave out mappings whose ESP fields this board doesn't report at all
+        if not all(esp_field in schema_field_to_index for esp_field in http_field_tuple):
+            continue
+        index_tuple = tuple(schema_field_to_index[esp_field] for esp_field in http_field_tuple)
+        converter = influx_field_to_converter.get(influx_field_name, convert_raw_value)
+        influx_field_to_candidates.setdefault(influx_field_name, []).insert(0, (index_tuple, converter))
+    return len(schema_field_list), tuple((influx_field_name, tuple(candidate_list))
+                                         for influx_field_name, candidate_list in influx_field_to_candidates.items())
 
 
-# Given a dict of ESP field name field value pairs, remove the input dict's entries with known bad values in place
-def filter_bad_values_from_dict(esp_dict):
-    known_bad_value_float = -16384
-    known_bad_value_string = "nan"
-    for key in list(esp_dict):
-        if (esp_dict[key] == known_bad_value_string) or (float(esp_dict[key]) == known_bad_value_float):
-            esp_dict.pop(key)
+# Get the compiled plan for an ESP's schema line, compiling and caching it the first time the schema is seen
+def get_field_mapping_plan(schema_line):
+    field_mapping_plan = field_mapping_plan_cache.get(schema_line)
+    if field_mapping_plan is None:
+        if len(field_mapping_plan_cache) >= field_mapping_plan_cache_limit:
+            field_mapping_plan_cache.clear()
+        field_mapping_plan = field_mapping_plan_cache[schema_line] = compile_field_mapping_plan(schema_line)
+    return field_mapping_plan
 
 
-# Given a dict of valid ESP data, perform necessary conversions if any and store the output value in a dict
-# under its Influx field name
-def parse_esp_dict_into_influx_dict(esp_dict):
+# Given a compiled plan and the values of an ESP's data line, store the most preferred value that isn't a known bad
+# value for each Influx field, converted as needed, in a dict under its Influx field name. Each field with no usable
+# value is printed unless told not to
+def apply_field_mapping_plan(field_mapping_plan, data_field_list, print_missing_fields=True):
     influx_dict = {}
-    # Go through all the pre-defined mappings of Influx field name to ESP field name
-    for influx_http_tuple in influx_fields_to_http_fields:
-        # Get the Influx field name from the tuple, which is used to handle different cases
-        influx_field_name = influx_http_tuple[0]
-        # Using the new Python 3.10 switch syntax to handle special cases where conversion is needed
-        # https://www.blog.pythonlibrary.org/2021/09/16/case-switch-comes-to-python-in-3-10/
-        # Wrap in try except to catch instances where the necessary data doesn't exist. Skip the Tuple in that case
-        try:
-            match influx_field_name:
-                case "dewpointf":
-                    # Use esp_dict[key] rather than esp_dict.get(key) so a KeyError is raised
-                    dewpoint_c = convert_relative_humidity_temperature_to_dewpoint(esp_dict[influx_http_tuple[1][0]],
-                                                                                   esp_dict[influx_http_tuple[1][1]])
-                    data_value = convert_celsius_to_fahrenheit(dewpoint_c)
-                case "temperaturef":
-                    data_value = convert_celsius_to_fahrenheit(esp_dict[influx_http_tuple[1]])
-                case "pressurehg":
-                    data_value = convert_pascals_to_inches_mercury(esp_dict[influx_http_tuple[1]])
-                case _:
-                    # Default case, the raw data from ESP can be saved directly to Influx
-                    data_value = esp_dict[influx_http_tuple[1]]
-            print("Found value of [{}] for Influx field [{}]".format(data_value, influx_field_name))
-            # Since a dict is used, only one value for each field name can exist. For that reason, the later
-            # values as defined in the field name Tuples will overwrite earlier fields. This allows us to define
-            # fallback, or less preferred values by processing them first. DHT and then Bosch, for example.
-            influx_dict[influx_field_name] = data_value
-        except KeyError:
-            print("Corresponding data value not found when trying to fetch Influx value {}".format(influx_field_name))
+    for influx_field_name, candidate_tuple in field_mapping_plan[1]:
+        for index_tuple, converter in candidate_tuple:
+            esp_value_list = [data_field_list[index] for index in index_tuple]
+            if any(is_bad_value(esp_value) for esp_value in esp_value_list):
+                continue
+            influx_dict[influx_field_name] = converter(*esp_value_list)
+            break
+        else:
+            if print_missing_fields:
+                print("Corresponding data value not found when trying to fetch Influx value {}".format(
+                    influx_field_name))
     return influx_dict
 
 
-# Convert the dict to a string in Line Protocol, which is `field=value,field2=value2,field3=value3` for the data section
-def parse_influx_dict_into_line_protocol(influx_dict):
-    line_protocol_list = []
-    for key in influx_dict:
-        line_protocol_list.append("{}={}".format(key, influx_dict[key]))
-    return ",".join(line_protocol_list)
+# Given an ESP's response as a list of lines, validate that its schema line and data line are the only lines, and that
+# the number of fields is equal in both, then convert it into a dict keyed on the field name in Influx using the
+# compiled plan for its schema line
+def parse_lines_into_influx_dict(line_list, print_missing_fields=True):
+    line_list_count = len(line_list)
+    if line_list_count != 2:
+        raise Exception("Expected ESP response was 2 lines, actual was {}".format(line_list_count))
+    field_mapping_plan = get_field_mapping_plan(line_list[0])
+    data_field_list = line_list[1].split(",")
+    if field_mapping_plan[0] != len(data_field_list):
+        raise Exception("Expected ESP response schema field count to match data field count. Schema count was {} and "
+                        "field count was {}".format(field_mapping_plan[0], len(data_field_list)))
+    return apply_field_mapping_plan(field_mapping_plan, data_field_list, print_missing_fields)
 
 
-# Top-level ESP data-gathering function to orchestrate all the other calls in this file
-# TODO move this to an esp-specific python file so main can be log setup and switching between different updates
-# TODO maybe make this return the list of line protocol, and then all can be merged together for writing to Influx
-def collect_and_write_esp_sensor_readings():
+# Given an ESP's response as fetched, convert it into a dict keyed on the field name in Influx, printing each field with
+# no usable value unless told not to
+def parse_response_into_influx_dict(fetched_data, print_missing_fields=True):
+    # Remove any whitespace from the data, as it should be CSV, and split it into separate lines
+    return parse_lines_into_influx_dict(str.splitlines(fetched_data.replace(" ", "")), print_missing_fields)
+
+
+# Given a list of every ESP's response as fetched, convert each into a dict keyed on the field name in Influx. When
+# given the IP each response came from, records how long each took to parse. Returns the list of dicts in the same
+# order, with an Exception in place of each response that was an Exception or couldn't be parsed
+def parse_responses_into_influx_dicts(fetched_data_list, current_ip_list=None):
+    influx_dict_list = []
+    for index, fetched_data in enumerate(fetched_data_list):
+        if isinstance(fetched_data, Exception):
+            influx_dict_list.append(fetched_data)
+            continue
+        parse_start_time = perf_counter()
+        try:
+            influx_dict_list.append(parse_response_into_influx_dict(fetched_data))
+        except Exception as parse_error:
+            influx_dict_list.append(parse_error)
+        if current_ip_list is not None:
+            set_duration_stat("esp", current_ip_list[index], "parseMilliseconds", perf_counter() - parse_start_time)
+    return influx_dict_list
+
+
+# Top-level ESP data-gathering function to orchestrate all the other calls in this file, returning the Line Protocol
+# for every ESP without writing it
+def collect_esp_sensor_readings():
     # Instantiate a list to store lines of Line Protocol to write to Influx
     line_protocol_string_list = []
-    # Get the current time since Epoch in seconds, which is used when writing lines to Influx
-    epoch_time_seconds = int(time())
-    # Iterate through each tuple of IP and Influx host name
-    for ip_to_host_tuple in ip_addresses_to_influx_hosts:
+    # Fetch from every IP at once, so the cycle only takes as long as the slowest device, skipping any IP whose circuit
+    # breaker is open and giving the others a timeout based on how quickly they usually respond. Each device starts in
+    # its own phase slot, and the time its response arrived is kept as the time of its record
+    fetched_data_list, fetch_time_list = fetch_all_with_device_health("esp", fetch_data,
+                                                                      [current_ip for current_ip, _ in
+                                                                       ip_addresses_to_influx_hosts])
+    # Validate the data, then run conversions and create a dict keyed on the field name in Influx, rather than the
+    # ESP name, skipping values that don't meet the criteria needed for saving to Influx, timing each device's parse
+    influx_dict_list = parse_responses_into_influx_dicts(fetched_data_list,
+                                                         [current_ip for current_ip, _ in ip_addresses_to_influx_hosts])
+    # Iterate through each tuple of IP and Influx host name alongside the data fetched from it
+    for ip_to_host_tuple, fetched_data, influx_dict, fetch_time in zip(ip_addresses_to_influx_hosts, fetched_data_list,
+                                                                       influx_dict_list, fetch_time_list):
         current_ip = ip_to_host_tuple[0]
         influx_host_name = ip_to_host_tuple[1]
         print("\n\nChecking IP {} with Influx Host Name {}\n".format(current_ip, influx_host_name))
-        try:
-            # Get the data from the current IP, removing any whitespace as it should be CSV
-            data = fetch_data(current_ip).replace(" ", "")
-        except RequestException:
+        if isinstance(fetched_data, Exception):
             # Don't exit on an Exception when getting data, rather skipping the current IP
-            print("Could not connect/fetch from IP {}, skipping".format(current_ip))
+            print("Could not connect/fetch from IP {}, skipping. Error was {}".format(current_ip, fetched_data))
+            continue
+        record_response("esp", current_ip, fetched_data, fetch_time)
+        if isinstance(influx_dict, Exception):
+            # Don't exit on malformed data from one device, rather skipping the current IP
+            print("Could not parse data from IP {}, skipping. Error was {}".format(current_ip, influx_dict))
+            record_error("esp", current_ip, influx_dict)
+            continue
+        print("Found values {}".format(influx_dict))
+        record_latest_values("environment", influx_host_name, influx_dict, fetch_time)
+        # Add the aggregates of any samples taken since the last write
+        influx_dict.update(drain_window_aggregates("esp", influx_host_name, influx_dict, influx_fields_to_aggregate))
+        # Drop the fields that haven't changed beyond their deadband, skipping this IP if that leaves none
+        if len(influx_dict) > 0:
+            influx_dict = filter_unchanged_fields("esp", influx_host_name, influx_dict, influx_field_deadbands)
+            if len(influx_dict) < 1:
+                print("No field from IP {} changed beyond its deadband, skipping submission".format(current_ip))
+                continue
+        # Encode the Line Protocol, forming together the measurement, tags, field set, and time
+        line_protocol_full_string = encode_point(build_series_prefix("environment", (("host", influx_host_name),)),
+                                                 influx_dict, get_precision_timestamp(fetch_time))
+        # Count the filtered values as written only once InfluxDB has this line
+        hold_values_until_written("esp", influx_host_name, line_protocol_full_string)
+        # Skip this IP if none of its fields could be written, since a line without fields is invalid
+        if line_protocol_full_string is None:
+            print("No valid data was found for IP {}, skipping submission of this IP".format(current_ip))
             continue
-        # Split the ESP data into separate lines
-        line_list = str.splitlines(data)
-        # Validate that the data is in a parseable format
-        validate_data(line_list)
-        # Convert the CSV data into a dict, with the field name as key and the field value as value
-        esp_dict = parse_data_into_dict(line_list)
-        # Remove key/value pairs from the dict when the value doesn't meet the criteria needed for saving to Influx
-        filter_bad_values_from_dict(esp_dict)
-        # Run conversions and create a new dict keyed on the field name in Influx, rather than the ESP name
-        influx_dict = parse_esp_dict_into_influx_dict(esp_dict)
-        # Convert the Influx field name dict into a Line Protocol string, but just the data at this point
-        line_protocol_data_string = parse_influx_dict_into_line_protocol(influx_dict)
-        # Format the rest of the Line Protocol, forming together the measurement, tags, field set, and time
-        line_protocol_full_string = "environment,host={} {} {}".format(influx_host_name, line_protocol_data_string,
-                                                                       epoch_time_seconds)
         # Add the completed Line Protocol to the list of Line Protocol to write to Influx
         line_protocol_string_list.append(line_protocol_full_string)
+        increment_stat("esp", current_ip, "points")
+    save_recorded_responses("esp")
+    return line_protocol_string_list
+
+
+# Take one high-frequency sample from every ESP, folding the aggregated fields into the current window without writing
+# anything
+def sample_esp_sensor_readings():
+    fetched_data_list, fetch_time_list = fetch_all_with_device_health("esp", fetch_data,
+                                                                      [current_ip for current_ip, _ in
+                                                                       ip_addresses_to_influx_hosts],
+                                                                      record_health=False)
+    for (_, influx_host_name), fetched_data, influx_dict, fetch_time in zip(
+            ip_addresses_to_influx_hosts, fetched_data_list, parse_responses_into_influx_dicts(fetched_data_list),
+            fetch_time_list):
+        # Devices that couldn't be reached or returned malformed data are just missing from this sample
+        if isinstance(fetched_data, Exception):
+            continue
+        if isinstance(influx_dict, Exception):
+            print("Could not parse sample from {}, skipping: {}".format(influx_host_name, influx_dict))
+            continue
+        record_latest_values("environment", influx_host_name, influx_dict, fetch_time)
+        add_field_samples("esp", influx_host_name, influx_dict, influx_fields_to_aggregate)
+
+
+# Collect the ESP data and write it to Influx on its own
+def collect_and_write_esp_sensor_readings():
+    line_protocol_string_list = collect_esp_sensor_readings()
     print("Writing data from {} ESP devices into InfluxDB".format(len(line_protocol_string_list)))
     send_data_to_influx(line_protocol_string_list)
     print("Completed writing ESP data to Influx!")
 
 
 if __name__ == '__main__':
-    wait_seconds = randint(0, 10)
-    print("Adding {} second(s) of jitter before executing".format(wait_seconds))
-    sleep(wait_seconds)
+    wait_for_collector_phase("esp")
     collect_and_write_esp_sensor_readings()
+    # Write anything still batched before the process exits
+    close_influx_writer()
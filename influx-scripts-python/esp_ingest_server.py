@@ -0,0 +1,215 @@
+import asyncio
+from threading import Thread
+from time import time_ns
+from urllib.parse import parse_qs, urlparse
+
+from collector_stats import increment_stat, record_error
+from device_inventory import load_device_inventory
+from esp import parse_response_into_influx_dict
+from influx_writer import close_influx_writer, get_precision_timestamp, send_data_to_influx
+from latest_value_cache import record_latest_values
+from line_protocol import build_series_prefix, encode_point
+from response_recorder import record_response, save_recorded_responses
+
+# Push-based ingest for ESP boards, as an alternative to polling them, so boards only need to reach the collector
+# rather than the other way around. Boards POST the same two-line CSV they serve when polled to `/esp`, which is
+# validated, filtered, and mapped to Influx fields by the same code as esp.py, and each accepted report becomes one
+# `environment` point stamped with the time it arrived. A board is known by its address in the inventory, or by its
+# Influx host name given as `?host=nodemcu1`, which must also be in the inventory.
+#
+# Accepted points go on a bounded queue that a single writer drains into the write batch. When Influx falls behind
+# and the queue fills, new reports wait briefly for room and are then turned away with 503 and Retry-After, so the
+# boards back off rather than the collector's memory growing without bound.
+# Run on its own with `pipenv run python3 esp_ingest_server.py`, or alongside the polls in collector_daemon.py
+
+# Define the address and port to accept reports on
+ingest_listen_host = "0.0.0.0"
+ingest_listen_port = 8096
+# Define the most points held waiting to be written, and how long a report waits for room before it is turned away
+ingest_queue_size = 10000
+ingest_queue_wait_seconds = 1
+# Define how many seconds a board that was turned away is asked to wait before reporting again, which HTTP only allows
+# as a whole number
+ingest_retry_after_seconds = 1
+# Define the most points handed to the writer at once, and how long the writer waits to gather more before writing
+ingest_write_batch_size = 5000
+ingest_flush_interval_seconds = 0.5
+# Define the largest request body accepted, well above the size of any board's report
+ingest_max_body_bytes = 16 * 1024
+# Define how long an idle keep-alive connection is held open
+ingest_idle_timeout_seconds = 30
+
+# Map each address and Influx host name boards may report as to the board's (inventory address, Influx host name),
+# built when starting
+reporter_to_influx_host_dict = {}
+# Map each HTTP status code sent to its reason phrase
+status_code_to_reason = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                         411: "Length Required", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+# Build the map of reporter to Influx host name from every ESP in the inventory, not only those this process polls
+def build_reporter_to_influx_host_dict():
+    reporter_to_influx_host_dict.clear()
+    for address, influx_host_name in load_device_inventory().get("esp", []):
+        reporter_to_influx_host_dict[address] = (address, influx_host_name)
+        reporter_to_influx_host_dict[influx_host_name] = (address, influx_host_name)
+
+
+# Write an HTTP response with a short text body, optionally closing the connection afterwards
+def write_response(writer, status_code, body_text="", extra_header_text="", close_connection=False):
+    body_bytes = body_text.encode("utf-8")
+    writer.write("HTTP/1.1 {} {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\n{}{}\r\n".format(
+        status_code, status_code_to_reason[status_code], len(body_bytes), extra_header_text,
+        "Connection: close\r\n" if close_connection else "").encode("ascii") + body_bytes)
+
+
+# Given one report, convert it to a point and queue it for writing, returning the HTTP status code and body to answer
+# with. Waits for room on the queue for a short time when it is full
+async def accept_report(point_queue, address, influx_host_name, body_bytes):
+    fetched_data = body_bytes.decode("utf-8", "replace")
+    fetch_time = time_ns()
+    try:
+        # Parsing runs on the event loop, so it must not write a line to stdout for each field a board doesn't have
+        influx_dict = parse_response_into_influx_dict(fetched_data, print_missing_fields=False)
+    except Exception as parse_error:
+        record_error("esp", address, parse_error)
+        return 400, "{}\n".format(parse_error)
+    record_response("esp", address, fetched_data, fetch_time)
+    record_latest_values("environment", influx_host_name, influx_dict, fetch_time)
+    line_protocol_full_string = encode_point(build_series_prefix("environment", (("host", influx_host_name),)),
+                                             influx_dict, get_precision_timestamp(fetch_time))
+    if line_protocol_full_string is None:
+        return 400, "No valid data was found\n"
+    try:
+        await asyncio.wait_for(point_queue.put((address, line_protocol_full_string)),
+                               ingest_queue_wait_seconds)
+    except asyncio.TimeoutError:
+        increment_stat("esp", None, "ingestRejected")
+        return 503, "Ingest queue is full, retry later\n"
+    return 204, ""
+
+
+# Serve one connection, answering each request on it in turn until the client closes it or goes idle
+async def handle_connection(point_queue, reader, writer):
+    peer_address = writer.get_extra_info("peername")[0]
+    try:
+        while True:
+            try:
+                header_bytes = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), ingest_idle_timeout_seconds)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+            header_line_list = header_bytes.decode("latin-1").split("\r\n")
+            request_part_list = header_line_list[0].split(" ")
+            header_dict = {}
+            for header_line in header_line_list[1:]:
+                if ":" in header_line:
+                    header_name, header_value = header_line.split(":", 1)
+                    header_dict[header_name.strip().lower()] = header_value.strip()
+            close_connection = header_dict.get("connection", "").lower() == "close"
+            if len(request_part_list) != 3:
+                write_response(writer, 400, "Malformed request line\n", close_connection=True)
+                return
+            method, target, _ = request_part_list
+            content_length_string = header_dict.get("content-length")
+            if content_length_string is None or not content_length_string.isdigit():
+                write_response(writer, 411, "Content-Length is required\n", close_connection=True)
+                return
+            content_length = int(content_length_string)
+            if content_length > ingest_max_body_bytes:
+                write_response(writer, 413, "Reports are limited to {} bytes\n".format(ingest_max_body_bytes),
+                               close_connection=True)
+                return
+            try:
+                body_bytes = await asyncio.wait_for(reader.readexactly(content_length), ingest_idle_timeout_seconds)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                return
+            parsed_url = urlparse(target)
+            if parsed_url.path != "/esp":
+                write_response(writer, 404, "Reports are accepted at /esp\n", close_connection=close_connection)
+            elif method != "POST":
+                write_response(writer, 405, "Reports must be POSTed\n", "Allow: POST\r\n", close_connection)
+            else:
+                reporter = parse_qs(parsed_url.query).get("host", [peer_address])[0]
+                board_tuple = reporter_to_influx_host_dict.get(reporter)
+                if board_tuple is None:
+                    write_response(writer, 404, "Unknown board {}\n".format(reporter),
+                                   close_connection=close_connection)
+                else:
+                    status_code, body_text = await accept_report(point_queue, *board_tuple, body_bytes)
+                    retry_header_text = ("Retry-After: {}\r\n".format(ingest_retry_after_seconds) if status_code == 503
+                                         else "")
+                    write_response(writer, status_code, body_text, retry_header_text, close_connection)
+            # Waiting for the client to read the response is what slows a client down when the server is busy
+            await writer.drain()
+            if close_connection:
+                return
+    finally:
+        writer.close()
+
+
+# Drain the queue into the write batch for as long as the server runs, gathering points for up to the flush interval
+# so each write carries many of them. Writes run in a worker thread and block while the writer already holds its
+# most lines pending, and while one is blocked the queue fills up, which is what pushes back on the boards
+async def write_queued_points(point_queue):
+    event_loop = asyncio.get_running_loop()
+    while True:
+        address, line_protocol_full_string = await point_queue.get()
+        line_protocol_string_list = [line_protocol_full_string]
+        address_to_point_count_dict = {address: 1}
+        flush_time = event_loop.time() + ingest_flush_interval_seconds
+        while len(line_protocol_string_list) < ingest_write_batch_size:
+            remaining_seconds = flush_time - event_loop.time()
+            if remaining_seconds <= 0:
+                break
+            try:
+                address, line_protocol_full_string = await asyncio.wait_for(point_queue.get(), remaining_seconds)
+            except asyncio.TimeoutError:
+                break
+            line_protocol_string_list.append(line_protocol_full_string)
+            address_to_point_count_dict[address] = address_to_point_count_dict.get(address, 0) + 1
+        for address, point_count in address_to_point_count_dict.items():
+            increment_stat("esp", address, "points", point_count)
+        try:
+            await event_loop.run_in_executor(None, send_data_to_influx, line_protocol_string_list)
+            await event_loop.run_in_executor(None, save_recorded_responses, "esp")
+        except Exception as write_error:
+            # Don't stop ingesting on a failed write, which the writer's own retries and spool already cover
+            print("Could not queue {} ingested point(s) for InfluxDB: {}".format(len(line_protocol_string_list),
+                                                                                  write_error))
+            record_error("esp", None, write_error)
+
+
+# Start accepting reports on the running event loop, returning the server once it is listening
+async def start_ingest_server():
+    build_reporter_to_influx_host_dict()
+    point_queue = asyncio.Queue(maxsize=ingest_queue_size)
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(point_queue, reader, writer),
+                                        ingest_listen_host, ingest_listen_port)
+    # Keep a reference to the writer task on the server, since the event loop only holds a weak one
+    server.point_writer_task = asyncio.ensure_future(write_queued_points(point_queue))
+    print("Accepting ESP reports on {}:{} from {} board(s)".format(ingest_listen_host, ingest_listen_port,
+                                                                  len(load_device_inventory().get("esp", []))))
+    return server
+
+
+# Start the server on an event loop of its own in a background thread, so it never competes with SNMP work
+def start_ingest_server_thread():
+    event_loop = asyncio.new_event_loop()
+    Thread(target=event_loop.run_forever, name="esp-ingest-event-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(start_ingest_server(), event_loop).result()
+
+
+# Accept reports until stopped
+async def serve_reports():
+    server = await start_ingest_server()
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve_reports())
+    except KeyboardInterrupt:
+        pass
+    # Write anything still batched before the process exits
+    close_influx_writer()
@@ -0,0 +1,324 @@
+import asyncio
+import gzip
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import choice, randint, random, uniform
+from socket import SO_REUSEADDR, SOL_SOCKET, socket
+from threading import Event, Lock, Thread
+from time import sleep
+
+# Local stand-ins for the devices the collectors poll, so collector performance can be measured without real hardware.
+# ESP boards and Tasmota plugs are small HTTP servers returning the same response shapes as the real devices, APC
+# network management cards are SNMPv3 agents answering the PowerNet OIDs apc.py requests, Unraid servers are SNMPv2c
+# agents answering walks of their extend output and processor load, Ubiquiti S16 switches are SSH servers with a CLI
+# that answers `show environment`, and InfluxDB is an HTTP server accepting the v2 write API. Each HTTP stand-in can add
+# latency and fail a fraction of requests.
+
+# Define the prompt the fake S16 CLI shows, and the host key every fake S16 shares, generated on first use
+fake_s16_prompt = "(UBNT EdgeSwitch) #"
+fake_s16_host_key = None
+
+
+# Handler shared by every fake HTTP device. The server it belongs to holds the response body and behavior settings
+class FakeDeviceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Wait for the configured latency, then either drop the connection to simulate a failure or return True
+    def simulate_latency_and_failure(self):
+        sleep(uniform(self.server.minimum_latency_seconds, self.server.maximum_latency_seconds))
+        if random() < self.server.failure_rate:
+            self.close_connection = True
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.simulate_latency_and_failure():
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", self.server.content_type)
+        self.send_header("Content-Length", str(len(self.server.response_bytes)))
+        self.end_headers()
+        self.wfile.write(self.server.response_bytes)
+
+    # Accept InfluxDB v2 writes, counting the lines of Line Protocol received
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.simulate_latency_and_failure():
+            return
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        with self.server.counter_lock:
+            self.server.write_count += 1
+            self.server.line_count += len([line for line in body.splitlines() if line])
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # Keep the benchmark output readable by not logging each request
+    def log_message(self, *_):
+        pass
+
+
+# Start a fake HTTP device on a free local port in a background thread, returning the server. The address to poll it
+# at is `127.0.0.1:<server.server_port>`
+def start_fake_http_device(response_bytes=b"", content_type="text/plain", latency_milliseconds_range=(0, 0),
+                           failure_rate=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDeviceRequestHandler)
+    server.daemon_threads = True
+    server.response_bytes = response_bytes
+    server.content_type = content_type
+    server.minimum_latency_seconds = latency_milliseconds_range[0] / 1000
+    server.maximum_latency_seconds = latency_milliseconds_range[1] / 1000
+    server.failure_rate = failure_rate
+    server.counter_lock = Lock()
+    server.write_count = 0
+    server.line_count = 0
+    Thread(target=server.serve_forever, name="fake-device-{}".format(server.server_port), daemon=True).start()
+    return server
+
+
+# Build the two-line CSV an ESP board returns: a schema line of sensor names, and a line of their values
+def build_esp_response(esp_field_name_list):
+    value_list = ["{:.2f}".format(uniform(1, 100)) for _ in esp_field_name_list]
+    return "{}\n{}\n".format(",".join(esp_field_name_list), ",".join(value_list)).encode("utf-8")
+
+
+# Build the JSON a Tasmota plug returns for `Status 0`, including the sections the collector never reads
+def build_tasmota_response():
+    status_dict = {"Status": {"Module": 0, "DeviceName": "Tasmota", "FriendlyName": ["Tasmota"], "Topic": "tasmota",
+                              "ButtonTopic": "0", "Power": 1, "PowerOnState": 3, "LedState": 1, "SaveData": 1},
+                   "StatusPRM": {"Baudrate": 115200, "SerialConfig": "8N1", "GroupTopic": "tasmotas",
+                                 "OtaUrl": "http://ota.tasmota.com/tasmota/release/tasmota.bin.gz",
+                                 "RestartReason": "Software/System restart", "Uptime": "10T04:12:44",
+                                 "StartupUTC": "2024-07-04T12:00:00", "Sleep": 50, "BootCount": 42},
+                   "StatusFWR": {"Version": "14.1.0(tasmota)", "BuildDateTime": "2024-06-19T08:23:30",
+                                 "Boot": 31, "Core": "2_7_7", "SDK": "2.2.2-dev(38a443e)", "CpuFrequency": 80,
+                                 "Hardware": "ESP8266EX", "CR": "378/699"},
+                   "StatusMEM": {"ProgramSize": 629, "Free": 372, "Heap": 25, "ProgramFlashSize": 1024,
+                                 "FlashSize": 4096, "FlashChipId": "164020", "FlashFrequency": 40, "FlashMode": "DOUT",
+                                 "Features": ["00000809", "8F9AC787", "04368001", "000000CF", "010013C0"]},
+                   "StatusNET": {"Hostname": "tasmota-plug", "IPAddress": "10.1.1.50", "Gateway": "10.1.1.1",
+                                 "Subnetmask": "255.255.255.0", "DNSServer1": "10.1.1.1", "DNSServer2": "0.0.0.0",
+                                 "Mac": "AA:BB:CC:DD:EE:FF", "Webserver": 2, "HTTP_API": 1, "WifiConfig": 4},
+                   "StatusMQT": {"MqttHost": "", "MqttPort": 1883, "MqttClient": "DVES_000000", "MqttUser": "DVES",
+                                 "MqttCount": 0, "MAX_PACKET_SIZE": 1200, "KEEPALIVE": 30, "SOCKET_TIMEOUT": 4},
+                   "StatusTIM": {"UTC": "2024-07-14T16:12:44", "Local": "2024-07-14T12:12:44",
+                                 "StartDST": "2024-03-10T02:00:00", "EndDST": "2024-11-03T02:00:00",
+                                 "Timezone": "-05:00", "Sunrise": "05:35", "Sunset": "20:25"},
+                   "StatusSNS": {"Time": "2024-07-14T12:12:44",
+                                 "ENERGY": {"TotalStartTime": "2023-01-01T00:00:00", "Total": round(uniform(1, 900), 3),
+                                            "Yesterday": 1.234, "Today": 0.456, "Power": round(uniform(0, 1500)),
+                                            "ApparentPower": round(uniform(0, 1500)), "ReactivePower": 12,
+                                            "Factor": round(uniform(0, 1), 2), "Voltage": round(uniform(110, 125)),
+                                            "Current": round(uniform(0, 12), 3)}},
+                   "StatusSTS": {"Time": "2024-07-14T12:12:44", "Uptime": "10T04:12:44", "UptimeSec": 879164,
+                                 "Heap": 25, "SleepMode": "Dynamic", "Sleep": 50, "LoadAvg": 19, "MqttCount": 0,
+                                 "POWER": "ON", "Wifi": {"AP": 1, "SSId": "network", "BSSId": "AA:BB:CC:DD:EE:00",
+                                                         "Channel": 6, "Mode": "11n", "RSSI": 70, "Signal": -65,
+                                                         "LinkCount": 1, "Downtime": "0T00:00:03"}}}
+    return json.dumps(status_dict).encode("utf-8")
+
+
+# Start a fake APC network management card as an SNMPv3 agent on the given event loop, answering GETs for each OID
+# with a fixed value. The agent listens on `address` and `port`; on Linux any 127.x.y.z address can be used, so many
+# agents can share the port the collector polls
+async def start_fake_apc_agent(address, port, snmp_user, oid_list, value=1234):
+    from pysnmp.carrier.asyncio.dgram import udp
+    from pysnmp.entity import config, engine
+    from pysnmp.entity.rfc3413 import cmdrsp, context
+    from pysnmp.proto.api import v2c
+    snmp_engine = engine.SnmpEngine()
+    config.addTransport(snmp_engine, udp.domainName, udp.UdpTransport().openServerMode((address, port)))
+    config.addV3User(snmp_engine, snmp_user)
+    config.addVacmUser(snmp_engine, 3, snmp_user, "noAuthNoPriv", (1, 3, 6, 1, 4, 1, 318))
+    snmp_context = context.SnmpContext(snmp_engine)
+    mib_builder = snmp_context.getMibInstrum().getMibBuilder()
+    MibScalar, MibScalarInstance = mib_builder.importSymbols("SNMPv2-SMI", "MibScalar", "MibScalarInstance")
+
+    # Scalar instance that always answers with the same value
+    class FakeApcScalarInstance(MibScalarInstance):
+        def getValue(self, name, idx):
+            return self.getSyntax().clone(value)
+
+    mib_symbol_list = []
+    for oid in oid_list:
+        # Split `x.y.z.0` into the scalar's OID and its `.0` instance
+        oid_tuple = tuple(int(oid_part) for oid_part in oid.split("."))
+        mib_symbol_list.append(MibScalar(oid_tuple[:-1], v2c.Gauge32()))
+        mib_symbol_list.append(FakeApcScalarInstance(oid_tuple[:-1], oid_tuple[-1:], v2c.Gauge32()))
+    mib_builder.exportSymbols("__FAKE-APC-MIB", *mib_symbol_list)
+    cmdrsp.GetCommandResponder(snmp_engine, snmp_context)
+    return snmp_engine
+
+
+# Start a fake Unraid server as an SNMPv2c agent on the given event loop. It answers walks of the net-snmp extend
+# output lines, given as a dict of extend name to its list of output lines, and of the per-core processor load
+async def start_fake_unraid_agent(address, port, community_name, extend_name_to_line_list, processor_load_list):
+    from pysnmp.carrier.asyncio.dgram import udp
+    from pysnmp.entity import config, engine
+    from pysnmp.entity.rfc3413 import cmdrsp, context
+    from pysnmp.proto.api import v2c
+    snmp_engine = engine.SnmpEngine()
+    config.addTransport(snmp_engine, udp.domainName, udp.UdpTransport().openServerMode((address, port)))
+    config.addV1System(snmp_engine, "fake-unraid-area", community_name)
+    config.addVacmUser(snmp_engine, 2, "fake-unraid-area", "noAuthNoPriv", (1, 3, 6, 1))
+    snmp_context = context.SnmpContext(snmp_engine)
+    mib_builder = snmp_context.getMibInstrum().getMibBuilder()
+    MibScalar, MibScalarInstance = mib_builder.importSymbols("SNMPv2-SMI", "MibScalar", "MibScalarInstance")
+    mib_symbol_list = []
+    # nsExtendOutLine is indexed by the extend name as a length-prefixed string, then the line number from 1
+    for extend_name, line_list in extend_name_to_line_list.items():
+        extend_oid = (1, 3, 6, 1, 4, 1, 8072, 1, 3, 2, 4, 1, 2, len(extend_name)) + tuple(extend_name.encode())
+        mib_symbol_list.append(MibScalar(extend_oid, v2c.OctetString()))
+        for line_number, line in enumerate(line_list, start=1):
+            mib_symbol_list.append(MibScalarInstance(extend_oid, (line_number,), v2c.OctetString(line)))
+    # hrProcessorLoad is indexed by each processor's hrDeviceIndex, which starts at 196608
+    processor_load_oid = (1, 3, 6, 1, 2, 1, 25, 3, 3, 1, 2)
+    mib_symbol_list.append(MibScalar(processor_load_oid, v2c.Integer32()))
+    for core_number, processor_load in enumerate(processor_load_list):
+        mib_symbol_list.append(MibScalarInstance(processor_load_oid, (196608 + core_number,),
+                                                 v2c.Integer32(processor_load)))
+    mib_builder.exportSymbols("__FAKE-UNRAID-MIB", *mib_symbol_list)
+    cmdrsp.GetCommandResponder(snmp_engine, snmp_context)
+    cmdrsp.NextCommandResponder(snmp_engine, snmp_context)
+    cmdrsp.BulkCommandResponder(snmp_engine, snmp_context)
+    return snmp_engine
+
+
+# Build the extend output an Unraid server returns, with the given number of disks and shares
+def build_unraid_extend_lines(disk_count, share_count):
+    return {"diskfree": ["disk{}: {}".format(disk_number, randint(10 ** 9, 10 ** 13))
+                         for disk_number in range(1, disk_count + 1)],
+            "sharefree": ["share{}: {}".format(share_number, randint(10 ** 9, 10 ** 13))
+                          for share_number in range(1, share_count + 1)],
+            "disktemp": ["WDC_WD100EMAZ-00WJTA0_DISK{}: {}".format(disk_number, choice((-2, -1, randint(25, 50))))
+                         for disk_number in range(1, disk_count + 1)],
+            "meminfo": ["MemTotal: 25278668800", "MemFree: 1234567890", "MemAvailable: 9876543210",
+                        "Cached: 5555555555"]}
+
+
+# Build the table a Ubiquiti S16 prints for `show environment`, with its temperature rows on lines 5-9 and its power
+# rows on lines 14-16 as ubiquiti.py reads them
+def build_s16_environment_output():
+    temperature_row_list = ["1        {}       {:<16}  {:<10}  Normal          {}".format(sensor_number, description,
+                                                                               randint(30, 60), 85)
+                            for sensor_number, description in enumerate(("TEMP-1", "TEMP-2", "PoE-01", "PoE-02",
+                                                                         "PoE-03"), start=1)]
+    power_row_list = ["1     {}            {:<11}  Fixed  Powering  {:.2f}  {:.2f}  {:.2f}  {:.2f}".format(
+        supply_number, description, uniform(0, 120), uniform(48, 56), uniform(0, 2500), uniform(0, 200000))
+        for supply_number, description in enumerate(("PoE-IN-1", "PoE-IN-2", "DC-IN-1"), start=1)]
+    return "\r\n".join(["Temperature Sensors:",
+                         "",
+                         "Unit     Sensor  Description       Temp (C)    State           Max_Temp (C)",
+                         "-------  ------  ----------------  ----------  --------------  ------------"] +
+                        temperature_row_list +
+                        ["",
+                         "Power Supplies:",
+                         "Unit  PowerSupply  Description  Type   State     Consumed(W)  Voltage(V)  Current(mA)  "
+                         "ConsumedMeter(Whr)",
+                         "----  -----------  -----------  -----  --------  -----------  ----------  -----------  "
+                         "------------------"] +
+                        power_row_list)
+
+
+# Get the paramiko server interface for the fake S16, which accepts any password and opens a shell on request. It is
+# built on first use, so paramiko is only imported when a fake S16 is started
+def get_fake_s16_server_interface_class():
+    import paramiko
+
+    # Server interface of one fake S16 connection, setting its event once the client asks for a shell
+    class FakeS16ServerInterface(paramiko.ServerInterface):
+        def __init__(self):
+            self.shell_requested_event = Event()
+
+        def get_allowed_auths(self, username):
+            return "password"
+
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            if kind == "session":
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+            return True
+
+        def check_channel_shell_request(self, channel):
+            self.shell_requested_event.set()
+            return True
+
+    return FakeS16ServerInterface
+
+
+# Serve one SSH connection to a fake S16, echoing what is typed as a terminal does and answering each line with the
+# `show environment` table or nothing, followed by the prompt, after the configured latency
+def serve_fake_s16_connection(client_socket, server_interface_class, minimum_latency_seconds, maximum_latency_seconds):
+    import paramiko
+    transport = paramiko.Transport(client_socket)
+    try:
+        transport.add_server_key(fake_s16_host_key)
+        server_interface = server_interface_class()
+        transport.start_server(server=server_interface)
+        channel = transport.accept(20)
+        if channel is None or not server_interface.shell_requested_event.wait(20):
+            return
+        channel.sendall(fake_s16_prompt)
+        line_characters = ""
+        previous_character = ""
+        while True:
+            received_bytes = channel.recv(1024)
+            if len(received_bytes) < 1:
+                return
+            for character in received_bytes.decode("utf-8", "replace"):
+                # Treat a line ended by \r\n as one line, not two
+                if character == "\n" and previous_character == "\r":
+                    previous_character = character
+                    continue
+                previous_character = character
+                if character not in "\r\n":
+                    line_characters += character
+                    channel.sendall(character)
+                    continue
+                sleep(uniform(minimum_latency_seconds, maximum_latency_seconds))
+                if line_characters.strip() == "show environment":
+                    channel.sendall("\r\n" + build_s16_environment_output())
+                channel.sendall("\r\n" + fake_s16_prompt)
+                line_characters = ""
+    except (EOFError, OSError, paramiko.SSHException):
+        return
+    finally:
+        transport.close()
+
+
+# Start a fake Ubiquiti S16 as an SSH server on `address` and `port` in a background thread, returning its listening
+# socket. As with the fake APC agents, any 127.x.y.z address can be used, so many switches can share the port polled
+def start_fake_s16_switch(address, port, latency_milliseconds_range=(0, 0)):
+    global fake_s16_host_key
+    import paramiko
+    if fake_s16_host_key is None:
+        fake_s16_host_key = paramiko.RSAKey.generate(2048)
+    server_interface_class = get_fake_s16_server_interface_class()
+    listening_socket = socket()
+    listening_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    listening_socket.bind((address, port))
+    listening_socket.listen(16)
+
+    # Accept connections for as long as the process runs, serving each on its own thread
+    def accept_connections():
+        while True:
+            client_socket, _ = listening_socket.accept()
+            Thread(target=serve_fake_s16_connection,
+                   args=(client_socket, server_interface_class, latency_milliseconds_range[0] / 1000,
+                         latency_milliseconds_range[1] / 1000), daemon=True).start()
+
+    Thread(target=accept_connections, name="fake-s16-{}".format(address), daemon=True).start()
+    return listening_socket
+
+
+# Start an event loop in a background thread for fake SNMP agents, kept apart from the collectors' own SNMP loop
+def start_fake_agent_event_loop():
+    event_loop = asyncio.new_event_loop()
+    Thread(target=event_loop.run_forever, name="fake-agent-event-loop", daemon=True).start()
+    return event_loop
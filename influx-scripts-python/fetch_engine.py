@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+
+# Shared engine for fetching from many devices at once, so a cycle takes roughly as long as its slowest device rather
+# than the sum of every device. A bounded pool of worker threads runs the per-device fetch functions, and HTTP fetches
+# go through one shared Session so connections to each device are kept alive and reused between requests and cycles.
+
+# Define the maximum number of devices that are fetched from at the same time
+max_concurrent_fetches = 16
+# Define the overall time limit for fetching from every device in a cycle. Devices still outstanding are skipped
+cycle_deadline_seconds = 20
+# Define the time limit for each individual HTTP GET before timing out
+http_timeout_seconds = 5
+
+# The shared Session is created on first use and then reused by every fetch in the process
+http_session = None
+http_session_lock = Lock()
+
+
+# Get the process-wide HTTP Session, creating it on first use with a connection pool sized for the worker pool
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            # Import requests on first use, to keep it out of process startup
+            from requests import Session
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter(pool_connections=max_concurrent_fetches, pool_maxsize=max_concurrent_fetches)
+            http_session = Session()
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+    return http_session
+
+
+# Given a URL, fetch its HTTP response body as text using the shared keep-alive Session
+def fetch_url_text(url, timeout=None):
+    if timeout is None:
+        timeout = http_timeout_seconds
+    response = get_http_session().get(url, timeout=timeout)
+    return response.text
+
+
+# Given a fetch function and a list of arguments, call the function once per argument across the worker pool.
+# Returns a list in the same order as the arguments, where each entry is either the function's return value or the
+# Exception it raised. Entries still running when the cycle deadline passes are returned as a TimeoutError.
+# The worker count and deadline default to the module settings, and a deadline of None waits for every entry
+def fetch_all_concurrently(fetch_function, argument_list, max_workers=None, deadline_seconds=-1):
+    if len(argument_list) < 1:
+        return []
+    if max_workers is None:
+        max_workers = max_concurrent_fetches
+    if deadline_seconds == -1:
+        deadline_seconds = cycle_deadline_seconds
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(argument_list)))
+    future_list = [executor.submit(fetch_function, argument) for argument in argument_list]
+    wait(future_list, timeout=deadline_seconds)
+    # Don't wait on stragglers past the deadline, and drop anything that never got a worker
+    executor.shutdown(wait=False, cancel_futures=True)
+    result_list = []
+    for argument, future in zip(argument_list, future_list):
+        if not future.done() or future.cancelled():
+            result_list.append(TimeoutError("Fetch for {} missed the {} second cycle deadline".format(
+                argument, deadline_seconds)))
+        elif future.exception() is not None:
+            result_list.append(future.exception())
+        else:
+            result_list.append(future.result())
+    return result_list
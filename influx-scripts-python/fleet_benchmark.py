@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import apc
+import device_health
+import esp
+import fetch_engine
+import influx_spool
+import influx_writer
+import phase_scheduler
+import ssh_session_pool
+import tasmota
+import ubiquiti
+import unraid
+from fake_devices import (build_esp_response, build_tasmota_response, build_unraid_extend_lines, start_fake_apc_agent,
+                          start_fake_agent_event_loop, start_fake_http_device, start_fake_s16_switch,
+                          start_fake_unraid_agent)
+from my_credentials import APC_SNMPV3_USER
+
+# End-to-end benchmark of each collector against a local fleet of fake devices and a fake InfluxDB, reporting cycle
+# time, points written per second, and peak memory for each `collect_and_write_*` function. Later performance work
+# should be judged against these numbers.
+# Run with `pipenv run python3 fleet_benchmark.py --esp 50 --tasmota 100 --ups 20 --unraid 5 --s16 5 --latency-ms 5 50 --failure-rate 0.05`
+
+# Define the port the fake APC agents listen on. Each agent gets its own 127.0.1.x address on this port
+fake_apc_port_number = 1161
+# Define the port the fake Unraid agents listen on, each on its own 127.0.2.x address, and the disks and shares of each
+fake_unraid_port_number = 1162
+fake_unraid_disk_count = 24
+fake_unraid_share_count = 20
+# Define the port the fake S16 switches accept SSH on, each on its own 127.0.3.x address
+fake_s16_port_number = 2222
+
+
+# Start the fake ESP boards and point esp.py at them
+def start_fake_esp_fleet(device_count, latency_milliseconds_range, failure_rate):
+    esp_field_name_list = []
+    for _, http_field in esp.influx_fields_to_http_fields:
+        for esp_field_name in (http_field if isinstance(http_field, tuple) else (http_field,)):
+            if esp_field_name not in esp_field_name_list:
+                esp_field_name_list.append(esp_field_name)
+    server_list = [start_fake_http_device(build_esp_response(esp_field_name_list), "text/plain",
+                                          latency_milliseconds_range, failure_rate) for _ in range(device_count)]
+    esp.ip_addresses_to_influx_hosts = [("127.0.0.1:{}".format(server.server_port), "fakeesp{}".format(index))
+                                        for index, server in enumerate(server_list)]
+
+
+# Start the fake Tasmota plugs and point tasmota.py at them
+def start_fake_tasmota_fleet(device_count, latency_milliseconds_range, failure_rate):
+    server_list = [start_fake_http_device(build_tasmota_response(), "application/json", latency_milliseconds_range,
+                                          failure_rate) for _ in range(device_count)]
+    tasmota.ip_addresses_to_influx_hosts = [("127.0.0.1:{}".format(server.server_port), "fakeplug{}".format(index))
+                                            for index, server in enumerate(server_list)]
+
+
+# Start the fake APC agents and point apc.py at them. A failure_rate fraction of the UPS addresses get no agent at all,
+# so polling them times out the way an unreachable card does
+def start_fake_apc_fleet(device_count, failure_rate):
+    event_loop = start_fake_agent_event_loop()
+    ups_address_list = ["127.0.1.{}".format(index + 1) for index in range(device_count)]
+    dead_ups_count = round(device_count * failure_rate)
+    for ups_address in ups_address_list[dead_ups_count:]:
+        asyncio.run_coroutine_threadsafe(start_fake_apc_agent(ups_address, fake_apc_port_number, APC_SNMPV3_USER,
+                                                              apc.oid_to_influx_field_dict.keys()),
+                                         event_loop).result()
+    apc.snmp_port_number = fake_apc_port_number
+    apc.ip_addresses_to_influx_ups = [(ups_address, "fakeups{}".format(index))
+                                      for index, ups_address in enumerate(ups_address_list)]
+
+
+# Start the fake Unraid servers and point unraid.py at them
+def start_fake_unraid_fleet(device_count):
+    event_loop = start_fake_agent_event_loop()
+    unraid_address_list = ["127.0.2.{}".format(index + 1) for index in range(device_count)]
+    for unraid_address in unraid_address_list:
+        asyncio.run_coroutine_threadsafe(start_fake_unraid_agent(unraid_address, fake_unraid_port_number,
+                                                                 unraid.snmp_community_name,
+                                                                 build_unraid_extend_lines(fake_unraid_disk_count,
+                                                                                           fake_unraid_share_count),
+                                                                 [5, 10, 15, 20]),
+                                         event_loop).result()
+    unraid.snmp_port_number = fake_unraid_port_number
+    unraid.ip_addresses_to_influx_hosts = [(unraid_address, "fakeunraid{}".format(index))
+                                           for index, unraid_address in enumerate(unraid_address_list)]
+
+
+# Start the fake S16 switches and point ubiquiti.py and the SSH session pool at them. A failure_rate fraction of the
+# switch addresses get no switch at all, so connecting to them is refused the way a switch that is down refuses it
+def start_fake_s16_fleet(device_count, latency_milliseconds_range, failure_rate):
+    s16_address_list = ["127.0.3.{}".format(index + 1) for index in range(device_count)]
+    dead_s16_count = round(device_count * failure_rate)
+    for s16_address in s16_address_list[dead_s16_count:]:
+        start_fake_s16_switch(s16_address, fake_s16_port_number, latency_milliseconds_range)
+    ssh_session_pool.ssh_port_number = fake_s16_port_number
+    ubiquiti.s16_ip_tag_tuples = [(s16_address, "fakes16{}".format(index))
+                                  for index, s16_address in enumerate(s16_address_list)]
+
+
+# Start the fake InfluxDB and point the writer at it, spooling any failed writes to a throwaway directory
+def start_fake_influx(latency_milliseconds_range, failure_rate):
+    influx_server = start_fake_http_device(latency_milliseconds_range=latency_milliseconds_range,
+                                           failure_rate=failure_rate)
+    influx_writer.INFLUX_URL = "http://127.0.0.1:{}".format(influx_server.server_port)
+    influx_spool.spool_directory = tempfile.mkdtemp(prefix="fleet-benchmark-spool-")
+    return influx_server
+
+
+# Run one full collect-and-write cycle, including flushing the writer so the write to Influx is part of the timing.
+# Returns the cycle time in seconds and the number of lines Influx received
+def run_timed_cycle(collect_and_write_function, influx_server):
+    line_count_before = influx_server.line_count
+    start_time = perf_counter()
+    collect_and_write_function()
+    influx_writer.close_influx_writer()
+    return perf_counter() - start_time, influx_server.line_count - line_count_before
+
+
+# Benchmark one collector over several cycles, then one more cycle with memory tracing on for its peak allocation
+def benchmark_collector(collector_name, collect_and_write_function, influx_server, cycle_count):
+    # Run one untimed cycle first, so connection setup and lazy imports don't count against the steady state
+    run_timed_cycle(collect_and_write_function, influx_server)
+    cycle_seconds_list = []
+    point_count = 0
+    for _ in range(cycle_count):
+        cycle_seconds, cycle_point_count = run_timed_cycle(collect_and_write_function, influx_server)
+        cycle_seconds_list.append(cycle_seconds)
+        point_count += cycle_point_count
+    tracemalloc.start()
+    run_timed_cycle(collect_and_write_function, influx_server)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    total_seconds = sum(cycle_seconds_list)
+    return (collector_name, total_seconds / cycle_count, max(cycle_seconds_list), point_count / cycle_count,
+            point_count / total_seconds, peak_bytes / 1024 / 1024)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Benchmark collectors against a fleet of fake devices")
+    argument_parser.add_argument("--esp", type=int, default=6, help="number of fake ESP boards")
+    argument_parser.add_argument("--tasmota", type=int, default=12, help="number of fake Tasmota plugs")
+    argument_parser.add_argument("--ups", type=int, default=1, help="number of fake APC cards")
+    argument_parser.add_argument("--unraid", type=int, default=1, help="number of fake Unraid servers")
+    argument_parser.add_argument("--s16", type=int, default=1, help="number of fake Ubiquiti S16 switches")
+    argument_parser.add_argument("--latency-ms", type=float, nargs=2, default=(0, 0), metavar=("MIN", "MAX"),
+                                 help="range of latency added to each device response")
+    argument_parser.add_argument("--failure-rate", type=float, default=0.0,
+                                 help="fraction of device requests (or APC cards and S16 switches) that fail")
+    argument_parser.add_argument("--influx-latency-ms", type=float, nargs=2, default=(0, 0), metavar=("MIN", "MAX"),
+                                 help="range of latency added to each Influx write")
+    argument_parser.add_argument("--influx-failure-rate", type=float, default=0.0,
+                                 help="fraction of Influx writes that fail")
+    argument_parser.add_argument("--cycles", type=int, default=5, help="number of timed cycles per collector")
+    argument_parser.add_argument("--device-phase-window", type=float, default=0.0,
+                                 help="seconds each cycle's devices are spread across, 0 to fetch them all at once")
+    argument_parser.add_argument("--timeout", type=float, default=fetch_engine.http_timeout_seconds,
+                                 help="per-request HTTP timeout in seconds")
+    arguments = argument_parser.parse_args()
+
+    fetch_engine.http_timeout_seconds = arguments.timeout
+    phase_scheduler.device_phase_window_seconds = arguments.device_phase_window
+    # Keep the fake fleet's device health apart from the real devices'
+    device_health.device_health_directory = tempfile.mkdtemp(prefix="fleet-benchmark-health-")
+    fake_influx_server = start_fake_influx(arguments.influx_latency_ms, arguments.influx_failure_rate)
+    collector_tuples = []
+    if arguments.esp > 0:
+        start_fake_esp_fleet(arguments.esp, arguments.latency_ms, arguments.failure_rate)
+        collector_tuples.append(("esp", esp.collect_and_write_esp_sensor_readings))
+    if arguments.tasmota > 0:
+        start_fake_tasmota_fleet(arguments.tasmota, arguments.latency_ms, arguments.failure_rate)
+        collector_tuples.append(("tasmota", tasmota.collect_and_write_tasmota_readings))
+    if arguments.ups > 0:
+        start_fake_apc_fleet(arguments.ups, arguments.failure_rate)
+        collector_tuples.append(("apc", apc.collect_and_write_apc_readings))
+    if arguments.unraid > 0:
+        start_fake_unraid_fleet(arguments.unraid)
+        collector_tuples.append(("unraid", unraid.collect_and_write_unraid_readings))
+    if arguments.s16 > 0:
+        start_fake_s16_fleet(arguments.s16, arguments.latency_ms, arguments.failure_rate)
+        collector_tuples.append(("s16", ubiquiti.collect_and_write_s16_readings))
+
+    result_tuples = [benchmark_collector(collector_name, collect_and_write_function, fake_influx_server,
+                                         arguments.cycles)
+                     for collector_name, collect_and_write_function in collector_tuples]
+    print("\n{:<10} {:>12} {:>12} {:>14} {:>12} {:>12}".format("collector", "mean cycle", "max cycle",
+                                                               "points/cycle", "points/s", "peak MiB"))
+    for result_tuple in result_tuples:
+        print("{:<10} {:>10.3f} s {:>10.3f} s {:>14.1f} {:>12.1f} {:>12.2f}".format(*result_tuple))
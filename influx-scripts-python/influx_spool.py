@@ -0,0 +1,210 @@
+import os
+from threading import Lock
+from time import time, time_ns
+
+# Append-only, segment-rotated spool of Line Protocol on local disk, used as a write-ahead log for InfluxDB. Every
+# record is appended to this process' open segment before it is handed to the writer, and each line is resolved once
+# the batch holding it is written or fails every retry. A segment whose lines were all written is deleted, while one
+# with any failed line is sealed and is then eligible to be replayed, so records survive the process dying while they
+# are buffered or being retried. Segments left open by a process that died are replayed once they go stale.
+# Replaying claims a segment by renaming it, so several processes can share one spool directory. Disk usage is capped
+# by deleting the oldest segments first.
+
+# Define where the spool segment files are stored, next to the scripts themselves
+spool_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool")
+# Define the size at which the open segment is sealed and a new one started
+spool_segment_max_bytes = 4 * 1024 * 1024
+# Define the maximum total size of every segment in the spool, beyond which the oldest segments are deleted
+spool_max_total_bytes = 256 * 1024 * 1024
+# Define how many lines of Line Protocol are replayed to InfluxDB in each write
+spool_replay_batch_lines = 50000
+# Define how old an open or claimed segment must be before it is assumed to be abandoned by a process that died
+spool_stale_segment_seconds = 300
+
+# Segment files are named `segment-<creation time in ns>-<pid>` so sorting by name sorts oldest first, with a suffix
+# that marks the state of the segment
+segment_prefix = "segment-"
+open_segment_suffix = ".open"
+sealed_segment_suffix = ".lp"
+claimed_segment_suffix = ".replaying"
+
+# Track the segment currently being appended to by this process
+open_segment_path = None
+# Map each of this process' segments with lines not yet resolved to a list of [unresolved line count, whether any line
+# failed]. Segments are rotated before all their lines are resolved, so several may be awaiting resolution at once
+unresolved_segment_dict = {}
+# Map each line not yet resolved to the list of segments it was appended to, which is how a batch handed back by the
+# writer is matched to its segments, since batches split and merge records and may finish in any order
+line_to_segment_paths = {}
+spool_lock = Lock()
+
+
+# Get the paths of every segment in the spool, oldest first
+def list_segment_paths():
+    try:
+        file_name_list = os.listdir(spool_directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(spool_directory, file_name) for file_name in sorted(file_name_list)
+            if file_name.startswith(segment_prefix)]
+
+
+# Rename the segment to mark it as sealed, so it can be replayed
+def seal_segment(segment_path):
+    os.replace(segment_path, segment_path[:-len(open_segment_suffix)] + sealed_segment_suffix)
+
+
+# Seal the segment this process is appending to, if any, along with any segment whose lines were never all resolved,
+# so they are replayed. Call this before the process exits
+def seal_open_segment():
+    global open_segment_path
+    with spool_lock:
+        for segment_path in list(unresolved_segment_dict):
+            finish_segment(segment_path, True)
+        line_to_segment_paths.clear()
+        if open_segment_path is not None:
+            seal_segment(open_segment_path)
+            open_segment_path = None
+
+
+# Finish with one of this process' segments once nothing more will be appended to it, sealing it for replay if any of
+# its lines failed and deleting it otherwise. Must be called while holding the lock
+def finish_segment(segment_path, any_line_failed):
+    global open_segment_path
+    unresolved_segment_dict.pop(segment_path, None)
+    if segment_path == open_segment_path:
+        open_segment_path = None
+    try:
+        if any_line_failed:
+            seal_segment(segment_path)
+        else:
+            os.remove(segment_path)
+    except FileNotFoundError:
+        # Evicted in the meantime, or claimed by another process after going stale
+        pass
+
+
+# Delete the oldest segments until the spool is back under its size limit, never deleting this process' open segment
+def evict_oldest_segments():
+    segment_size_list = []
+    for segment_path in list_segment_paths():
+        try:
+            segment_size_list.append((segment_path, os.path.getsize(segment_path)))
+        except FileNotFoundError:
+            # Another process replayed or evicted the segment in the meantime
+            continue
+    total_bytes = sum(segment_size for _, segment_size in segment_size_list)
+    for segment_path, segment_size in segment_size_list:
+        if total_bytes <= spool_max_total_bytes:
+            break
+        if segment_path == open_segment_path:
+            continue
+        try:
+            os.remove(segment_path)
+            print("Spool over {} bytes, evicted oldest segment {}".format(spool_max_total_bytes, segment_path))
+        except FileNotFoundError:
+            pass
+        total_bytes -= segment_size
+
+
+# Append a list of lines of Line Protocol to this process' open segment before they are handed to the writer, to be
+# resolved with resolve_spooled_lines() once written. The segment is rotated once it grows past the size limit, and is
+# then finished as soon as all of its lines are resolved
+def append_lines_to_spool(line_protocol_string_list):
+    global open_segment_path
+    if len(line_protocol_string_list) < 1:
+        return
+    with spool_lock:
+        if open_segment_path is None:
+            os.makedirs(spool_directory, exist_ok=True)
+            open_segment_path = os.path.join(spool_directory, "{}{:020d}-{}{}".format(
+                segment_prefix, time_ns(), os.getpid(), open_segment_suffix))
+            unresolved_segment_dict[open_segment_path] = [0, False]
+        with open(open_segment_path, "a", encoding="utf-8") as segment_file:
+            segment_file.write("\n".join(line_protocol_string_list) + "\n")
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+            segment_bytes = segment_file.tell()
+        unresolved_segment_dict[open_segment_path][0] += len(line_protocol_string_list)
+        for line in line_protocol_string_list:
+            line_to_segment_paths.setdefault(line, []).append(open_segment_path)
+        if segment_bytes >= spool_segment_max_bytes:
+            # Stop appending to it, leaving it to be finished once its last line is resolved
+            open_segment_path = None
+        evict_oldest_segments()
+
+
+# Resolve the lines of a batch handed back by the writer, given as a newline-separated String or bytes, as either
+# written or failed. Each segment is finished once all of its lines are resolved, which keeps it for replay if any of
+# them failed. Lines that were never spooled, such as when appending to the spool failed, are ignored
+def resolve_spooled_lines(batch_data, written):
+    if isinstance(batch_data, bytes):
+        batch_data = batch_data.decode("utf-8")
+    with spool_lock:
+        for line in batch_data.split("\n"):
+            segment_path_list = line_to_segment_paths.get(line)
+            if segment_path_list is None:
+                continue
+            segment_path = segment_path_list.pop(0)
+            if len(segment_path_list) < 1:
+                line_to_segment_paths.pop(line)
+            segment_state = unresolved_segment_dict.get(segment_path)
+            if segment_state is None:
+                continue
+            segment_state[0] -= 1
+            if not written:
+                segment_state[1] = True
+            if segment_state[0] < 1:
+                finish_segment(segment_path, segment_state[1])
+        if not written:
+            print("Kept {} failed line(s) in the spool for replay".format(batch_data.count("\n") + 1))
+
+
+# Try to claim a segment for replay by renaming it, which only one process can win. Returns the claimed path or None
+def claim_segment(segment_path):
+    if segment_path.endswith(open_segment_suffix):
+        # Only claim an open segment once its process has stopped appending to it for a long time
+        if segment_path in unresolved_segment_dict:
+            return None
+        base_path = segment_path[:-len(open_segment_suffix)]
+    elif segment_path.endswith(claimed_segment_suffix):
+        # A claimed segment that is never finished means the process replaying it died part way
+        base_path = segment_path[:-len(claimed_segment_suffix)]
+    else:
+        base_path = segment_path[:-len(sealed_segment_suffix)]
+    try:
+        if not segment_path.endswith(sealed_segment_suffix) and \
+                time() - os.path.getmtime(segment_path) < spool_stale_segment_seconds:
+            return None
+        claimed_path = base_path + claimed_segment_suffix
+        os.replace(segment_path, claimed_path)
+        # Touch the claimed segment so other processes see it as freshly claimed rather than stale
+        os.utime(claimed_path)
+        return claimed_path
+    except FileNotFoundError:
+        return None
+
+
+# Replay every available segment oldest first through the given write function, which is called with lists of
+# Line Protocol and should raise on failure. A segment is deleted once all of it is written. Replay stops at the first
+# failure, putting that segment back so it is retried later. InfluxDB overwrites points with an identical series and
+# timestamp, so replaying part of a segment a second time does no harm. Returns the number of lines replayed
+def replay_spool(write_function):
+    replayed_line_count = 0
+    for segment_path in list_segment_paths():
+        claimed_path = claim_segment(segment_path)
+        if claimed_path is None:
+            continue
+        with open(claimed_path, encoding="utf-8") as segment_file:
+            line_list = [line for line in segment_file.read().splitlines() if line]
+        try:
+            for start_index in range(0, len(line_list), spool_replay_batch_lines):
+                write_function(line_list[start_index:start_index + spool_replay_batch_lines])
+        except Exception as write_error:
+            print("Could not replay spool segment {}, keeping it for later: {}".format(claimed_path, write_error))
+            os.replace(claimed_path, claimed_path[:-len(claimed_segment_suffix)] + sealed_segment_suffix)
+            break
+        os.remove(claimed_path)
+        replayed_line_count += len(line_list)
+        print("Replayed {} line(s) from spool segment {}".format(len(line_list), claimed_path))
+    return replayed_line_count
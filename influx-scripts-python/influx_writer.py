@@ -1,12 +1,246 @@
-from influxdb_client import InfluxDBClient, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, time_ns
 
+from collector_stats import drain_stats_lines, increment_stat, record_error
+from deadband_filter import resolve_written_lines
+from influx_spool import append_lines_to_spool, replay_spool, resolve_spooled_lines, seal_open_segment
 from my_credentials import INFLUX_URL, INFLUX_BUCKET, INFLUX_ORG, INFLUX_TOKEN
 
+# One client and one batching write API are kept per process and shared by every collector. Records from all callers
+# are coalesced into batches that are sent gzip-compressed, whenever a batch fills up or the flush interval passes,
+# with failed batches retried using exponential backoff. Call close_influx_writer() before the process exits so that
+# anything still buffered gets written. Records are appended to the on-disk spool before they are buffered, and stay
+# there until written, so batches that fail every retry, or that were buffered when the process died, are kept. A
+# background thread replays the spool in bulk once InfluxDB can be written to again. Every write also carries the stats
+# recorded since the previous one, including the size and latency of the batches this writer has sent.
+# The Influx client library is only imported once something is written, to keep it out of process startup.
 
-# Use the Influx Python Client to call the Influx 2.0 write API to batch-write the Line Protocol for all new data
+# Define the precision of the timestamps in the Line Protocol being written, matching the client's WritePrecision.S.
+# Every timestamp is made with get_precision_timestamp(), so changing this changes the precision of every collector
+influx_write_precision = "s"
+# Map each write precision to the number of nanoseconds in one unit of it
+precision_to_nanoseconds = {"s": 1000000000, "ms": 1000000, "us": 1000, "ns": 1}
+# Define the maximum number of lines of Line Protocol sent in one HTTP write
+influx_batch_size = 5000
+# Define how long records may wait in the buffer before a partial batch is sent anyway
+influx_flush_interval_milliseconds = 1000
+# Define how many times a failed batch is retried, and the backoff between attempts
+influx_max_retries = 3
+influx_retry_interval_milliseconds = 1000
+influx_max_retry_delay_milliseconds = 30000
+influx_retry_exponential_base = 2
+# Define the longest time a batch may spend being retried, and how long exiting may wait for buffered writes
+influx_max_retry_time_milliseconds = 60000
+influx_max_close_wait_milliseconds = 60000
+# Define the most lines handed to the client that may be waiting to be written or retried. Writing more blocks until
+# enough are written or given up on, so a slow InfluxDB pushes back on the callers rather than growing the buffer
+influx_max_pending_lines = 20000
+# Compress the body of each write request
+influx_enable_gzip = True
+# Define how often the background thread checks the spool for records to replay
+spool_replay_interval_seconds = 30
+
+# The shared client and write API are created on first use
+influx_client = None
+influx_write_api = None
+influx_writer_lock = Lock()
+# The spool replay thread runs until the writer is closed
+spool_replay_thread = None
+spool_replay_stop_event = Event()
+# The time the oldest record not yet confirmed written was queued, for measuring how long a batch takes to be written
+oldest_queued_time = None
+# Kept apart from the writer lock, which is held while closing the writer flushes batches and runs their callbacks
+write_latency_lock = Lock()
+# The number of lines handed to the client whose batch hasn't yet been written or given up on
+pending_line_count = 0
+pending_line_condition = Condition()
+
+
+# Given a time in nanoseconds since Epoch, such as from time_ns(), get the Line Protocol timestamp for it at the write
+# precision. Defaults to the current time
+def get_precision_timestamp(epoch_time_nanoseconds=None):
+    if epoch_time_nanoseconds is None:
+        epoch_time_nanoseconds = time_ns()
+    return epoch_time_nanoseconds // precision_to_nanoseconds[influx_write_precision]
+
+
+# Count lines as no longer pending once their batch is written or given up on, waking any writer waiting for room
+def release_pending_lines(line_count):
+    global pending_line_count
+    with pending_line_condition:
+        pending_line_count = max(0, pending_line_count - line_count)
+        pending_line_condition.notify_all()
+
+
+# Wait until the client has room for more lines, then count them as pending. A write larger than the limit waits for
+# nothing else to be pending, so it is never blocked forever
+def reserve_pending_lines(line_count):
+    global pending_line_count
+    with pending_line_condition:
+        if pending_line_count > 0 and pending_line_count + line_count > influx_max_pending_lines:
+            print("{} line(s) are still waiting to be written to InfluxDB, waiting for room".format(pending_line_count))
+        pending_line_condition.wait_for(lambda: pending_line_count < 1 or
+                                        pending_line_count + line_count <= influx_max_pending_lines)
+        pending_line_count += line_count
+
+
+# Take the time since the oldest record still waiting was queued, in milliseconds, starting over for the next batch
+def take_write_latency_milliseconds():
+    global oldest_queued_time
+    with write_latency_lock:
+        queued_time = oldest_queued_time
+        oldest_queued_time = None
+    if queued_time is None:
+        return 0.0
+    return round((monotonic() - queued_time) * 1000, 3)
+
+
+# Print a summary once a batch has been written, drop its lines from the spool, and count their deadband values as
+# written
+def handle_write_success(batch_tuple, batch_data):
+    resolve_spooled_lines(batch_data, True)
+    resolve_written_lines(batch_data, True)
+    batch_line_count = count_batch_lines(batch_data)
+    release_pending_lines(batch_line_count)
+    print("Wrote batch of {} line(s) to InfluxDB bucket {}".format(batch_line_count, batch_tuple[0]))
+    increment_stat("influx_writer", None, "batches")
+    increment_stat("influx_writer", None, "batchLines", batch_line_count)
+    increment_stat("influx_writer", None, "batchBytes", len(batch_data))
+    increment_stat("influx_writer", None, "writeMilliseconds", take_write_latency_milliseconds())
+
+
+# Print the error once a batch has failed every retry, and keep its lines in the spool so they aren't lost
+def handle_write_error(batch_tuple, batch_data, exception):
+    print("Could not write batch of {} line(s) to InfluxDB bucket {}, keeping it in the spool: {}".format(
+        count_batch_lines(batch_data), batch_tuple[0], exception))
+    resolve_spooled_lines(batch_data, False)
+    resolve_written_lines(batch_data, False)
+    release_pending_lines(count_batch_lines(batch_data))
+    take_write_latency_milliseconds()
+    record_error("influx_writer", None, exception)
+
+
+# Print the error each time a batch will be retried
+def handle_write_retry(batch_tuple, batch_data, exception):
+    print("Retrying batch of {} line(s) to InfluxDB bucket {}: {}".format(count_batch_lines(batch_data),
+                                                                         batch_tuple[0], exception))
+    increment_stat("influx_writer", None, "retries")
+
+
+# Given the data of a batch as the client hands it back, count the lines of Line Protocol it contains
+def count_batch_lines(batch_data):
+    if isinstance(batch_data, bytes):
+        return batch_data.count(b"\n") + 1
+    return batch_data.count("\n") + 1
+
+
+# Get the process-wide batching write API, creating the client and write API on first use
+def get_write_api():
+    global influx_client, influx_write_api
+    with influx_writer_lock:
+        if influx_write_api is None:
+            from influxdb_client import InfluxDBClient
+            from influxdb_client.client.write_api import WriteOptions, WriteType
+            influx_client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG,
+                                           enable_gzip=influx_enable_gzip)
+            write_options = WriteOptions(write_type=WriteType.batching,
+                                         batch_size=influx_batch_size,
+                                         flush_interval=influx_flush_interval_milliseconds,
+                                         retry_interval=influx_retry_interval_milliseconds,
+                                         max_retries=influx_max_retries,
+                                         max_retry_delay=influx_max_retry_delay_milliseconds,
+                                         max_retry_time=influx_max_retry_time_milliseconds,
+                                         exponential_base=influx_retry_exponential_base,
+                                         max_close_wait=influx_max_close_wait_milliseconds)
+            influx_write_api = influx_client.write_api(write_options=write_options,
+                                                       success_callback=handle_write_success,
+                                                       error_callback=handle_write_error,
+                                                       retry_callback=handle_write_retry)
+            start_spool_replay_thread(influx_client)
+    return influx_write_api
+
+
+# Replay spooled records through a synchronous write API, so each bulk write either succeeds or raises
+def replay_spool_to_influx(client):
+    from influxdb_client.client.write_api import SYNCHRONOUS
+    replay_write_api = client.write_api(write_options=SYNCHRONOUS)
+    replayed_line_count = replay_spool(lambda line_list: replay_write_api.write(
+        write_precision=influx_write_precision, bucket=INFLUX_BUCKET, record=line_list))
+    if replayed_line_count > 0:
+        print("Replayed {} spooled line(s) into InfluxDB".format(replayed_line_count))
+
+
+# Check the spool right away and then on an interval until the writer is closed
+def run_spool_replay(client):
+    while True:
+        try:
+            replay_spool_to_influx(client)
+        except Exception as replay_error:
+            # Don't exit on an Exception when replaying, rather trying again next interval
+            print("Could not replay spool: {}".format(replay_error))
+        if spool_replay_stop_event.wait(spool_replay_interval_seconds):
+            return
+
+
+# Start the background thread that replays the spool into InfluxDB using the shared client
+def start_spool_replay_thread(client):
+    global spool_replay_thread
+    spool_replay_stop_event.clear()
+    spool_replay_thread = Thread(target=run_spool_replay, name="spool-replay", args=(client,), daemon=True)
+    spool_replay_thread.start()
+
+
+# Write the stats recorded by the callbacks of the last batches, which come after the final write they could be drained
+# into, through a synchronous write API on the client, keeping them in the spool if that fails
+def write_remaining_stats(client):
+    from influxdb_client.client.write_api import SYNCHRONOUS
+    stats_line_list = drain_stats_lines(get_precision_timestamp())
+    if len(stats_line_list) < 1:
+        return
+    append_lines_to_spool(stats_line_list)
+    try:
+        client.write_api(write_options=SYNCHRONOUS).write(write_precision=influx_write_precision, bucket=INFLUX_BUCKET,
+                                                          record=stats_line_list)
+    except Exception as write_error:
+        print("Could not write {} stats line(s) to InfluxDB, keeping them in the spool: {}".format(
+            len(stats_line_list), write_error))
+        resolve_spooled_lines("\n".join(stats_line_list), False)
+        return
+    resolve_spooled_lines("\n".join(stats_line_list), True)
+
+
+# Flush anything still buffered and close the shared write API and client, sealing any records spooled meanwhile
+def close_influx_writer():
+    global influx_client, influx_write_api, spool_replay_thread
+    with influx_writer_lock:
+        if influx_write_api is not None:
+            spool_replay_stop_event.set()
+            spool_replay_thread.join(timeout=influx_max_close_wait_milliseconds / 1000)
+            spool_replay_thread = None
+            influx_write_api.close()
+            # Lines still pending after the close wait was reached will never be resolved by this write API
+            release_pending_lines(pending_line_count)
+            write_remaining_stats(influx_client)
+            influx_client.close()
+            influx_write_api = None
+            influx_client = None
+    seal_open_segment()
+
+
+# Queue Line Protocol for all new data to be batch-written through the Influx 2.0 write API, along with the stats
+# recorded since the last write. Blocks while the client already holds the most lines it may have pending
 def send_data_to_influx(line_protocol_string_list):
-    client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
-    write_api = client.write_api(write_options=SYNCHRONOUS)
-    print("Writing data {} to InfluxDB".format(line_protocol_string_list))
-    write_api.write(write_precision=WritePrecision.S, bucket=INFLUX_BUCKET, record=line_protocol_string_list)
+    global oldest_queued_time
+    line_protocol_string_list = line_protocol_string_list + drain_stats_lines(get_precision_timestamp())
+    reserve_pending_lines(len(line_protocol_string_list))
+    print("Queueing {} line(s) of data for InfluxDB".format(len(line_protocol_string_list)))
+    try:
+        append_lines_to_spool(line_protocol_string_list)
+    except OSError as spool_error:
+        # Still write the records when the spool can't be, they just won't survive the process dying before then
+        print("Could not append {} line(s) to the spool: {}".format(len(line_protocol_string_list), spool_error))
+        record_error("influx_writer", None, spool_error)
+    with write_latency_lock:
+        if oldest_queued_time is None:
+            oldest_queued_time = monotonic()
+    get_write_api().write(write_precision=influx_write_precision, bucket=INFLUX_BUCKET, record=line_protocol_string_list)
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+from time import perf_counter
+
+import device_inventory
+import esp
+import esp_ingest_server
+import influx_writer
+from fake_devices import build_esp_response
+from fleet_benchmark import start_fake_influx
+
+# Load test of esp_ingest_server.py with many fake ESP boards pushing reports over keep-alive connections at once,
+# against a fake InfluxDB. Reports the reports accepted per second, the points Influx received, how many reports were
+# turned away with 503 because the queue was full, and the response latency, so the queue, batch, and pending line
+# settings can be judged under load. Boards that are turned away wait the Retry-After time before reporting again, as
+# real ones should.
+# Run with `pipenv run python3 ingest_benchmark.py --boards 1000 --seconds 10 --influx-latency-ms 50 200`
+
+
+# Point the ingest server at the fake boards, which report as `fakeesp0` and so on
+def register_fake_boards(board_count):
+    device_inventory.collector_device_dict = {"esp": [("fakeesp{}".format(index), "fakeesp{}".format(index))
+                                                      for index in range(board_count)]}
+
+
+# Push reports from one fake board until the end time, waiting the given interval between reports. Returns a Tuple of
+# the list of latencies in seconds of accepted reports, the number turned away with 503, and the number otherwise
+# failed
+async def run_fake_board(board_name, port_number, report_bytes, report_interval_seconds, end_time):
+    request_bytes = ("POST /esp?host={} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: text/plain\r\n"
+                     "Content-Length: {}\r\n\r\n".format(board_name, len(report_bytes))).encode("ascii") + report_bytes
+    latency_list = []
+    rejected_count = 0
+    failed_count = 0
+    reader, writer = await asyncio.open_connection("127.0.0.1", port_number)
+    try:
+        while perf_counter() < end_time:
+            start_time = perf_counter()
+            writer.write(request_bytes)
+            header_bytes = await reader.readuntil(b"\r\n\r\n")
+            header_line_list = header_bytes.decode("latin-1").split("\r\n")
+            status_code = int(header_line_list[0].split(" ")[1])
+            header_dict = {}
+            for header_line in header_line_list[1:]:
+                header_name, _, header_value = header_line.partition(":")
+                header_dict[header_name.strip().lower()] = header_value.strip()
+            await reader.readexactly(int(header_dict.get("content-length", 0)))
+            if status_code == 204:
+                latency_list.append(perf_counter() - start_time)
+                await asyncio.sleep(report_interval_seconds)
+            elif status_code == 503:
+                rejected_count += 1
+                await asyncio.sleep(float(header_dict.get("retry-after", 1)))
+            else:
+                failed_count += 1
+                await asyncio.sleep(report_interval_seconds)
+    finally:
+        writer.close()
+    return latency_list, rejected_count, failed_count
+
+
+# Run every fake board at once for the given number of seconds, returning the list of each board's result Tuple
+async def run_fake_boards(board_count, port_number, report_interval_seconds, run_seconds):
+    esp_field_name_list = []
+    for _, http_field in esp.influx_fields_to_http_fields:
+        for esp_field_name in (http_field if isinstance(http_field, tuple) else (http_field,)):
+            if esp_field_name not in esp_field_name_list:
+                esp_field_name_list.append(esp_field_name)
+    end_time = perf_counter() + run_seconds
+    return await asyncio.gather(*[run_fake_board("fakeesp{}".format(index), port_number,
+                                                 build_esp_response(esp_field_name_list), report_interval_seconds,
+                                                 end_time)
+                                  for index in range(board_count)])
+
+
+# Get the value at a fraction of the way through a sorted list, or 0 if it is empty
+def get_percentile(sorted_value_list, fraction):
+    if len(sorted_value_list) < 1:
+        return 0
+    return sorted_value_list[min(int(len(sorted_value_list) * fraction), len(sorted_value_list) - 1)]
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Load test the ESP ingest server with fake boards")
+    argument_parser.add_argument("--boards", type=int, default=100, help="number of fake boards reporting at once")
+    argument_parser.add_argument("--seconds", type=float, default=10, help="how long the boards keep reporting")
+    argument_parser.add_argument("--interval", type=float, default=0.0,
+                                 help="seconds each board waits between reports, 0 to report as fast as possible")
+    argument_parser.add_argument("--port", type=int, default=esp_ingest_server.ingest_listen_port,
+                                 help="port the ingest server listens on")
+    argument_parser.add_argument("--queue-size", type=int, default=esp_ingest_server.ingest_queue_size,
+                                 help="most points held waiting to be written")
+    argument_parser.add_argument("--max-pending-lines", type=int, default=influx_writer.influx_max_pending_lines,
+                                 help="most lines the writer holds waiting to be written to Influx")
+    argument_parser.add_argument("--influx-latency-ms", type=float, nargs=2, default=(0, 0), metavar=("MIN", "MAX"),
+                                 help="range of latency added to each Influx write")
+    argument_parser.add_argument("--influx-failure-rate", type=float, default=0.0,
+                                 help="fraction of Influx writes that fail")
+    arguments = argument_parser.parse_args()
+    fake_influx_server = start_fake_influx(arguments.influx_latency_ms, arguments.influx_failure_rate)
+    register_fake_boards(arguments.boards)
+    esp_ingest_server.ingest_listen_host = "127.0.0.1"
+    esp_ingest_server.ingest_listen_port = arguments.port
+    esp_ingest_server.ingest_queue_size = arguments.queue_size
+    influx_writer.influx_max_pending_lines = arguments.max_pending_lines
+    esp_ingest_server.start_ingest_server_thread()
+
+    start_time = perf_counter()
+    board_result_tuples = asyncio.run(run_fake_boards(arguments.boards, arguments.port, arguments.interval,
+                                                      arguments.seconds))
+    elapsed_seconds = perf_counter() - start_time
+    # Give the ingest server's writer time to hand over its last batch, then flush it so Influx's count is complete
+    asyncio.run(asyncio.sleep(esp_ingest_server.ingest_flush_interval_seconds * 2))
+    influx_writer.close_influx_writer()
+
+    latency_list = sorted(latency for board_latency_list, _, _ in board_result_tuples
+                          for latency in board_latency_list)
+    rejected_count = sum(board_rejected_count for _, board_rejected_count, _ in board_result_tuples)
+    failed_count = sum(board_failed_count for _, _, board_failed_count in board_result_tuples)
+    print("\n{:>8} {:>10} {:>12} {:>12} {:>10} {:>8} {:>10} {:>10}".format(
+        "boards", "accepted", "accepted/s", "influx lines", "rejected", "failed", "p50 ms", "p99 ms"))
+    print("{:>8} {:>10} {:>12,.0f} {:>12} {:>10} {:>8} {:>10.2f} {:>10.2f}".format(
+        arguments.boards, len(latency_list), len(latency_list) / elapsed_seconds, fake_influx_server.line_count,
+        rejected_count, failed_count, get_percentile(latency_list, 0.5) * 1000,
+        get_percentile(latency_list, 0.99) * 1000))
@@ -0,0 +1,140 @@
+import json
+from collections import deque
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import time_ns
+from urllib.parse import parse_qs, urlparse
+
+# In-memory cache of the most recent readings of every device, served over a small local HTTP endpoint by the resident
+# collector, so dashboards and alert scripts reading the current state don't need to query InfluxDB. Collectors hand
+# each device's fields to the cache as they are read, before any deadband filtering, and every field keeps a ring
+# buffer of its last few readings, so memory stays bounded however long the collector runs.
+#
+# GET /latest returns every device's newest value of each field as {measurement: {device: {field: [time, value]}}},
+# and can be narrowed with `?measurement=tasmota&device=lamp`. GET /history?measurement=tasmota&device=lamp&field=watts
+# returns that field's buffered readings as a list of [time, value], oldest first, optionally only those from the last
+# `seconds`. Times are seconds since Epoch.
+
+# Define whether readings are cached at all. The resident collector turns this on when it starts the endpoint
+latest_value_cache_enabled = False
+# Define how many of the most recent readings are kept for each field of each device
+latest_value_history_length = 120
+# Define the local address and port the endpoint listens on. Worker processes listen on consecutive ports from it
+latest_value_server_host = "127.0.0.1"
+latest_value_server_port = 8095
+
+# Map each (measurement, device) to its dict of field to a deque of (time in nanoseconds, value) Tuples
+series_history_dict = {}
+latest_value_lock = Lock()
+
+
+# Given a device's dict of field to value and the time in nanoseconds since Epoch it was read, add each field's value
+# to its ring buffer, replacing the oldest reading once the buffer is full. The time defaults to now
+def record_latest_values(measurement, device_name, field_dict, fetch_time_nanoseconds=None):
+    if not latest_value_cache_enabled:
+        return
+    if fetch_time_nanoseconds is None:
+        fetch_time_nanoseconds = time_ns()
+    with latest_value_lock:
+        field_history_dict = series_history_dict.setdefault((measurement, device_name), {})
+        for field_key, value in field_dict.items():
+            # Decimals aren't JSON types, and a float carries every value the collectors produce
+            if isinstance(value, Decimal):
+                value = float(value)
+            field_history = field_history_dict.get(field_key)
+            if field_history is None:
+                field_history = field_history_dict[field_key] = deque(maxlen=latest_value_history_length)
+            field_history.append((fetch_time_nanoseconds, value))
+
+
+# Convert a time in nanoseconds since Epoch to the seconds returned by the endpoint
+def to_epoch_seconds(time_nanoseconds):
+    return round(time_nanoseconds / 1e9, 3)
+
+
+# Get the newest value of every field of every device, optionally only for one measurement and device, as a dict of
+# measurement to device to field to [time, value]
+def get_latest_values(measurement=None, device_name=None):
+    latest_value_dict = {}
+    with latest_value_lock:
+        for (series_measurement, series_device_name), field_history_dict in series_history_dict.items():
+            if measurement is not None and series_measurement != measurement:
+                continue
+            if device_name is not None and series_device_name != device_name:
+                continue
+            latest_value_dict.setdefault(series_measurement, {})[series_device_name] = {
+                field_key: [to_epoch_seconds(field_history[-1][0]), field_history[-1][1]]
+                for field_key, field_history in field_history_dict.items()}
+    return latest_value_dict
+
+
+# Get the buffered readings of one field of one device as a list of [time, value], oldest first, optionally only those
+# read in the last given number of seconds. Returns None if the field has never been read
+def get_field_history(measurement, device_name, field_key, seconds=None):
+    with latest_value_lock:
+        field_history = series_history_dict.get((measurement, device_name), {}).get(field_key)
+        if field_history is None:
+            return None
+        reading_list = list(field_history)
+    if seconds is not None:
+        earliest_time = time_ns() - int(seconds * 1e9)
+        reading_list = [reading for reading in reading_list if reading[0] >= earliest_time]
+    return [[to_epoch_seconds(reading_time), value] for reading_time, value in reading_list]
+
+
+# Handler answering the endpoint's GET requests with JSON
+class LatestValueRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status_code, body):
+        body_bytes = json.dumps(body, separators=(",", ":")).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body_bytes)))
+        self.end_headers()
+        self.wfile.write(body_bytes)
+
+    def do_GET(self):
+        parsed_url = urlparse(self.path)
+        # Each parameter is only expected once, so take its first value
+        parameter_dict = {key: value_list[0] for key, value_list in parse_qs(parsed_url.query).items()}
+        if parsed_url.path == "/latest":
+            self.send_json(200, get_latest_values(parameter_dict.get("measurement"), parameter_dict.get("device")))
+            return
+        if parsed_url.path == "/history":
+            missing_parameter_list = [key for key in ("measurement", "device", "field") if key not in parameter_dict]
+            if len(missing_parameter_list) > 0:
+                self.send_json(400, {"error": "missing parameter(s) {}".format(", ".join(missing_parameter_list))})
+                return
+            try:
+                seconds = float(parameter_dict["seconds"]) if "seconds" in parameter_dict else None
+            except ValueError:
+                self.send_json(400, {"error": "seconds must be a number"})
+                return
+            reading_list = get_field_history(parameter_dict["measurement"], parameter_dict["device"],
+                                             parameter_dict["field"], seconds)
+            if reading_list is None:
+                self.send_json(404, {"error": "no readings for that measurement, device, and field"})
+                return
+            self.send_json(200, reading_list)
+            return
+        self.send_json(404, {"error": "unknown path, expected /latest or /history"})
+
+    # Keep the collector's output readable by not logging each request
+    def log_message(self, *_):
+        pass
+
+
+# Turn on caching and start the endpoint in a background thread, returning the server. The port is offset by the
+# worker index, so each worker process of the resident collector serves its own devices. Raises OSError if the port
+# can't be bound, leaving caching off
+def start_latest_value_server(port_offset=0):
+    global latest_value_cache_enabled
+    server = ThreadingHTTPServer((latest_value_server_host, latest_value_server_port + port_offset),
+                                 LatestValueRequestHandler)
+    latest_value_cache_enabled = True
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="latest-value-server", daemon=True).start()
+    print("Serving latest values at http://{}:{}/latest".format(latest_value_server_host, server.server_port))
+    return server
@@ -0,0 +1,99 @@
+from decimal import Decimal
+from functools import lru_cache
+from math import isfinite
+
+# Shared encoder for InfluxDB Line Protocol, which is `measurement,tag=value field=value,field2=value2 timestamp`
+# https://docs.influxdata.com/influxdb/v2/reference/syntax/line-protocol/
+# Measurement names, tag keys, tag values and field keys have their special characters escaped, and field values are
+# typed: floats and Decimals are written plainly, ints get an `i` suffix, bools become true/false, and Strings are
+# quoted. Collectors whose fields have always been stored as floats must therefore pass floats rather than ints, since
+# InfluxDB rejects a field whose type changes.
+# The measurement and tags of each device are encoded once into a series prefix that is reused for every point.
+
+# Translation tables for the characters that must be backslash-escaped in each part of a line
+measurement_escape_table = str.maketrans({",": "\\,", " ": "\\ ", "\n": "\\n"})
+key_escape_table = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ ", "\n": "\\n"})
+string_field_escape_table = str.maketrans({"\"": "\\\"", "\\": "\\\\"})
+
+# Field keys repeat on every point, so each one is escaped (along with its trailing `=`) only once
+escaped_field_key_cache = {}
+float_repr = float.__repr__
+
+
+# Escape a measurement name
+def escape_measurement(measurement):
+    return str(measurement).translate(measurement_escape_table)
+
+
+# Escape a tag key, tag value, or field key
+def escape_key(key):
+    return str(key).translate(key_escape_table)
+
+
+# Given a field value, return its Line Protocol representation, or None if it can't be represented (NaN or infinity)
+def encode_field_value(value):
+    # Check bool before int, since bool is a subclass of int
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "{}i".format(value)
+    if isinstance(value, float):
+        return float_repr(value) if isfinite(value) else None
+    if isinstance(value, Decimal):
+        return repr(float(value)) if value.is_finite() else None
+    return "\"{}\"".format(str(value).translate(string_field_escape_table))
+
+
+# Given a dict of field name to value, return the field set such as `field=1.0,field2="text"`, skipping any field
+# whose value can't be represented
+def encode_field_set(field_dict):
+    field_string_list = []
+    for field_key, field_value in field_dict.items():
+        # Floats are by far the most common value, so handle them inline rather than through encode_field_value.
+        # Subtracting a float from itself only gives a non-zero result (NaN) for NaN and infinity
+        if type(field_value) is float:
+            if field_value - field_value != 0:
+                continue
+            encoded_value = float_repr(field_value)
+        else:
+            encoded_value = encode_field_value(field_value)
+            if encoded_value is None:
+                continue
+        escaped_field_key = escaped_field_key_cache.get(field_key)
+        if escaped_field_key is None:
+            escaped_field_key = escaped_field_key_cache.setdefault(field_key, escape_key(field_key) + "=")
+        field_string_list.append(escaped_field_key + encoded_value)
+    return ",".join(field_string_list)
+
+
+# Given a measurement name and a list of (tag key, tag value) Tuples, return the escaped `measurement,tag=value` prefix
+# shared by every point in that series. Tags are sorted by key, which is the order InfluxDB prefers. Each device's
+# prefix is only built once and then served from the cache, so tag_tuples must be a Tuple of Tuples
+@lru_cache(maxsize=None)
+def build_series_prefix(measurement, tag_tuples=()):
+    series_prefix_list = [escape_measurement(measurement)]
+    for tag_key, tag_value in sorted(tag_tuples):
+        series_prefix_list.append(escape_key(tag_key) + "=" + escape_key(tag_value))
+    return ",".join(series_prefix_list)
+
+
+# Given a series prefix, a dict of fields, and an optional timestamp, return one line of Line Protocol, or None if
+# there are no fields that can be written, since a line with no fields is invalid
+def encode_point(series_prefix, field_dict, timestamp=None):
+    field_set = encode_field_set(field_dict)
+    if len(field_set) < 1:
+        return None
+    if timestamp is None:
+        return series_prefix + " " + field_set
+    return series_prefix + " " + field_set + " " + str(timestamp)
+
+
+# Given an iterable of (series prefix, field dict, timestamp) Tuples, encode them in a single pass into a list of
+# Line Protocol lines, leaving out points that had no fields that could be written
+def encode_points(point_tuples):
+    line_protocol_string_list = []
+    for series_prefix, field_dict, timestamp in point_tuples:
+        line = encode_point(series_prefix, field_dict, timestamp)
+        if line is not None:
+            line_protocol_string_list.append(line)
+    return line_protocol_string_list
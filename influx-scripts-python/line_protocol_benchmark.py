@@ -0,0 +1,74 @@
+import argparse
+from time import perf_counter, time
+
+from line_protocol import build_series_prefix, encode_points
+
+# Microbenchmark for the shared Line Protocol encoder, so encoding throughput is measured rather than assumed.
+# Encodes a batch of Tasmota-shaped points spread across a number of devices, alongside the repeated `str.format`
+# approach the collectors used before, and prints the time and points per second of each.
+# Run with `pipenv run python3 line_protocol_benchmark.py --points 1000000`
+
+# A representative field set, matching the fields a Tasmota plug reports each cycle
+sample_field_dict = {"kilowattHours": 123.456,
+                     "voltage": 121.0,
+                     "powerFactor": 0.98,
+                     "watts": 57.0,
+                     "amps": 0.47,
+                     "voltAmps": 58.0,
+                     "uptime": 864000.0,
+                     "powerState": 1.0}
+
+
+# Encode every point the way the collectors used to, one `str.format` call per field and per line
+def encode_points_with_format(point_tuples):
+    line_protocol_string_list = []
+    for measurement, device_name, field_dict, timestamp in point_tuples:
+        field_list = []
+        for key in field_dict:
+            field_list.append("{}={}".format(key, field_dict[key]))
+        line_protocol_string_list.append("{},device={} {} {}".format(measurement, device_name, ",".join(field_list),
+                                                                     timestamp))
+    return line_protocol_string_list
+
+
+# Time one encoding function over the given input, returning the elapsed seconds and the encoded output
+def time_encoding(encode_function, point_tuples):
+    start_time = perf_counter()
+    line_protocol_string_list = encode_function(point_tuples)
+    return perf_counter() - start_time, line_protocol_string_list
+
+
+# Print the results of one timed run
+def print_result(label, point_count, elapsed_seconds, line_protocol_string_list):
+    encoded_bytes = sum(len(line) for line in line_protocol_string_list) + len(line_protocol_string_list)
+    print("{:<24} {:>9.3f} s {:>12,.0f} points/s {:>8.1f} MB/s".format(label, elapsed_seconds,
+                                                                     point_count / elapsed_seconds,
+                                                                     encoded_bytes / elapsed_seconds / 1e6))
+
+
+def run_benchmark(point_count, device_count):
+    epoch_time_seconds = int(time())
+    device_name_list = ["device{}".format(device_index) for device_index in range(device_count)]
+    # Vary one field per point so values aren't all identical
+    field_dict_list = [dict(sample_field_dict, watts=float(point_index % 1500)) for point_index in range(device_count)]
+    print("Encoding {:,} points across {:,} devices".format(point_count, device_count))
+
+    shared_point_tuples = [(build_series_prefix("tasmota", (("device", device_name_list[point_index % device_count]),)),
+                            field_dict_list[point_index % device_count], epoch_time_seconds)
+                           for point_index in range(point_count)]
+    elapsed_seconds, line_protocol_string_list = time_encoding(encode_points, shared_point_tuples)
+    print_result("line_protocol encoder", point_count, elapsed_seconds, line_protocol_string_list)
+
+    format_point_tuples = [("tasmota", device_name_list[point_index % device_count],
+                            field_dict_list[point_index % device_count], epoch_time_seconds)
+                           for point_index in range(point_count)]
+    elapsed_seconds, line_protocol_string_list = time_encoding(encode_points_with_format, format_point_tuples)
+    print_result("str.format per field", point_count, elapsed_seconds, line_protocol_string_list)
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Benchmark Line Protocol encoding throughput")
+    argument_parser.add_argument("--points", type=int, default=1_000_000, help="number of points to encode")
+    argument_parser.add_argument("--devices", type=int, default=100, help="number of distinct devices (series)")
+    arguments = argument_parser.parse_args()
+    run_benchmark(arguments.points, arguments.devices)
@@ -0,0 +1,64 @@
+from hashlib import sha1
+from time import monotonic, sleep, time
+
+# Deterministic phase offsets replacing random jitter. Each collector is given a stable slot within the start of every
+# interval, and each device a stable slot within the start of its collector's cycle, both hashed from their names. The
+# same name always lands on the same slot in every process and on every host, so collectors and devices are spread
+# evenly across the window rather than colliding by chance, and the load each puts on the network and on InfluxDB is
+# the same from one interval to the next.
+
+# Define the window at the start of each interval that collectors are spread across, matching the old 0-10 second jitter
+collector_phase_window_seconds = 10
+# Define the window at the start of a collector's cycle that its devices are spread across
+device_phase_window_seconds = 1
+# Define the interval a collector started from cron runs on
+cron_interval_seconds = 60
+
+
+# Given a name, get its stable position within any window as a fraction from 0 up to 1. A hash of the name is used
+# rather than hash(), which is salted differently in every process
+def get_phase_fraction(name):
+    return int(sha1(name.encode("utf-8")).hexdigest()[:8], 16) / 2 ** 32
+
+
+# Get how many seconds into each interval a collector's slot starts
+def get_collector_phase_offset_seconds(collector_name, interval_seconds=None):
+    if interval_seconds is None:
+        interval_seconds = cron_interval_seconds
+    return get_phase_fraction(collector_name) * min(collector_phase_window_seconds, interval_seconds)
+
+
+# Get how many seconds into its collector's cycle a device's slot starts
+def get_device_phase_offset_seconds(collector_name, device_key):
+    return get_phase_fraction("{}/{}".format(collector_name, device_key)) * device_phase_window_seconds
+
+
+# Get the wall-clock time of a collector's next slot, which is now if the slot in the current interval is under way
+def get_next_collector_phase_time(collector_name, interval_seconds=None):
+    if interval_seconds is None:
+        interval_seconds = cron_interval_seconds
+    current_time = time()
+    phase_time = current_time - current_time % interval_seconds + get_collector_phase_offset_seconds(collector_name,
+                                                                                                    interval_seconds)
+    return max(phase_time, current_time)
+
+
+# Wait for a collector's slot in the current interval, such as when a collector is started from cron at the top of the
+# minute. A collector started after its slot has passed runs right away rather than waiting for the next interval
+def wait_for_collector_phase(collector_name, interval_seconds=None):
+    wait_seconds = get_next_collector_phase_time(collector_name, interval_seconds) - time()
+    print("Waiting {:.2f} second(s) for the phase slot of {} before executing".format(wait_seconds, collector_name))
+    if wait_seconds > 0:
+        sleep(wait_seconds)
+
+
+# Get how many seconds are left until a device's slot, given the monotonic time its collector's cycle started
+def get_device_phase_delay_seconds(collector_name, device_key, cycle_start_time):
+    return max(0.0, cycle_start_time + get_device_phase_offset_seconds(collector_name, device_key) - monotonic())
+
+
+# Wait for a device's slot, given the monotonic time its collector's cycle started
+def wait_for_device_phase(collector_name, device_key, cycle_start_time):
+    delay_seconds = get_device_phase_delay_seconds(collector_name, device_key, cycle_start_time)
+    if delay_seconds > 0:
+        sleep(delay_seconds)
@@ -0,0 +1,62 @@
+import gzip
+import json
+import os
+from threading import Lock
+from time import time_ns
+
+from device_inventory import get_collector_file_name
+
+# Optional capture of the raw responses collectors fetch, before any parsing, so they can be replayed through the
+# parsers offline with response_replay.py. Each collector appends to its own gzip file of JSON lines, one line per
+# response holding the time it was fetched in nanoseconds since Epoch, the device, and the data. Responses are held in
+# memory during a cycle and appended once at its end as a new gzip member, which gzip readers treat as one stream, so
+# a recording can keep growing across runs without being rewritten.
+
+# Define whether responses are recorded at all
+response_recording_enabled = False
+# Define where the recordings are stored, next to the scripts themselves
+response_recording_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings")
+
+# Map each collector name to its list of recorded response dicts not yet appended to its file
+pending_response_dict = {}
+response_recording_lock = Lock()
+
+
+# Get the path of the recording for a collector
+def get_recording_file_path(collector_name):
+    return os.path.join(response_recording_directory, "{}.jsonl.gz".format(get_collector_file_name(collector_name)))
+
+
+# Hold one response from a device to be appended at the end of the cycle. The data must be made of JSON types, such as
+# the response text or a list of SNMP (OID, value) pairs. The time defaults to now
+def record_response(collector_name, device_key, data, fetch_time_nanoseconds=None):
+    if not response_recording_enabled:
+        return
+    if fetch_time_nanoseconds is None:
+        fetch_time_nanoseconds = time_ns()
+    with response_recording_lock:
+        pending_response_dict.setdefault(collector_name, []).append({"time": fetch_time_nanoseconds,
+                                                                     "device": device_key, "data": data})
+
+
+# Append a collector's responses held since the last save to its recording
+def save_recorded_responses(collector_name):
+    with response_recording_lock:
+        response_list = pending_response_dict.pop(collector_name, None)
+    if not response_list:
+        return
+    os.makedirs(response_recording_directory, exist_ok=True)
+    with gzip.open(get_recording_file_path(collector_name), "at", encoding="utf-8") as recording_file:
+        for response in response_list:
+            recording_file.write(json.dumps(response, separators=(",", ":")) + "\n")
+
+
+# Read a recording back, yielding a Tuple of (fetch time in nanoseconds, device, data) for each response in the order
+# they were recorded. Defaults to the recording of the named collector
+def read_recorded_responses(collector_name, recording_file_path=None):
+    if recording_file_path is None:
+        recording_file_path = get_recording_file_path(collector_name)
+    with gzip.open(recording_file_path, "rt", encoding="utf-8") as recording_file:
+        for line in recording_file:
+            response = json.loads(line)
+            yield response["time"], response["device"], response["data"]
@@ -0,0 +1,133 @@
+import argparse
+import glob
+import json
+import os
+import sys
+from contextlib import redirect_stdout
+from time import perf_counter
+
+import apc
+import esp
+import response_recorder
+import tasmota
+import ubiquiti
+import unraid
+
+# Offline replay of the raw responses captured by response_recorder, fed through each collector's parser as fast as
+# possible with no network. Reports the responses and fields parsed per second for each collector, which gives a
+# throughput benchmark against real production data, and can dump every parsed field set so a parser change can be
+# checked by diffing the dump from before and after it. The parsers' own printing is silenced while timing.
+# Record by setting `response_recording_enabled = True` in response_recorder.py, then run with
+# `pipenv run python3 response_replay.py esp tasmota --repeat 100`
+
+
+# Count the fields in a parsed result, which for Unraid is a dict of each type to its dict of fields
+def count_unraid_fields(type_to_field_dict):
+    return sum(len(field_dict) for field_dict in type_to_field_dict.values())
+
+
+# This Dict defines, for each collector, the function preparing recorded data for its parser outside of the timing,
+# the parser itself taking the prepared data, and the function counting the fields in what the parser returns
+collector_name_to_replay_tuple = {
+    "esp": (None, esp.parse_response_into_influx_dict, len),
+    "tasmota": (None, tasmota.parse_raw_data_into_field_set, len),
+    "apc": (None, apc.parse_var_binds_into_influx_dict, len),
+    "s16": (None, ubiquiti.parse_data_into_influx_dict, len),
+    "unraid": (unraid.read_recorded_var_binds,
+               lambda var_bind_lists: unraid.parse_var_binds_into_type_dict(*var_bind_lists), count_unraid_fields)}
+
+
+# Parse every prepared response once, returning the list of parsed results, with the Exception in place of any
+# response the parser rejected
+def parse_responses(parse_function, prepared_data_list):
+    parsed_list = []
+    for prepared_data in prepared_data_list:
+        try:
+            parsed_list.append(parse_function(prepared_data))
+        except Exception as parse_error:
+            parsed_list.append(parse_error)
+    return parsed_list
+
+
+# Get the paths of every recording of a collector, including those written by each worker process of the resident
+# collector, such as `esp-worker0.jsonl.gz`
+def find_recording_file_paths(collector_name):
+    recording_directory = glob.escape(response_recorder.response_recording_directory)
+    return sorted(glob.glob(os.path.join(recording_directory, "{}.jsonl.gz".format(collector_name))) +
+                  glob.glob(os.path.join(recording_directory, "{}-worker*.jsonl.gz".format(collector_name))))
+
+
+# Replay one collector's recordings through its parser the given number of times. Returns a Tuple of the collector
+# name, responses, seconds, responses per second, fields per second, and rejected responses, along with the list of
+# (time, device, parsed result) Tuples from the last pass
+def replay_collector(collector_name, recording_file_path_list, repeat_count):
+    prepare_function, parse_function, count_function = collector_name_to_replay_tuple[collector_name]
+    response_tuples = [response_tuple for recording_file_path in recording_file_path_list
+                       for response_tuple in response_recorder.read_recorded_responses(collector_name,
+                                                                                       recording_file_path)]
+    prepared_data_list = [data if prepare_function is None else prepare_function(data)
+                          for _, _, data in response_tuples]
+    with open(os.devnull, "w") as null_output, redirect_stdout(null_output):
+        start_time = perf_counter()
+        for _ in range(repeat_count):
+            parsed_list = parse_responses(parse_function, prepared_data_list)
+        elapsed_seconds = perf_counter() - start_time
+    response_count = len(prepared_data_list) * repeat_count
+    field_count = sum(count_function(parsed) for parsed in parsed_list if not isinstance(parsed, Exception))
+    error_count = sum(1 for parsed in parsed_list if isinstance(parsed, Exception))
+    result_tuple = (collector_name, response_count, elapsed_seconds, response_count / elapsed_seconds,
+                    field_count * repeat_count / elapsed_seconds, error_count * repeat_count)
+    return result_tuple, [(fetch_time, device_key, parsed)
+                          for (fetch_time, device_key, _), parsed in zip(response_tuples, parsed_list)]
+
+
+# Print each parsed result as a line of JSON, with rejected responses as their error, in recorded order
+def dump_parsed_results(collector_name, parsed_tuples):
+    for fetch_time, device_key, parsed in parsed_tuples:
+        result = {"error": repr(parsed)} if isinstance(parsed, Exception) else {"fields": parsed}
+        print(json.dumps(dict(collector=collector_name, time=fetch_time, device=device_key, **result), default=str,
+                         sort_keys=True))
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Replay recorded device responses through the parsers")
+    argument_parser.add_argument("collectors", nargs="*", help="collectors to replay, defaulting to every recording")
+    argument_parser.add_argument("--recording", nargs="+",
+                                 help="recording file(s) to replay, when replaying a single collector")
+    argument_parser.add_argument("--repeat", type=int, default=1, help="number of passes over each recording")
+    argument_parser.add_argument("--dump", action="store_true",
+                                 help="print every parsed field set as JSON lines instead of the timings")
+    arguments = argument_parser.parse_args()
+
+    collector_name_list = arguments.collectors or [collector_name for collector_name in collector_name_to_replay_tuple
+                                                   if len(find_recording_file_paths(collector_name)) > 0]
+    unknown_name_list = [collector_name for collector_name in collector_name_list
+                         if collector_name not in collector_name_to_replay_tuple]
+    if len(unknown_name_list) > 0:
+        sys.exit("Unknown collector(s) {}, expected some of {}".format(unknown_name_list,
+                                                                       list(collector_name_to_replay_tuple)))
+    if arguments.repeat < 1:
+        sys.exit("--repeat must be at least 1")
+    if arguments.recording is not None and len(collector_name_list) != 1:
+        sys.exit("--recording needs exactly one collector to be named")
+    if len(collector_name_list) < 1:
+        sys.exit("No recordings found in {}".format(response_recorder.response_recording_directory))
+    if arguments.recording is None:
+        missing_name_list = [collector_name for collector_name in collector_name_list
+                             if len(find_recording_file_paths(collector_name)) < 1]
+        if len(missing_name_list) > 0:
+            sys.exit("No recordings found for {} in {}".format(missing_name_list,
+                                                               response_recorder.response_recording_directory))
+
+    result_tuples = []
+    for collector_name in collector_name_list:
+        result_tuple, parsed_tuples = replay_collector(collector_name, arguments.recording or
+                                                       find_recording_file_paths(collector_name), arguments.repeat)
+        if arguments.dump:
+            dump_parsed_results(collector_name, parsed_tuples)
+        result_tuples.append(result_tuple)
+    if not arguments.dump:
+        print("{:<10} {:>10} {:>12} {:>14} {:>14} {:>10}".format("collector", "responses", "seconds",
+                                                                 "responses/s", "fields/s", "rejected"))
+        for result_tuple in result_tuples:
+            print("{:<10} {:>10} {:>10.3f} s {:>14,.0f} {:>14,.0f} {:>10}".format(*result_tuple))
@@ -1,5 +1,3 @@
 #!/usr/bin/zsh
 cd /root/influx-scripts-python/
-/root/.pyenv/shims/pipenv run python3 esp.py
-/root/.pyenv/shims/pipenv run python3 tasmota.py
-/root/.pyenv/shims/pipenv run python3 apc.py
\ No newline at end of file
+/root/.pyenv/shims/pipenv run python3 collection_runner.py esp tasmota apc
\ No newline at end of file
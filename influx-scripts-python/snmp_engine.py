@@ -0,0 +1,76 @@
+import asyncio
+import math
+from threading import Lock, Thread
+
+# Shared, persistent SNMP machinery for every SNMP collector in the process. A single SnmpEngine is kept for the life of
+# the process, so the USM state it learns from each agent (engine ID, boots, and time from SNMPv3 discovery) is reused
+# rather than rediscovered on every poll. pysnmp's asyncio API binds its sockets to the event loop they are opened on,
+# so every SNMP coroutine runs on one long-lived event loop in a background thread, which any thread can submit to.
+# pysnmp itself is only imported on first use, to keep it out of process startup.
+
+# Define the response timeout and number of retries for each SNMP request
+snmp_timeout_seconds = 2
+snmp_retries = 2
+# Define the step adaptive timeouts are rounded up to. pysnmp configures a new target address in the engine, which is
+# never removed, for each distinct timeout it is sent with, so timeouts are kept to a few values per device
+snmp_timeout_step_seconds = 0.5
+
+# The event loop, its thread, and the engine are created on first use
+snmp_event_loop = None
+snmp_engine = None
+snmp_engine_lock = Lock()
+# Transport targets resolve their host name when created, so they are kept per address, port, and timeout
+transport_target_cache = {}
+
+
+# Get the event loop that all SNMP work runs on, starting it in a background thread on first use
+def get_snmp_event_loop():
+    global snmp_event_loop
+    with snmp_engine_lock:
+        if snmp_event_loop is None:
+            snmp_event_loop = asyncio.new_event_loop()
+            Thread(target=snmp_event_loop.run_forever, name="snmp-event-loop", daemon=True).start()
+    return snmp_event_loop
+
+
+# Run a coroutine on the SNMP event loop from any other thread, waiting for and returning its result
+def run_snmp_coroutine(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_snmp_event_loop()).result()
+
+
+# Get the process-wide SnmpEngine, creating it on first use
+def get_snmp_engine():
+    global snmp_engine
+    with snmp_engine_lock:
+        if snmp_engine is None:
+            from pysnmp.hlapi.asyncio import SnmpEngine
+            snmp_engine = SnmpEngine()
+    return snmp_engine
+
+
+# Get the transport target for an address and port, resolving the host name only the first time it is used. The
+# timeout of each try can be given to override the default, and is rounded up to the timeout step
+def get_transport_target(ip_address, port_number, timeout_seconds=None):
+    if timeout_seconds is None:
+        timeout_seconds = snmp_timeout_seconds
+    timeout_seconds = math.ceil(timeout_seconds / snmp_timeout_step_seconds) * snmp_timeout_step_seconds
+    transport_target = transport_target_cache.get((ip_address, port_number, timeout_seconds))
+    if transport_target is None:
+        from pysnmp.hlapi.asyncio import UdpTransportTarget
+        transport_target = UdpTransportTarget((ip_address, port_number), timeout=timeout_seconds,
+                                              retries=snmp_retries)
+        transport_target_cache[(ip_address, port_number, timeout_seconds)] = transport_target
+    return transport_target
+
+
+# Forget the transport targets for an address and port, so its host name is resolved again next time
+def forget_transport_target(ip_address, port_number):
+    for cache_key in [cache_key for cache_key in transport_target_cache if cache_key[:2] == (ip_address, port_number)]:
+        transport_target_cache.pop(cache_key, None)
+
+
+# Given a list of OIDs, create the object structure needed by the SNMP library. Build this once and reuse it, since
+# pysnmp resolves each ObjectType against its MIBs the first time it is sent and skips that work afterwards
+def build_object_type_list(oid_list):
+    from pysnmp.hlapi.asyncio import ObjectIdentity, ObjectType
+    return tuple(ObjectType(ObjectIdentity(oid)) for oid in oid_list)
@@ -0,0 +1,89 @@
+import atexit
+from threading import Lock
+
+# Pool of netmiko SSH sessions kept open across polls, so each poll is a single command round trip rather than a full
+# SSH handshake and login. Sessions are keyed by IP and user, checked before each use, and reopened when they have
+# dropped. Each session has its own lock since a session can only run one command at a time, but different devices
+# can be polled in parallel. Every session is disconnected when the process exits.
+# netmiko (and paramiko beneath it) is only imported on first use, to keep it out of process startup.
+
+# Define the port sessions connect to
+ssh_port_number = 22
+
+# Map each (IP, user) to its open session, and to the lock guarding it
+session_dict = {}
+session_lock_dict = {}
+session_pool_lock = Lock()
+
+
+# Get the lock for one device's session, creating it on first use
+def get_session_lock(session_key):
+    with session_pool_lock:
+        session_lock = session_lock_dict.get(session_key)
+        if session_lock is None:
+            session_lock = session_lock_dict[session_key] = Lock()
+            # Register the cleanup once, when the first session is set up
+            if len(session_lock_dict) == 1:
+                atexit.register(close_all_sessions)
+    return session_lock
+
+
+# Disconnect a session, ignoring any error since it is being thrown away regardless
+def disconnect_session(net_connect):
+    try:
+        net_connect.disconnect()
+    except Exception:
+        pass
+
+
+# Get the errors that mean a session is no longer usable and should be replaced with a new one
+def get_session_failure_exceptions():
+    from netmiko.exceptions import NetmikoBaseException, ReadTimeout, SSHException
+    return NetmikoBaseException, ReadTimeout, SSHException, OSError, EOFError
+
+
+# Get an open session for the device, reusing the pooled one if it is still alive or connecting a new one otherwise.
+# Must be called while holding the device's session lock
+def get_live_session(session_key, current_ip, login_user, login_password):
+    net_connect = session_dict.get(session_key)
+    if net_connect is not None and not net_connect.is_alive():
+        print("SSH session to {} has dropped, reconnecting".format(current_ip))
+        disconnect_session(net_connect)
+        net_connect = None
+    if net_connect is None:
+        from netmiko import ConnectHandler
+        # Use the `terminal_server` device type to avoid netmiko preconfigured setups to automatically run `configure`
+        # or `enable terminal` the way most devices need
+        net_connect = ConnectHandler(device_type='terminal_server', ip=current_ip, port=ssh_port_number,
+                                     username=login_user, password=login_password)
+        session_dict[session_key] = net_connect
+    return net_connect
+
+
+# Given a device's IP and user/pass, run one command over its pooled session and return the output. If the command
+# fails on a reused session, the session is replaced and the command tried once more on a fresh connection
+def send_command(current_ip, login_user, login_password, command):
+    session_key = (current_ip, login_user)
+    session_failure_exceptions = get_session_failure_exceptions()
+    with get_session_lock(session_key):
+        for attempt_number in (1, 2):
+            net_connect = get_live_session(session_key, current_ip, login_user, login_password)
+            try:
+                return net_connect.send_command(command)
+            except session_failure_exceptions as session_error:
+                session_dict.pop(session_key, None)
+                disconnect_session(net_connect)
+                if attempt_number == 2:
+                    raise
+                print("SSH command to {} failed, retrying on a new session: {}".format(current_ip, session_error))
+
+
+# Disconnect every pooled session
+def close_all_sessions():
+    with session_pool_lock:
+        session_key_list = list(session_dict)
+    for session_key in session_key_list:
+        with get_session_lock(session_key):
+            net_connect = session_dict.pop(session_key, None)
+            if net_connect is not None:
+                disconnect_session(net_connect)
@@ -0,0 +1,98 @@
+import argparse
+import subprocess
+import sys
+
+# Startup profiling mode, reporting how long each entry point takes to import and how long each of the heavy
+# dependencies it loads on first use takes to initialize. Every entry point is measured in a fresh interpreter using
+# Python's own `-X importtime`, so the numbers reflect a cold run from cron rather than an already-warm process.
+# Exits with a non-zero status if an entry point's own import goes over its budget, so slow imports don't creep back in.
+# Run with `pipenv run python3 startup_profiler.py` or name entry points such as `startup_profiler.py esp tasmota`
+
+# These Tuples define each entry point module and the heavy dependencies it loads lazily once it fetches or writes
+entry_point_dependency_tuples = [("esp", ["requests", "influxdb_client"]),
+                                 ("tasmota", ["requests", "influxdb_client"]),
+                                 ("apc", ["pysnmp.hlapi.asyncio", "influxdb_client"]),
+                                 ("ubiquiti", ["netmiko", "influxdb_client"]),
+                                 ("unraid", ["pysnmp.hlapi.asyncio", "influxdb_client"]),
+                                 ("collection_runner", ["requests", "pysnmp.hlapi.asyncio", "netmiko",
+                                                        "influxdb_client"]),
+                                 ("collector_daemon", ["requests", "pysnmp.hlapi.asyncio", "netmiko",
+                                                       "influxdb_client"])]
+# Define the most time an entry point's own import may take, before any of its dependencies are loaded
+entry_point_import_budget_milliseconds = 150
+# Define how many of the slowest nested imports to list for each entry point
+slowest_import_count = 5
+
+
+# Given the stderr of `python -X importtime`, return a list of (cumulative microseconds, nesting depth, module name)
+# for every imported module. Each line looks like `import time:  self [us] | cumulative | <indent>module.name`
+def parse_import_time_output(import_time_output):
+    import_time_tuples = []
+    for line in import_time_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_string, indented_module_name = line[len("import time:"):].split("|")
+        module_name = indented_module_name.strip()
+        nesting_depth = (len(indented_module_name) - len(indented_module_name.lstrip()) - 1) // 2
+        import_time_tuples.append((int(cumulative_string), nesting_depth, module_name))
+    return import_time_tuples
+
+
+# Import the given modules one after another in a fresh interpreter, returning the parsed import times
+def measure_imports(module_name_list):
+    import_statements = ";".join("import {}".format(module_name) for module_name in module_name_list)
+    completed_process = subprocess.run([sys.executable, "-X", "importtime", "-c", import_statements],
+                                       capture_output=True, text=True)
+    if completed_process.returncode != 0:
+        raise RuntimeError("Could not import {}: {}".format(module_name_list, completed_process.stderr.strip()))
+    return parse_import_time_output(completed_process.stderr)
+
+
+# Find the cumulative import time of a top-level import, which is 0 if an earlier import already loaded it
+def find_top_level_milliseconds(import_time_tuples, module_name):
+    for cumulative_microseconds, nesting_depth, imported_module_name in import_time_tuples:
+        if nesting_depth == 0 and imported_module_name == module_name:
+            return cumulative_microseconds / 1000
+    return 0.0
+
+
+# Profile one entry point, printing its import time, the slowest modules it pulled in, and the first-use cost of each
+# of its lazily loaded dependencies. Returns True if the entry point's import is within budget
+def profile_entry_point(entry_point_name, dependency_list):
+    import_time_tuples = measure_imports([entry_point_name] + dependency_list)
+    entry_point_milliseconds = find_top_level_milliseconds(import_time_tuples, entry_point_name)
+    within_budget = entry_point_milliseconds <= entry_point_import_budget_milliseconds
+    print("\n{}: import {:.1f} ms (budget {} ms){}".format(entry_point_name, entry_point_milliseconds,
+                                                            entry_point_import_budget_milliseconds,
+                                                            "" if within_budget else " OVER BUDGET"))
+    # Modules are listed after everything they import, so the entry point's direct imports are the depth 1 lines
+    # between it and the previous top-level line
+    entry_point_index = next(index for index, import_time_tuple in enumerate(import_time_tuples)
+                             if import_time_tuple[1] == 0 and import_time_tuple[2] == entry_point_name)
+    nested_import_tuples = []
+    for import_time_tuple in reversed(import_time_tuples[:entry_point_index]):
+        if import_time_tuple[1] == 0:
+            break
+        if import_time_tuple[1] == 1:
+            nested_import_tuples.append(import_time_tuple)
+    for cumulative_microseconds, _, module_name in sorted(nested_import_tuples, reverse=True)[:slowest_import_count]:
+        print("  imports {:<40} {:>8.1f} ms".format(module_name, cumulative_microseconds / 1000))
+    # Report what each lazily loaded dependency adds the first time it is needed
+    total_milliseconds = entry_point_milliseconds
+    for dependency_name in dependency_list:
+        dependency_milliseconds = find_top_level_milliseconds(import_time_tuples, dependency_name)
+        total_milliseconds += dependency_milliseconds
+        print("  first use of {:<35} {:>8.1f} ms".format(dependency_name, dependency_milliseconds))
+    print("  total for a full run {:>36.1f} ms".format(total_milliseconds))
+    return within_budget
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description="Report startup import and initialization time")
+    argument_parser.add_argument("entry_points", nargs="*", help="entry points to profile, defaulting to all of them")
+    arguments = argument_parser.parse_args()
+    all_within_budget = True
+    for name, dependencies in entry_point_dependency_tuples:
+        if len(arguments.entry_points) < 1 or name in arguments.entry_points:
+            all_within_budget = profile_entry_point(name, dependencies) and all_within_budget
+    sys.exit(0 if all_within_budget else 1)
@@ -1,25 +1,21 @@
-from json import loads
-from random import randint
-from time import time, sleep
-
-from requests import RequestException, get
-
-from influx_writer import send_data_to_influx
-
-# These Tuples define the IP address from which to fetch data and the host string stored in InfluxDB for each.
-# This way, if the IP address changes, an update can be made to keep the data going to the same tag in Influx
-ip_addresses_to_influx_hosts = [("lamp.brad", "lamp"),
-                                ("tv.brad", "tv"),
-                                ("hvac1.brad", "hvac1"),
-                                ("hvac2.brad", "hvac2"),
-                                ("fridge.brad", "fridge"),
-                                ("blanket.brad", "blanket"),
-                                ("kitchen1.brad", "kitchen"),
-                                ("server-switch.brad", "server"),
-                                ("ct-desk.brad", "ctdesk"),
-                                ("jb-desk.brad", "jbdesk"),
-                                ("heater", "heater"),
-                                ("kitchen2.brad", "kitchen2")]
+from json import JSONDecoder
+from time import perf_counter
+
+from collector_stats import increment_stat, set_duration_stat
+from deadband_filter import filter_unchanged_fields, hold_values_until_written
+from device_health import fetch_all_with_device_health
+from device_inventory import get_assigned_devices
+from fetch_engine import fetch_url_text
+from influx_writer import close_influx_writer, get_precision_timestamp, send_data_to_influx
+from latest_value_cache import record_latest_values
+from line_protocol import build_series_prefix, encode_point
+from phase_scheduler import wait_for_collector_phase
+from response_recorder import record_response, save_recorded_responses
+from window_aggregator import add_field_samples, drain_window_aggregates
+
+# These Tuples define the IP address from which to fetch data and the host string stored in InfluxDB for each, taken
+# from the "tasmota" devices in the inventory that this process polls
+ip_addresses_to_influx_hosts = get_assigned_devices("tasmota")
 
 # These Tuples define the names of the fields in InfluxDB, and the Tasmota-reported field names they are derived from.
 influx_fields_to_http_fields = [("kilowattHours", "StatusSNS.ENERGY.Total"),
@@ -30,12 +26,31 @@ influx_fields_to_http_fields = [("kilowattHours", "StatusSNS.ENERGY.Total"),
                                 ("voltAmps", "StatusSNS.ENERGY.ApparentPower"),
                                 ("uptime", "StatusSTS.UptimeSec"),
                                 ("powerState", "Status.Power")]
+# This Dict defines the optional deadband of Influx fields, as described in deadband_filter.py. The spiky watts and
+# amps aren't listed, so they are written every time
+influx_field_deadbands = {"kilowattHours": (0.01, None),
+                          "voltage": (1, None),
+                          "powerFactor": (0.02, None),
+                          "uptime": (3600, None)}
+# These Influx fields are also sampled between writes when the resident collector has high-frequency sampling on, and
+# are written with their minimum, maximum, and mean over each window as extra fields such as `wattsMax`
+influx_fields_to_aggregate = ["watts", "amps"]
+
+# Define whether to request only the status sections the fields above are read from, rather than `Status 0` with every
+# section. `Status` holds Status with the relay state, `Status 8` holds StatusSNS and `Status 11` holds StatusSTS.
+# Their responses are a fraction of the size of `Status 0`, at the cost of more requests to each plug over its
+# keep-alive connection. The relay state is read from `Status.Power` rather than StatusSTS, since plugs with several
+# relays report `POWER1`, `POWER2` and so on there instead of `POWER`
+request_needed_sections_only = False
+all_sections_status_command_list = ["Status 0"]
+needed_sections_status_command_list = ["Status", "Status 8", "Status 11"]
 
 
-# Given a JSON blob and a dot.separated.path to the key of the desired value, fetch that value or return an error
+# Given a JSON blob and a dot.separated.path to the key of the desired value, fetch that value or return an error. The
+# path can also be given already split into a tuple of keys, as the precompiled field paths are
 def fetch_value_from_json(json, search_string):
     # Split the search_string into a List
-    search_term_list = search_string.split(".")
+    search_term_list = search_string.split(".") if isinstance(search_string, str) else search_string
     # Traverse the List one level at a time, throwing an error if the value doesn't exist
     filtered_json = json
     for search_term in search_term_list:
@@ -44,64 +59,157 @@ def fetch_value_from_json(json, search_string):
     return filtered_json
 
 
-# Given an IP address, fetch its HTTP response
-def fetch_data_from_ip(ip_address):
-    # Form the URL and limit the HTTP GET to 5 seconds before timing out
-    response = get("http://{}/cm?cmnd=Status%200".format(ip_address), timeout=5)
-    return response.text
+# Given the field Tuples, split each dot.separated.path once up front, returning Tuples of Influx field, the original
+# path for logging, the top-level section the value lives in, and the keys beneath that section
+def compile_field_paths(field_tuple_list):
+    compiled_path_list = []
+    for influx_field, http_field in field_tuple_list:
+        section_name, *key_list = http_field.split(".")
+        compiled_path_list.append((influx_field, http_field, section_name, tuple(key_list)))
+    return tuple(compiled_path_list)
+
+
+compiled_field_paths = compile_field_paths(influx_fields_to_http_fields)
+# The top-level sections any field is read from, in the order first needed
+needed_section_names = tuple(dict.fromkeys(section_name for _, _, section_name, _ in compiled_field_paths))
+json_decoder = JSONDecoder()
+
 
+# Given an IP address, fetch its HTTP response, optionally with a timeout other than the default. When only the needed
+# sections are requested, each command's response is fetched in turn and the JSON documents are returned joined by
+# newlines
+def fetch_data_from_ip(ip_address, timeout=None):
+    status_command_list = needed_sections_status_command_list if request_needed_sections_only \
+        else all_sections_status_command_list
+    response_text_list = []
+    for status_command in status_command_list:
+        # Form the URL and fetch it over the shared keep-alive Session, which limits the HTTP GET before timing out
+        url = "http://{}/cm?cmnd={}".format(ip_address, status_command.replace(" ", "%20"))
+        response_text_list.append(fetch_url_text(url, timeout))
+    return "\n".join(response_text_list)
 
-# Given the String representation of the Tasmota data, parse through it and return the Line Protocol version
+
+# Given the String representation of the Tasmota data, decode only the named top-level sections, returning a dict of
+# section name to its decoded JSON. Each section is found by its quoted key and decoded from there on its own, so the
+# Wi-Fi, firmware, memory and network sections of `Status 0` are never parsed. Top-level section names don't repeat
+# anywhere else in Tasmota's output, so this works the same across several joined responses
+def extract_json_sections(data_string, section_name_list):
+    section_dict = {}
+    for section_name in section_name_list:
+        key_string = '"{}":'.format(section_name)
+        key_index = data_string.find(key_string)
+        if key_index < 0:
+            continue
+        # Skip any whitespace after the colon, since the decoder must start at the value itself
+        value_index = key_index + len(key_string)
+        while data_string[value_index:value_index + 1].isspace():
+            value_index += 1
+        section_dict[section_name], _ = json_decoder.raw_decode(data_string, value_index)
+    return section_dict
+
+
+# Given the String representation of the Tasmota data, parse through it and return a dict of Influx field to value
 def parse_raw_data_into_field_set(data_string):
-    line_protocol_list = []
-    # Convert to JSON
-    json_data = loads(data_string)
-    # Iterate through influx_fields_to_http_fields, using each entry's JSON search string and Influx field name
-    for influx_field, http_field in influx_fields_to_http_fields:
+    field_dict = {}
+    # Convert only the sections holding a field to JSON
+    section_dict = extract_json_sections(data_string, needed_section_names)
+    # Iterate through the precompiled paths, using each entry's section and keys and Influx field name
+    for influx_field, http_field, section_name, key_tuple in compiled_field_paths:
         try:
             # Get the data value, if it exists
-            data_value = fetch_value_from_json(json_data, http_field)
+            data_value = fetch_value_from_json(section_dict[section_name], key_tuple)
         except KeyError:
             # Don't exit on an Exception when parsing JSON, rather skipping the current entry
             print("Could not find value for {}, skipping Influx value {}".format(http_field, influx_field))
             continue
-        # Add the key/value pair to a running String consisting of the line protocol data
-        line_protocol_list.append("{}={}".format(influx_field, data_value))
-    # Return the various key/value pairs, separated by commas as Line Protocol dictates
-    return ",".join(line_protocol_list)
+        # Add the key/value pair to the dict as a float, which is the type every Tasmota field has always had in Influx
+        try:
+            field_dict[influx_field] = float(data_value)
+        except (TypeError, ValueError):
+            print("Could not convert {} value [{}] to a float, skipping Influx value {}".format(http_field, data_value,
+                                                                                              influx_field))
+    return field_dict
 
 
-# Main method to retrieve data from multiple Tasmota devices and write Line Protocol data to InfluxDB
-def collect_and_write_tasmota_readings():
+# Main method to retrieve data from multiple Tasmota devices, returning the Line Protocol without writing it
+def collect_tasmota_readings():
     # Instantiate a list used to store lines of Line Protocol to write to Influx
     line_protocol_string_list = []
-    # Get the current time since Epoch in seconds, used to set the record time of data going into Influx
-    epoch_time_seconds = int(time())
-    # Iterate through each tuple of IP/address and Influx host name
-    for current_ip, influx_host_name in ip_addresses_to_influx_hosts:
-        try:
-            # Get the data from the current IP, leaving it as a string
-            data = fetch_data_from_ip(current_ip)
-            # Convert the Influx field name dict into a Line Protocol string, but just the data at this point
-            line_protocol_field_set = parse_raw_data_into_field_set(data)
-        except RequestException:
+    # Fetch from every IP/address at once, leaving each as a string, so the cycle only takes as long as the slowest one.
+    # Unplugged devices are skipped while their circuit breaker is open, rather than costing the full timeout each run.
+    # Each device starts in its own phase slot, and the time its response arrived is kept as the time of its record
+    fetched_data_list, fetch_time_list = fetch_all_with_device_health("tasmota", fetch_data_from_ip,
+                                                                      [current_ip for current_ip, _ in
+                                                                       ip_addresses_to_influx_hosts])
+    # Iterate through each tuple of IP/address and Influx host name alongside the data fetched from it
+    for (current_ip, influx_host_name), data, fetch_time in zip(ip_addresses_to_influx_hosts, fetched_data_list,
+                                                                fetch_time_list):
+        if isinstance(data, Exception):
             # Don't exit on an Exception when getting data, rather skipping the current IP
-            print("Could not connect/fetch from IP {}, skipping".format(current_ip))
+            print("Could not connect/fetch from IP {}, skipping. Error was {}".format(current_ip, data))
+            continue
+        record_response("tasmota", current_ip, data, fetch_time)
+        # Convert the data into a dict of Influx field name to value
+        parse_start_time = perf_counter()
+        field_dict = parse_raw_data_into_field_set(data)
+        set_duration_stat("tasmota", current_ip, "parseMilliseconds", perf_counter() - parse_start_time)
+        record_latest_values("tasmota", influx_host_name, field_dict, fetch_time)
+        # Add the aggregates of any samples taken since the last write
+        field_dict.update(drain_window_aggregates("tasmota", influx_host_name, field_dict, influx_fields_to_aggregate))
+        # Drop the fields that haven't changed beyond their deadband, skipping this IP if that leaves none
+        if len(field_dict) > 0:
+            field_dict = filter_unchanged_fields("tasmota", influx_host_name, field_dict, influx_field_deadbands)
+            if len(field_dict) < 1:
+                print("No field from IP {} changed beyond its deadband, skipping submission".format(current_ip))
+                continue
+        # Encode the Line Protocol, forming together the measurement, tags, field set, and time
+        line_protocol_full_string = encode_point(build_series_prefix("tasmota", (("device", influx_host_name),)),
+                                                 field_dict, get_precision_timestamp(fetch_time))
+        # Count the filtered values as written only once InfluxDB has this line
+        hold_values_until_written("tasmota", influx_host_name, line_protocol_full_string)
+        # Skip this IP if none of its fields could be written, since a line without fields is invalid
+        if line_protocol_full_string is None:
+            print("No valid data was found for IP {}, skipping submission of this IP".format(current_ip))
             continue
-        # Format the rest of the Line Protocol, forming together the measurement, tags, field set, and time
-        line_protocol_full_string = "tasmota,device={} {} {}".format(influx_host_name,
-                                                                     line_protocol_field_set,
-                                                                     epoch_time_seconds)
         print("Converted data from {} into Line Protocol: {}".format(current_ip, line_protocol_full_string))
         # Add the completed Line Protocol to the list of Line Protocol to write to Influx
         line_protocol_string_list.append(line_protocol_full_string)
+        increment_stat("tasmota", current_ip, "points")
+    save_recorded_responses("tasmota")
+    return line_protocol_string_list
+
+
+# Take one high-frequency sample from every Tasmota device, folding the aggregated fields into the current window
+# without writing anything
+def sample_tasmota_readings():
+    fetched_data_list, fetch_time_list = fetch_all_with_device_health("tasmota", fetch_data_from_ip,
+                                                                      [current_ip for current_ip, _ in
+                                                                       ip_addresses_to_influx_hosts],
+                                                                      record_health=False)
+    for (_, influx_host_name), data, fetch_time in zip(ip_addresses_to_influx_hosts, fetched_data_list,
+                                                       fetch_time_list):
+        # Devices that couldn't be reached or returned malformed data are just missing from this sample
+        if isinstance(data, Exception):
+            continue
+        try:
+            field_dict = parse_raw_data_into_field_set(data)
+        except Exception as parse_error:
+            print("Could not parse sample from {}, skipping: {}".format(influx_host_name, parse_error))
+            continue
+        record_latest_values("tasmota", influx_host_name, field_dict, fetch_time)
+        add_field_samples("tasmota", influx_host_name, field_dict, influx_fields_to_aggregate)
+
+
+# Collect the Tasmota data and write it to Influx on its own
+def collect_and_write_tasmota_readings():
+    line_protocol_string_list = collect_tasmota_readings()
     print("Writing data from {} Tasmota devices into InfluxDB".format(len(line_protocol_string_list)))
     send_data_to_influx(line_protocol_string_list)
     print("Completed writing Tasmota data to Influx!")
 
 
 if __name__ == '__main__':
-    wait_seconds = randint(0, 10)
-    print("Adding {} second(s) of jitter before executing".format(wait_seconds))
-    sleep(wait_seconds)
+    wait_for_collector_phase("tasmota")
     collect_and_write_tasmota_readings()
+    # Write anything still batched before the process exits
+    close_influx_writer()
@@ -0,0 +1,167 @@
+import asyncio
+from threading import Event
+
+import pytest
+
+import esp
+import esp_ingest_server
+from fake_devices import build_esp_response
+
+# Tests of esp_ingest_server.py, driving a server on a free local port with a raw HTTP client, and with the write to
+# InfluxDB replaced so reports can be checked without one
+# Run with `pipenv run python3 -m pytest test_esp_ingest_server.py`
+
+
+# Build a report holding every field the ESP collector reads, as a board would send it
+def build_valid_report():
+    esp_field_name_list = []
+    for _, http_field in esp.influx_fields_to_http_fields:
+        for esp_field_name in (http_field if isinstance(http_field, tuple) else (http_field,)):
+            if esp_field_name not in esp_field_name_list:
+                esp_field_name_list.append(esp_field_name)
+    return build_esp_response(esp_field_name_list)
+
+
+# Build a POST of the given body to the given target, with a Content-Length unless one is given as extra header text
+def build_request(body_bytes, target="/esp?host=nodemcu1", extra_header_text=None):
+    if extra_header_text is None:
+        extra_header_text = "Content-Length: {}\r\n".format(len(body_bytes))
+    return ("POST {} HTTP/1.1\r\nHost: 127.0.0.1\r\n{}\r\n".format(target, extra_header_text).encode("ascii") +
+            body_bytes)
+
+
+# Send one request on its own connection, returning a Tuple of the status code, dict of headers, and body text
+async def send_request(port_number, request_bytes):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port_number)
+    try:
+        writer.write(request_bytes)
+        header_line_list = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        header_dict = {}
+        for header_line in header_line_list[1:]:
+            header_name, _, header_value = header_line.partition(":")
+            header_dict[header_name.strip().lower()] = header_value.strip()
+        body_bytes = await reader.readexactly(int(header_dict.get("content-length", 0)))
+    finally:
+        writer.close()
+    return int(header_line_list[0].split(" ")[1]), header_dict, body_bytes.decode("utf-8")
+
+
+# Start a server for one test, then stop it and its writer task when the test is done
+async def run_with_server(test_coroutine_function):
+    server = await esp_ingest_server.start_ingest_server()
+    try:
+        await test_coroutine_function(server.sockets[0].getsockname()[1])
+    finally:
+        server.point_writer_task.cancel()
+        server.close()
+        await server.wait_closed()
+
+
+# Serve a single known board on a free port, keeping every batch of lines that would be written to InfluxDB
+@pytest.fixture
+def written_batch_list(monkeypatch):
+    written_batch_list = []
+    monkeypatch.setattr(esp_ingest_server, "load_device_inventory", lambda: {"esp": [("10.0.0.5", "nodemcu1")]})
+    monkeypatch.setattr(esp_ingest_server, "ingest_listen_host", "127.0.0.1")
+    monkeypatch.setattr(esp_ingest_server, "ingest_listen_port", 0)
+    monkeypatch.setattr(esp_ingest_server, "ingest_flush_interval_seconds", 0)
+    monkeypatch.setattr(esp_ingest_server, "send_data_to_influx", written_batch_list.append)
+    monkeypatch.setattr(esp_ingest_server, "save_recorded_responses", lambda collector_name: None)
+    return written_batch_list
+
+
+def test_valid_report_is_accepted_and_written(written_batch_list):
+    async def check(port_number):
+        status_code, _, _ = await send_request(port_number, build_request(build_valid_report()))
+        assert status_code == 204
+        # Give the writer task its turn to hand the point over
+        for _ in range(100):
+            if len(written_batch_list) > 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run_with_server(check))
+    assert len(written_batch_list) == 1
+    assert written_batch_list[0][0].startswith("environment,host=nodemcu1 ")
+
+
+def test_report_by_address_is_accepted(written_batch_list):
+    async def check(port_number):
+        status_code, _, _ = await send_request(port_number,
+                                               build_request(build_valid_report(), target="/esp?host=10.0.0.5"))
+        assert status_code == 204
+
+    asyncio.run(run_with_server(check))
+
+
+def test_report_without_a_reading_is_accepted_quietly(written_batch_list, capsys):
+    async def check(port_number):
+        status_code, _, _ = await send_request(port_number,
+                                               build_request(b"dhtTemperatureC,dhtHumidityPercent\n21.50,nan\n"))
+        assert status_code == 204
+
+    asyncio.run(run_with_server(check))
+    assert "Corresponding data value not found" not in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("body_bytes", [b"dhtHumidityPercent\n", b"dhtHumidityPercent,dhtTemperatureC\n55.20\n"],
+                         ids=["line count", "field count"])
+def test_malformed_report_is_rejected(written_batch_list, body_bytes):
+    async def check(port_number):
+        status_code, _, _ = await send_request(port_number, build_request(body_bytes))
+        assert status_code == 400
+
+    asyncio.run(run_with_server(check))
+    assert written_batch_list == []
+
+
+def test_unknown_board_is_rejected(written_batch_list):
+    async def check(port_number):
+        status_code, _, body_text = await send_request(port_number,
+                                                       build_request(build_valid_report(), target="/esp?host=nobody"))
+        assert status_code == 404
+        assert "nobody" in body_text
+
+    asyncio.run(run_with_server(check))
+
+
+def test_report_without_length_is_rejected(written_batch_list):
+    async def check(port_number):
+        status_code, header_dict, _ = await send_request(port_number,
+                                                         build_request(build_valid_report(), extra_header_text=""))
+        assert status_code == 411
+        assert header_dict["connection"] == "close"
+
+    asyncio.run(run_with_server(check))
+
+
+def test_oversized_report_is_rejected(written_batch_list):
+    async def check(port_number):
+        body_bytes = b"x" * (esp_ingest_server.ingest_max_body_bytes + 1)
+        status_code, header_dict, _ = await send_request(port_number, build_request(body_bytes))
+        assert status_code == 413
+        assert header_dict["connection"] == "close"
+
+    asyncio.run(run_with_server(check))
+
+
+def test_full_queue_is_retried_later(monkeypatch, written_batch_list):
+    # Hold the writer in its write, as it is while InfluxDB is behind, so the queue of one point fills up
+    write_release_event = Event()
+    monkeypatch.setattr(esp_ingest_server, "send_data_to_influx",
+                        lambda line_protocol_string_list: write_release_event.wait(10))
+    monkeypatch.setattr(esp_ingest_server, "ingest_queue_size", 1)
+    monkeypatch.setattr(esp_ingest_server, "ingest_queue_wait_seconds", 0.1)
+
+    async def check(port_number):
+        try:
+            status_code_list = [(await send_request(port_number, build_request(build_valid_report())))[0]
+                                for _ in range(2)]
+            assert status_code_list == [204, 204]
+            status_code, header_dict, _ = await send_request(port_number, build_request(build_valid_report()))
+            assert status_code == 503
+            assert header_dict["retry-after"] == "1"
+        finally:
+            write_release_event.set()
+
+    asyncio.run(run_with_server(check))
@@ -0,0 +1,268 @@
+import asyncio
+from time import monotonic, perf_counter, time_ns
+
+import response_recorder
+import snmp_engine
+from collector_stats import increment_stat, record_error, set_duration_stat
+from device_health import (CircuitOpenError, get_device_timeout, record_device_failure, record_device_success,
+                           save_device_health, should_poll_device)
+from device_inventory import get_assigned_devices
+from influx_writer import close_influx_writer, get_precision_timestamp, send_data_to_influx
+from line_protocol import build_series_prefix, encode_point
+from phase_scheduler import get_device_phase_delay_seconds, wait_for_collector_phase
+from snmp_engine import forget_transport_target, get_snmp_engine, get_transport_target, run_snmp_coroutine
+
+# Gets Unraid disk, share, memory, and CPU information over SNMPv2c, writing the same measurements as unraid_influx.sh.
+# The disk, share, and memory data comes from net-snmp `extend` scripts on the Unraid server, whose output lines are
+# read with GETBULK walks of NET-SNMP-EXTEND-MIB::nsExtendOutLine, and the CPU data from HOST-RESOURCES-MIB
+# https://oidref.com/1.3.6.1.4.1.8072.1.3.2.4.1.2
+
+# These Tuples define the IP address from which to fetch data and the tag "host" stored in InfluxDB for each, taken
+# from the "unraid" devices in the inventory that this process polls
+ip_addresses_to_influx_hosts = get_assigned_devices("unraid")
+# Define the SNMPv2c community and the port where SNMP is running on the target devices
+snmp_community_name = "public"
+snmp_port_number = 161
+# Define the "measurement" category under which the data fields will be stored
+influx_measurement_name = "unraid"
+# Define how many OIDs each GETBULK request asks for, so a walk of every extend line takes one or two round trips
+bulk_max_repetitions = 50
+
+# Define the OIDs of the nsExtendOutLine and hrProcessorLoad columns that are walked
+ns_extend_out_line_oid = "1.3.6.1.4.1.8072.1.3.2.4.1.2"
+hr_processor_load_oid = "1.3.6.1.2.1.25.3.3.1.2"
+# This Dict defines the extend scripts whose lines are `name: value`, and the "type" tag their fields are stored under
+extend_name_to_influx_type = {"diskfree": "diskFree",
+                              "sharefree": "shareFree",
+                              "meminfo": "memInfo"}
+# Define the extend script whose lines are `disk: temperature`, which is stored as both the diskTemp and diskActive
+# types. A temperature of -2 means the disk is in standby and -1 means it couldn't be read
+disk_temperature_extend_name = "disktemp"
+# Define every "type" tag that must have at least one field, otherwise nothing is written for that Unraid server
+influx_type_list = ["diskTemp", "diskActive", "diskFree", "shareFree", "cpuPercent", "memInfo"]
+
+# The SNMP credentials and context are built on first use, and reused for every poll
+snmp_request_tuple = None
+
+
+# Get the Tuple of SNMP credentials and context, building it the first time. pysnmp is imported here rather than at
+# the top, so it isn't loaded until a server is actually polled
+def get_snmp_request_tuple():
+    global snmp_request_tuple
+    if snmp_request_tuple is None:
+        from pysnmp.hlapi.asyncio import CommunityData, ContextData
+        snmp_request_tuple = (CommunityData(snmp_community_name), ContextData())
+    return snmp_request_tuple
+
+
+# Given an IP address and the OID of a column, walk every row of the column using GETBULK requests on the shared
+# engine, returning a list of (OID, value) Tuples. Raises PySnmpError if the agent can't be reached or returns an error
+async def walk_column(ip_address, column_oid_string, timeout_seconds=None):
+    from pysnmp.error import PySnmpError
+    from pysnmp.hlapi.asyncio import bulkCmd
+    from pysnmp.proto.rfc1902 import Null, ObjectName
+    from pysnmp.proto.rfc1905 import EndOfMibView, NoSuchInstance, NoSuchObject
+    community_data, context_data = get_snmp_request_tuple()
+    transport_target = get_transport_target(ip_address, snmp_port_number, timeout_seconds)
+    column_oid = ObjectName(column_oid_string)
+    var_bind_list = []
+    next_oid = column_oid
+    while True:
+        error_indication, error_status, _, var_bind_table = await bulkCmd(
+            get_snmp_engine(), community_data, transport_target, context_data, 0, bulk_max_repetitions,
+            (next_oid, Null("")), lookupMib=False)
+        if error_indication:
+            raise PySnmpError("Walk of {} failed: {}".format(column_oid_string, error_indication))
+        if error_status:
+            raise PySnmpError("Walk of {} failed: {}".format(column_oid_string, error_status.prettyPrint()))
+        # Each row of the table holds the single column being walked. Stop at the first OID past the column or at the
+        # end of the agent's MIB, which may come partway through a response
+        for (oid, value), in var_bind_table:
+            if not column_oid.isPrefixOf(oid) or isinstance(value, (EndOfMibView, NoSuchInstance, NoSuchObject)):
+                return var_bind_list
+            var_bind_list.append((oid, value))
+        if len(var_bind_table) < 1:
+            return var_bind_list
+        next_oid = var_bind_table[-1][0][0]
+
+
+# Given an IP address, walk the extend output lines and processor load columns at the same time, returning a Tuple of
+# the two lists of (OID, value) Tuples
+async def fetch_data(ip_address, timeout_seconds=None):
+    return tuple(await asyncio.gather(walk_column(ip_address, ns_extend_out_line_oid, timeout_seconds),
+                                      walk_column(ip_address, hr_processor_load_oid, timeout_seconds)))
+
+
+# Given an IP address and the monotonic time the cycle started, wait for the device's phase slot and fetch from it
+# unless its circuit breaker is open, with a timeout based on how quickly it usually responds. Returns a Tuple of the
+# seconds the fetch took, the time since Epoch in nanoseconds that it finished, and the fetched Tuple
+async def fetch_data_with_device_health(ip_address, cycle_start_time):
+    if not should_poll_device("unraid", ip_address):
+        raise CircuitOpenError("Circuit breaker for {} is open, skipping until its next probe".format(ip_address))
+    await asyncio.sleep(get_device_phase_delay_seconds("unraid", ip_address, cycle_start_time))
+    start_time = perf_counter()
+    data = await fetch_data(ip_address, get_device_timeout("unraid", ip_address, snmp_engine.snmp_timeout_seconds))
+    return perf_counter() - start_time, time_ns(), data
+
+
+# Given a list of IP addresses, fetch from all of them at once. Returns a list in the same order, where each entry is
+# either a Tuple of the seconds taken, the time it finished, and the fetched Tuple, or the Exception that was raised
+async def fetch_data_from_all(ip_address_list):
+    cycle_start_time = monotonic()
+    return await asyncio.gather(*[fetch_data_with_device_health(ip_address, cycle_start_time)
+                                  for ip_address in ip_address_list], return_exceptions=True)
+
+
+# Given a `name: value` line such as `disk2: 197598232576`, add the value to the dict of fields under its name. Lines
+# without a whole number after the name are skipped
+def parse_name_value_line(line, field_dict):
+    line_part_list = line.split()
+    if len(line_part_list) < 2 or not (line_part_list[1].isascii() and line_part_list[1].isdigit()):
+        print("Skipping: Encountered an empty name or non-numeric value in line [{}]".format(line))
+        return
+    field_dict[line_part_list[0].rstrip(":")] = float(line_part_list[1])
+
+
+# Given a `disk: temperature` line such as `WDC_WD100EMAZ-00WJTA0_2ABCDAD: 44`, add the disk's temperature and its
+# active state to their dicts of fields. The active state is 1 for an active or idle disk with a temperature, 0 for a
+# disk in standby, and -1 if its temperature couldn't be read
+def parse_disk_temperature_line(line, temperature_field_dict, active_field_dict):
+    line_part_list = line.split()
+    try:
+        disk_name = line_part_list[0].replace(":", "")
+        disk_temperature = int(line_part_list[1])
+    except (IndexError, ValueError):
+        print("Skipping: Encountered an empty disk name or non-numeric temperature in line [{}]".format(line))
+        return
+    if disk_temperature == -2:
+        disk_active = 0
+    elif disk_temperature > 0:
+        disk_active = 1
+    else:
+        disk_active = -1
+    temperature_field_dict[disk_name] = float(disk_temperature)
+    active_field_dict[disk_name] = float(disk_active)
+
+
+# Given the walked extend output lines and processor loads, parse every line in a single pass into a dict of each
+# "type" tag to its dict of fields. Each var bind is an (OID, value) pair, either as returned by pysnmp or as a Tuple of
+# OID numbers and the line's bytes or the load's number, such as when replayed from a recording
+def parse_var_binds_into_type_dict(extend_var_bind_list, processor_var_bind_list):
+    type_to_field_dict = {influx_type: {} for influx_type in influx_type_list}
+    # nsExtendOutLine is indexed by the extend name as a length-prefixed string, then the line number
+    name_length_index = len(ns_extend_out_line_oid.split("."))
+    for oid, value in extend_var_bind_list:
+        oid_tuple = tuple(oid)
+        extend_name = bytes(oid_tuple[name_length_index + 1:name_length_index + 1 + oid_tuple[name_length_index]]) \
+            .decode("ascii", "replace")
+        line = bytes(value).decode("utf-8", "replace")
+        if extend_name == disk_temperature_extend_name:
+            parse_disk_temperature_line(line, type_to_field_dict["diskTemp"], type_to_field_dict["diskActive"])
+            continue
+        influx_type = extend_name_to_influx_type.get(extend_name)
+        if influx_type is not None:
+            parse_name_value_line(line, type_to_field_dict[influx_type])
+    # Processors are numbered from zero in the order they are listed
+    for core_number, (_, value) in enumerate(processor_var_bind_list):
+        type_to_field_dict["cpuPercent"][str(core_number)] = float(value)
+    return type_to_field_dict
+
+
+# Given the walked extend output lines and processor loads, convert them into a dict of JSON types for recording, with
+# each OID as a dotted string and each line as text
+def build_recorded_var_binds(extend_var_bind_list, processor_var_bind_list):
+    return {"extend": [(".".join(str(number) for number in oid), bytes(value).decode("utf-8", "replace"))
+                       for oid, value in extend_var_bind_list],
+            "processor": [(".".join(str(number) for number in oid), int(value))
+                          for oid, value in processor_var_bind_list]}
+
+
+# Given var binds recorded by build_recorded_var_binds, convert them back into the extend output lines and processor
+# loads that parse_var_binds_into_type_dict takes
+def read_recorded_var_binds(recorded_dict):
+    return ([(tuple(int(number) for number in oid_string.split(".")), line.encode("utf-8"))
+             for oid_string, line in recorded_dict["extend"]],
+            [(tuple(int(number) for number in oid_string.split(".")), value)
+             for oid_string, value in recorded_dict["processor"]])
+
+
+# Top-level Unraid data-gathering function to orchestrate all the other calls in this file, returning the Line Protocol
+# for every server without writing it
+def collect_unraid_readings():
+    # Instantiate a list to store lines of Line Protocol to write to Influx
+    line_protocol_string_list = []
+    # Build the request parts and engine up front, so that first-time work doesn't hold up the shared SNMP event loop
+    get_snmp_request_tuple()
+    get_snmp_engine()
+    # Walk every IP at once
+    fetched_data_list = run_snmp_coroutine(fetch_data_from_all([current_ip for current_ip, _ in
+                                                                ip_addresses_to_influx_hosts]))
+    # Iterate through each tuple of IP and Influx host name alongside the data fetched from it
+    for (current_ip, influx_host_name), data in zip(ip_addresses_to_influx_hosts, fetched_data_list):
+        print("\nChecking IP {} with Influx Host Name {}".format(current_ip, influx_host_name))
+        if isinstance(data, Exception):
+            record_error("unraid", current_ip, data)
+        if isinstance(data, CircuitOpenError):
+            print("Skipping IP {}: {}".format(current_ip, data))
+            continue
+        elif isinstance(data, Exception):
+            # Don't exit on any Exception when getting data, such as the host name not resolving, rather skipping the
+            # current IP so the others are still written. Forget its transport so the host name is resolved again next
+            # time in case that is what failed
+            print("Could not connect/fetch from IP {}, skipping. Error was {}".format(current_ip, data))
+            forget_transport_target(current_ip, snmp_port_number)
+            record_device_failure("unraid", current_ip)
+            continue
+        fetch_seconds, fetch_time, (extend_var_bind_list, processor_var_bind_list) = data
+        record_device_success("unraid", current_ip, fetch_seconds)
+        set_duration_stat("unraid", current_ip, "fetchMilliseconds", fetch_seconds)
+        # Only convert the var binds for recording when recording, since they are otherwise parsed as they are
+        if response_recorder.response_recording_enabled:
+            response_recorder.record_response("unraid", current_ip,
+                                              build_recorded_var_binds(extend_var_bind_list, processor_var_bind_list),
+                                              fetch_time)
+
+        parse_start_time = perf_counter()
+        type_to_field_dict = parse_var_binds_into_type_dict(extend_var_bind_list, processor_var_bind_list)
+        set_duration_stat("unraid", current_ip, "parseMilliseconds", perf_counter() - parse_start_time)
+        # Skip this IP if any type is missing, rather than writing a partial set of data
+        unfilled_type_list = [influx_type for influx_type in influx_type_list
+                              if len(type_to_field_dict[influx_type]) < 1]
+        if len(unfilled_type_list) > 0:
+            print("Values for {} were unfilled for IP {}, skipping submission of this IP".format(unfilled_type_list,
+                                                                                                current_ip))
+            continue
+
+        # Stamp every type with the time the walks finished, which is used when writing lines to Influx
+        epoch_time_stamp = get_precision_timestamp(fetch_time)
+        # Encode one line of Line Protocol per type, forming together the measurement, tags, field set, and time
+        for influx_type in influx_type_list:
+            line_protocol_full_string = encode_point(build_series_prefix(influx_measurement_name,
+                                                                         (("host", influx_host_name),
+                                                                          ("type", influx_type))),
+                                                     type_to_field_dict[influx_type], epoch_time_stamp)
+            print("Converted data from {} into Line Protocol: {}".format(current_ip, line_protocol_full_string))
+            line_protocol_string_list.append(line_protocol_full_string)
+            increment_stat("unraid", current_ip, "points")
+    save_device_health("unraid")
+    response_recorder.save_recorded_responses("unraid")
+    return line_protocol_string_list
+
+
+# Collect the Unraid data and write it to Influx on its own
+def collect_and_write_unraid_readings():
+    line_protocol_string_list = collect_unraid_readings()
+    # Skip calling InfluxDB if the Line Protocol list ended up being empty
+    if len(line_protocol_string_list) < 1:
+        print("No Unraid data found, skipping write")
+        return
+    print("\nWriting {} line(s) of Unraid data into InfluxDB".format(len(line_protocol_string_list)))
+    send_data_to_influx(line_protocol_string_list)
+    print("Completed writing Unraid data to Influx!")
+
+
+if __name__ == '__main__':
+    wait_for_collector_phase("unraid")
+    collect_and_write_unraid_readings()
+    # Write anything still batched before the process exits
+    close_influx_writer()
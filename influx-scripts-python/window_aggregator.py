@@ -0,0 +1,65 @@
+from threading import Lock
+
+# In-memory windowed aggregation of fields sampled faster than they are written, so short spikes between writes are
+# still captured. When the resident collector runs a collector's sampler every few seconds, each sample of the fields
+# that collector aggregates is folded into a small accumulator per device and field. When the collector next runs its
+# normal write, the minimum, maximum, and mean over the window are added as extra fields, such as `wattsMin`, `wattsMax`
+# and `wattsMean`, beside the field itself which keeps holding the last value. The window then starts over, so the
+# number of points written is the same as without sampling. Nothing is added for a device that had no samples.
+
+# Define the suffixes added to an Influx field's name for each of its aggregates
+minimum_field_suffix = "Min"
+maximum_field_suffix = "Max"
+mean_field_suffix = "Mean"
+
+# Map each (collector name, device) to its dict of Influx field to accumulator, each a List of
+# [sample count, sum, minimum, maximum]
+window_accumulator_dict = {}
+window_lock = Lock()
+
+
+# Fold one value into a field's accumulator, creating it on the field's first sample in the window
+def add_value_to_accumulator(field_accumulator_dict, influx_field, value):
+    accumulator = field_accumulator_dict.get(influx_field)
+    if accumulator is None:
+        field_accumulator_dict[influx_field] = [1, value, value, value]
+        return
+    accumulator[0] += 1
+    accumulator[1] += value
+    if value < accumulator[2]:
+        accumulator[2] = value
+    if value > accumulator[3]:
+        accumulator[3] = value
+
+
+# Given one sample of a device's dict of Influx field to value, fold the fields being aggregated into the window
+def add_field_samples(collector_name, device_key, field_dict, aggregated_field_list):
+    with window_lock:
+        field_accumulator_dict = window_accumulator_dict.setdefault((collector_name, device_key), {})
+        for influx_field in aggregated_field_list:
+            value = field_dict.get(influx_field)
+            if value is not None:
+                add_value_to_accumulator(field_accumulator_dict, influx_field, float(value))
+
+
+# Given the device's dict of Influx field to value about to be written, fold it into the window as its last sample and
+# return a dict of the window's aggregate fields to write alongside it, starting a new window. Returns an empty dict if
+# the device wasn't sampled since the last write, which is always the case when high-frequency sampling is off
+def drain_window_aggregates(collector_name, device_key, field_dict, aggregated_field_list):
+    with window_lock:
+        field_accumulator_dict = window_accumulator_dict.pop((collector_name, device_key), None)
+    if field_accumulator_dict is None:
+        return {}
+    aggregate_field_dict = {}
+    for influx_field in aggregated_field_list:
+        value = field_dict.get(influx_field)
+        if value is not None:
+            add_value_to_accumulator(field_accumulator_dict, influx_field, float(value))
+        accumulator = field_accumulator_dict.get(influx_field)
+        if accumulator is None:
+            continue
+        sample_count, value_sum, minimum_value, maximum_value = accumulator
+        aggregate_field_dict[influx_field + minimum_field_suffix] = minimum_value
+        aggregate_field_dict[influx_field + maximum_field_suffix] = maximum_value
+        aggregate_field_dict[influx_field + mean_field_suffix] = round(value_sum / sample_count, 3)
+    return aggregate_field_dict